@@ -114,6 +114,108 @@ QUERY_PROCESSORS = {
     'default': 'avocado.query.pipeline.QueryProcessor',
 }
 
+# Number of rows fetched per round trip when unbounded export queries are
+# streamed through a server-side cursor (PostgreSQL only). The query is
+# executed once and rows are handed to the exporter as they arrive. Queries
+# of the p_* tables that can be seeked on a keyset are read with keyset
+# pagination instead. Set to `None` (or 0) to fall back to the chunked
+# LIMIT/OFFSET queries.
+QUERY_STREAM_ITERSIZE = 2000
+
+# Number of worker processes used by `QueryProcessor.get_partitioned_iterable`
+# to execute and format primary key partitions of an export in parallel.
+# Each partition spans the number of keys estimated to produce as many rows
+# as fit in `QUERY_CHUNK_MEMORY`. Defaults to the number of CPUs when `None`.
+QUERY_PARTITION_PROCESSES = None
+
+# Maximum number of compiled queries kept per process by the query
+# processor. Entries are keyed by the context and view JSON, the tree and the
+# versions of the referenced fields and concepts, and the least recently used
+# entry is evicted first. Set to `None` (or 0) to disable the cache.
+QUERY_CACHE_SIZE = 100
+
+# Maximum number of parsed context trees that are kept per process. Trees
+# are shared by contexts with the same conditions for the same user until
+# one of the referenced fields changes. The same number of composite context
+# graphs are kept, reused until one of the contexts changes. Set to `None` to
+# parse contexts on every use.
+CONTEXT_CACHE_SIZE = 100
+
+# Toggle whether the stage timings and counters collected by the query
+# processor and exporters are written to the `avocado.query.metrics` logger
+# and/or stored as an event in the `avocado.events` Log table (this requires
+# usage logging to be enabled) when an export finishes.
+METRICS_LOGGING = False
+METRICS_EVENTS = False
+
+# Maximum number of select and order by plans of views kept per process.
+# Plans are keyed by the view JSON, the tree and whether the query is
+# distinct, and are reused until a concept or its fields change. Changes made
+# by other processes are seen through a version kept in the Django cache, so
+# the cache backend must be shared by the processes (e.g. memcached). Set to
+# `None` to derive the plan on every use.
+VIEW_CACHE_SIZE = 100
+
+# Toggle whether parsed context trees are optimized before they are applied.
+# Duplicate conditions are dropped, conditions on the same field are merged
+# and branches that can not match any row are applied as a `1 = 0` condition.
+# Query processors return an empty queryset without executing any SQL for
+# contexts that can not match any row at all.
+CONTEXT_OPTIMIZER_ENABLED = True
+
+# Approximate memory budget in bytes for each chunk of rows fetched while
+# iterating over large query results. The size of the rows is measured from
+# the first chunk of `QUERY_CHUNK_INITIAL` rows and later chunks are sized to
+# fit the budget. Set to `None` to always fetch `QUERY_CHUNK_INITIAL` rows.
+QUERY_CHUNK_MEMORY = 64 * 1024 * 1024
+QUERY_CHUNK_INITIAL = 1000
+
+# Size in bytes of the chunks streamed from the database when TSV exports
+# whose values need no formatting in Python are bulk copied with
+# `COPY ... TO STDOUT`. Set to `None` to always fetch and format the rows in
+# Python.
+QUERY_COPY_CHUNKSIZE = 65536
+
+# Number of values above which the values of `in` conditions are passed to
+# PostgreSQL as a single array parameter (`IN (SELECT unnest(%s))`) instead
+# of one parameter per value. Set to `None` to always pass one parameter per
+# value.
+QUERY_IN_ARRAY_THRESHOLD = 1000
+
+# How conditions on the samples of the `_matrix` table are rendered for custom
+# (dict-based) conditions. `correlated` compares the primary key to a
+# correlated subquery per sample condition, `exists` uses a correlated
+# `EXISTS` per condition and `grouped` scans the matrix table once for all
+# conditions, keeping the keys that match each of them.
+SAMPLE_QUERY_STRATEGY = 'correlated'
+
+# Exports fetch rows from the database in a background thread while the
+# previous rows are formatted and written. At most `EXPORT_PIPELINE_DEPTH`
+# batches of `EXPORT_PIPELINE_BATCH` rows are buffered. Set the depth to
+# `None` to fetch and format the rows in turn.
+EXPORT_PIPELINE_DEPTH = 4
+EXPORT_PIPELINE_BATCH = 1000
+
+# Number of seconds the read positions of paged exports are kept in the
+# Django cache so the next page can be read, by any process, without
+# rescanning the preceding rows. Pages whose rows are deduplicated in Python
+# can only be resumed while the number of distinct rows read so far is at
+# most `EXPORT_RESUME_WINDOW`, since their hashes are kept with the position.
+EXPORT_RESUME_TIMEOUT = 60 * 60
+EXPORT_RESUME_WINDOW = 10000
+
+# Number of worker processes of the `avocado exports` command that run
+# background export jobs (see `avocado.export.jobs`) and the directory the
+# job output and status is written to. The directory defaults to the `exports` directory
+# of the `WAREHOUSE_PATH` setting.
+EXPORT_JOB_PROCESSES = 2
+EXPORT_JOB_DIR = None
+
+# Number of worker processes each export job uses to read the primary key
+# partitions of its export in parallel (see `QUERY_PARTITION_PROCESSES`).
+# Jobs read their export serially when set to 1 or `None`.
+EXPORT_JOB_PARTITION_PROCESSES = 1
+
 # Custom validation error and warnings messages
 VALIDATION_ERRORS = {}
 VALIDATION_WARNINGS = {}
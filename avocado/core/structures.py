@@ -1,3 +1,4 @@
+from threading import Lock
 try:
     from collections import OrderedDict
 except ImportError:
@@ -22,3 +23,48 @@ class ChoicesDict(OrderedDict):
             data[-1] = '...(remaining elements truncated)...'
 
         return repr(tuple(data))
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry once
+    `maxsize` entries are stored. Access is synchronized so a single instance
+    can be shared across threads.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            # Move to the end to mark it as most recently used
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
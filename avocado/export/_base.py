@@ -1,7 +1,17 @@
+from django.core.cache import cache
 from avocado.models import DataConcept, DataView, DataField
 from avocado.formatters import Formatter
+from avocado.conf import settings
+from avocado.query.cache import fingerprint
+from avocado.query.pipeline import PartitionedIterable, QueryIterable, \
+    detached_iterator, prefetch_iterator, supports_prefetch
+from avocado.query.metrics import Metrics
 from cStringIO import StringIO
 from itertools import tee
+import uuid
+
+# Prefix of the Django cache keys of the read positions of paged exports
+RESUME_KEY_PREFIX = 'avocado:resume:'
 
 def get_type_map(model_version_id, model_type):  
     if model_type=='sample':
@@ -35,6 +45,9 @@ class BaseExporter(object):
     content_type = 'text/plain'
     preferred_formats = ()
 
+    # Whether the metrics are reported once the rows have been read
+    report_metrics = True
+
     def __init__(self, concepts=None):
         if concepts is None:
             concepts = ()
@@ -48,6 +61,7 @@ class BaseExporter(object):
         self.params = []
         self.row_length = 0
         self.concepts = concepts
+        self.metrics = Metrics()
 
         for concept in concepts:
             self.add_formatter(concept)
@@ -74,6 +88,11 @@ class BaseExporter(object):
         else:
             self.params.append(params)
 
+    def _written(self, data):
+        "Records `data` as serialized output and returns it."
+        self.metrics.incr('bytes_written', len(data))
+        return data
+
     def get_file_obj(self, name=None):
         if name is None:
             return StringIO()
@@ -152,56 +171,146 @@ class BaseExporter(object):
 
         If `limit` is defined, once the limit has been reached (or the
         iterator is exhausted), the loop will exit.
+
+        If the iterable is a `QueryIterable`, the offset and limit are applied
+        to the query itself when the rows do not need to be filtered. When
+        they do, `resume_token` is set once the rows have been read and can
+        be passed as `resume` to read the next page without rescanning the
+        preceding rows.
         """
-        
+        resume = kwargs.pop('resume', None)
+        self.resume_token = None
+
         if 'model_version_id' in kwargs:
             model_version_id = kwargs['model_version_id']
             model_type = kwargs['model_type']
-            self.type_map = get_type_map(model_version_id, model_type)
-            self.allowed_value_map = get_allowed_value_map(model_version_id)
-            self.title_map = get_title_map(model_version_id)
+            with self.metrics.stage('metadata'):
+                self.type_map = get_type_map(model_version_id, model_type)
+                self.allowed_value_map = \
+                    get_allowed_value_map(model_version_id)
+                self.title_map = get_title_map(model_version_id)
         else:
             model_version_id = None
 
-        emitted = 0
+        # Partitions are read and formatted by worker processes, the rows
+        # are already distinct within each primary key range.
+        if isinstance(iterable, PartitionedIterable):
+            rows = iterable.read(self, force_distinct=force_distinct, **kwargs)
+
+            for i, row in enumerate(rows):
+                if limit is not None and i - (offset or 0) >= limit:
+                    break
+                if offset is None or i >= offset:
+                    self.metrics.incr('rows_emitted')
+                    yield row
+
+            if self.report_metrics:
+                self.metrics.report()
+            return
+
+        # Number of rows of the query preceding the iterable and the hashes
+        # of the distinct rows among them.
+        position = 0
         unique_rows = set()
+        seekable = isinstance(iterable, QueryIterable)
+
+        if seekable:
+            # Identifies the query the resume tokens belong to
+            query = fingerprint(iterable.sql, iterable.params)
+
+        if seekable and (offset or limit is not None):
+            if not force_distinct or iterable.is_distinct(self.row_length):
+                iterable = iterable.slice(offset, limit)
+                force_distinct = False
+                seekable = False
+                offset = None
+            else:
+                state = cache.get(RESUME_KEY_PREFIX + resume) \
+                    if resume else None
+
+                if state and state['query'] == query and \
+                        state['offset'] == (offset or 0):
+                    position = state['position']
+                    unique_rows = set(state['unique_rows'])
+                    offset = None
+
+                # Pages are always read in the stable order of the slices
+                iterable = iterable.slice(position)
+
+        # Fetch the next rows from the database while the current rows are
+        # formatted and written. The rows are read through a connection of
+        # their own since formatters may query the database meanwhile.
+        if isinstance(iterable, QueryIterable) and iterable.sql and \
+                supports_prefetch(iterable.connection):
+            rows = detached_iterator(iterable.sql, iterable.params,
+                                     iterable.queryset.db,
+                                     metrics=self.metrics)
+            iterable = prefetch_iterator(rows, metrics=self.metrics)
+
+        consumed = 0
+        distinct = 0
+        emitted = 0
         header = []
 
-        for i, row in enumerate(iterable):
-            if limit is not None and emitted >= limit:
-                break
-
+        for row in iterable:
+            consumed += 1
             _row = row[:self.row_length]
 
             if force_distinct:
-                
                 newrow = []
-                for i in range(0, len(_row)):
-                    if type(_row[i]) is list:
-                        newrow.append(str(_row[i]))
+                for value in _row:
+                    if type(value) is list:
+                        newrow.append(str(value))
                     else:
-                        newrow.append(_row[i])
+                        newrow.append(value)
                 _row = tuple(newrow)
-                    
+
                 _row_hash = hash(tuple(_row))
 
                 if _row_hash in unique_rows:
+                    self.metrics.incr('rows_deduplicated')
                     continue
 
                 unique_rows.add(_row_hash)
 
-            if offset is None or i >= offset:
+            distinct += 1
+
+            if offset is None or distinct > offset:
                 emitted += 1
-                formatted_row = self._format_row(_row, **kwargs)
-                formatted_row, row_gen = tee(formatted_row)
-                if i==0:                             
-                    for data in row_gen:
-                        header.extend(data.keys())
-
-                if model_version_id:
-                    yield self.format_row(formatted_row, header)
-                else:                
-                    yield list(formatted_row)
+                self.metrics.incr('rows_emitted')
+
+                with self.metrics.stage('format'):
+                    formatted_row = self._format_row(_row, **kwargs)
+                    formatted_row, row_gen = tee(formatted_row)
+                    if not header:
+                        for data in row_gen:
+                            header.extend(data.keys())
+
+                    if model_version_id:
+                        output = self.format_row(formatted_row, header)
+                    else:
+                        output = list(formatted_row)
+
+                yield output
+
+                if limit is not None and emitted >= limit:
+                    break
+
+        # The next page starts after the rows read so far. The hashes of the
+        # distinct rows are kept so their duplicates are filtered from the
+        # next pages, which is only done for a bounded number of rows.
+        if seekable and force_distinct and limit is not None and \
+                len(unique_rows) <= settings.EXPORT_RESUME_WINDOW:
+            self.resume_token = uuid.uuid4().hex
+            cache.set(RESUME_KEY_PREFIX + self.resume_token, {
+                'query': query,
+                'offset': len(unique_rows),
+                'position': position + consumed,
+                'unique_rows': list(unique_rows),
+            }, settings.EXPORT_RESUME_TIMEOUT)
+
+        if self.report_metrics:
+            self.metrics.report()
 
     def write(self, iterable, *args, **kwargs):
         for row_gen in self.read(iterable, *args, **kwargs):
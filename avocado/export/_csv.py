@@ -1,6 +1,31 @@
 import csv
+from django.db import models
+from avocado.models import DataConcept
+from avocado.formatters import Formatter, RawFormatter, \
+    registry as formatters
+from avocado.query.pipeline import QueryIterable, copy_iterator, \
+    supports_copy
 from _base import BaseExporter
 
+# Internal types of the fields whose values are rendered as text by the
+# database the same way they are formatted in Python, and how they are
+# rendered (see `avocado.query.pipeline.copy_iterator`).
+COPY_TYPES = {
+    'char': 'text',
+    'text': 'text',
+    'slug': 'text',
+    'email': 'text',
+    'url': 'text',
+    'auto': 'number',
+    'integer': 'number',
+    'biginteger': 'number',
+    'smallinteger': 'number',
+    'positiveinteger': 'number',
+    'positivesmallinteger': 'number',
+    'boolean': 'boolean',
+    'nullboolean': 'boolean',
+}
+
 
 class UnicodeWriter(object):
     """
@@ -25,6 +50,16 @@ class UnicodeWriter(object):
             self.writerow(row)
 
 
+class _WrittenFile(object):
+    "File-like object that records the data written through it."
+    def __init__(self, f, written):
+        self.f = f
+        self.written = written
+
+    def write(self, data):
+        self.f.write(self.written(data))
+
+
 class CSVExporter(BaseExporter):
     short_name = 'TSV'
     long_name = 'Tab-Separated Values (TSV)'
@@ -34,7 +69,125 @@ class CSVExporter(BaseExporter):
 
     preferred_formats = ('tsv', 'string')
 
+    def get_titles(self, keys):
+        """Returns the header titles of the formatted `keys`. Without the
+        titles of a model version, the names of the concepts' fields are
+        used.
+        """
+        titles = self.title_map
+
+        if not titles:
+            titles = {}
+
+            for concept in self.concepts:
+                if isinstance(concept, DataConcept):
+                    for key, field in Formatter(concept).fields.items():
+                        titles[key] = field.name or key
+
+        return [titles.get(k, k) for k in keys]
+
+    def get_copy_columns(self, iterable):
+        """Returns the keys and the `(kind, null)` rendering of the columns
+        of the output if the rows do not need to be formatted in Python,
+        otherwise `None`.
+
+        This is the case when every concept uses the default formatter,
+        which outputs the values as strings, and only contains fields whose
+        values are rendered the same way by the database. The primary key of
+        the root model may be output raw.
+        """
+        keys = []
+        columns = []
+        pk = iterable.queryset.model._meta.pk
+
+        for formatter, length in self.params:
+            concept = getattr(formatter, 'im_self', None)
+
+            if isinstance(concept, DataConcept):
+                if formatters.get(concept.formatter_name) is not Formatter:
+                    return
+
+                formatter = Formatter(concept)
+
+                for field in formatter.fields.values():
+                    if field.internal_type not in COPY_TYPES:
+                        return
+
+                    columns.append((COPY_TYPES[field.internal_type], ''))
+            elif type(formatter) is RawFormatter:
+                if formatter.keys != [pk.name] or \
+                        not isinstance(pk, (models.AutoField,
+                                            models.IntegerField)):
+                    return
+
+                columns.append(('number', 'None'))
+            else:
+                return
+
+            if len(formatter.keys) != length:
+                return
+
+            keys.extend(formatter.keys)
+
+        return keys, columns
+
+    def can_copy(self, iterable, force_distinct=True, offset=None,
+                 limit=None, *args, **kwargs):
+        """Returns true if the query behind `iterable` can be copied by the
+        database as is. Rows are only deduplicated by the database itself,
+        so distinct rows must be forced by the query.
+        """
+        if not isinstance(iterable, QueryIterable) or \
+                not supports_copy(iterable.connection):
+            return False
+
+        # Values of model versions are rewritten by `format_row`
+        if offset is not None or limit is not None or \
+                'model_version_id' in kwargs or kwargs.get('resume'):
+            return False
+
+        if force_distinct and not iterable.is_distinct(self.row_length):
+            return False
+
+        return True
+
+    def copy(self, iterable, keys, columns):
+        """Streams the output directly from the database using COPY. The
+        query is executed in a single pass and no rows are built in Python.
+        The output is identical to the one of the formatted rows.
+        """
+        writer = UnicodeWriter(self.get_file_obj(None))
+
+        for i, data in enumerate(copy_iterator(iterable.sql, iterable.params,
+                                               iterable.connection, columns,
+                                               metrics=self.metrics)):
+            # The header is only written along with the first row
+            if i == 0:
+                yield self._written(writer.row_to_str(
+                    self.get_titles(keys)) + '\n')
+
+            self.metrics.incr('rows_emitted', data.count('\n'))
+            yield self._written(data)
+
+        if self.report_metrics:
+            self.metrics.report()
+
+    def _copy(self, iterable, *args, **kwargs):
+        "Returns the output chunks of a COPY if the iterable can be copied."
+        if self.can_copy(iterable, *args, **kwargs):
+            plan = self.get_copy_columns(iterable)
+
+            if plan is not None:
+                return self.copy(iterable, *plan)
+
     def generator(self, iterable, *args, **kwargs):
+        chunks = self._copy(iterable, *args, **kwargs)
+
+        if chunks is not None:
+            for data in chunks:
+                yield data
+            return
+
         header = []
         buff = self.get_file_obj(None)
         writer = UnicodeWriter(buff, quoting=csv.QUOTE_MINIMAL)
@@ -44,19 +197,23 @@ class CSVExporter(BaseExporter):
 
             for data in row_gen:
                 if i == 0:
-                    header.extend([self.title_map[k] for k in data.keys()])
+                    header.extend(self.get_titles(data.keys()))
 
                 row.extend(data.values())
 
             if i == 0:
-                yield writer.row_to_str(header) + '\n'
+                yield self._written(writer.row_to_str(header) + '\n')
 
-            yield writer.row_to_str([str(s) for s in row]) + '\n'
+            with self.metrics.stage('serialize'):
+                line = writer.row_to_str([str(s) for s in row]) + '\n'
+
+            yield self._written(line)
 
     def write(self, iterable, buff=None, *args, **kwargs):
         header = []
         buff = self.get_file_obj(buff)
-        writer = UnicodeWriter(buff, quoting=csv.QUOTE_MINIMAL)
+        writer = UnicodeWriter(_WrittenFile(buff, self._written),
+                               quoting=csv.QUOTE_MINIMAL)
 
         for i, row_gen in enumerate(self.read(iterable, *args, **kwargs)):
             row = []
@@ -67,9 +224,10 @@ class CSVExporter(BaseExporter):
 
                 row.extend(data.values())
 
-            if i == 0:
-                writer.writerow(header)
+            with self.metrics.stage('serialize'):
+                if i == 0:
+                    writer.writerow(header)
 
-            writer.writerow(row)
+                writer.writerow(row)
 
         return buff
@@ -23,16 +23,18 @@ class JSONExporter(BaseExporter):
     def generator(self, iterable, *args, **kwargs):
 
         encoder = JSONGeneratorEncoder()
+        chunks = encoder.iterencode(self.read(iterable, *args, **kwargs))
 
-        for chunk in encoder.iterencode(self.read(iterable, *args, **kwargs)):
-            yield chunk
+        for chunk in self.metrics.timed('serialize', chunks):
+            yield self._written(chunk)
 
     def write(self, iterable, buff=None, *args, **kwargs):
         buff = self.get_file_obj(buff)
 
         encoder = JSONGeneratorEncoder()
+        chunks = encoder.iterencode(self.read(iterable, *args, **kwargs))
 
-        for chunk in encoder.iterencode(self.read(iterable, *args, **kwargs)):
-            buff.write(chunk)
+        for chunk in self.metrics.timed('serialize', chunks):
+            buff.write(self._written(chunk))
 
         return buff
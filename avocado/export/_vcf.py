@@ -9,7 +9,9 @@ import uuid
 import time
 from avocado.models import DataView, DataContext;
 from serrano.resources.base import prune_view_columns, get_alias_map
-from avocado.query.pipeline import QueryProcessor, queryset_iterator
+from avocado.query.pipeline import QueryProcessor, queryset_iterator, \
+    streaming_iterator, supports_streaming, detached_iterator, \
+    prefetch_iterator, supports_prefetch
 from django.db.backends.postgresql_psycopg2 import base
 from django.conf import settings
 from ceviche.utils import to_str, is_none
@@ -143,7 +145,10 @@ class VCFWriter(object):
             view = prune_view_columns(view, model_version['id'])
 
         # construct the query associated with the current view and filter
-        processor = QueryProcessor(context=context, view=view, tree=model_version['model_name'])
+        # The sample clauses are rewritten by `fix_sample_queries` which
+        # expects the correlated form regardless of the configured strategy
+        processor = QueryProcessor(context=context, view=view, tree=model_version['model_name'],
+                                   sample_strategy='correlated')
         queryset = processor.get_queryset(request=request)
 
         # fix queries that include sample filters
@@ -194,11 +199,18 @@ class VCFWriter(object):
         sample_data = [None] * len(sample_indexes)
 
         tables = queryset.query.tables
-        if len(tables)>0 and tables[0].startswith('p_') and 'LIMIT' not in sql:
+        if 'LIMIT' not in sql and supports_prefetch(compiler.connection):
+            # Fetch the next rows through a connection of their own while
+            # the current records are written
+            iterater = prefetch_iterator(
+                detached_iterator(sql, params, queryset.db))
+        elif 'LIMIT' not in sql and supports_streaming(compiler.connection):
+            iterater = streaming_iterator(sql, params, compiler.connection)
+        elif len(tables)>0 and tables[0].startswith('p_') and 'LIMIT' not in sql:
             iterater = queryset_iterator(sql, params, compiler.connection.cursor())
         else:
             cursor.execute(sql, params)
-            iterator = cursor.fetchall()
+            iterater = cursor.fetchall()
 
         for r in iterater:
             vcf_row = [r[i] for i in relevant_idxs]
@@ -398,10 +410,13 @@ class VCFExporter(BaseExporter):
                     writer.init_writer(header, model_version_id, model_type)
                     template_lines = writer.template_content(header, model_version_id, model_type)
                     for line in template_lines:
-                        yield line + '\n'
+                        yield self._written(line + '\n')
 
-                record = writer.get_record(row, header)
-                yield writer.record_to_str(record) + '\n'
+                with self.metrics.stage('serialize'):
+                    record = writer.get_record(row, header)
+                    line = writer.record_to_str(record) + '\n'
+
+                yield self._written(line)
 
     def write(self, iterable, buff=None, *args, **kwargs):
         model_version_id = kwargs['model_version_id']
@@ -0,0 +1,336 @@
+"""Background export jobs.
+
+Exports are queued with `submit` and run by a dedicated worker, started with
+`./manage.py avocado exports`, in a bounded number of processes. Web processes
+never fork workers themselves. Each job writes its output and a
+`status.json` file to its own directory under `EXPORT_JOB_DIR` (by default
+the `exports` directory of the `WAREHOUSE_PATH`), so jobs can be queued,
+polled, cancelled and downloaded from any process.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import logging
+import multiprocessing
+from datetime import datetime
+from django.conf import settings as django_settings
+from avocado.conf import settings
+from avocado.query.pipeline import close_inherited_connections
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Number of output chunks between progress updates and cancellation checks
+PROGRESS_CHUNKS = 1000
+
+# Minimum number of seconds between writes of the status file
+PROGRESS_INTERVAL = 1
+
+# Number of seconds the worker waits before looking for new jobs
+POLL_INTERVAL = 1
+
+job_id_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def get_job_dir():
+    if settings.EXPORT_JOB_DIR:
+        return settings.EXPORT_JOB_DIR
+    return os.path.join(django_settings.WAREHOUSE_PATH, 'exports')
+
+
+class ExportJob(object):
+    "Handle on the status and output of an export job."
+    def __init__(self, id):
+        self.id = id
+        self.path = os.path.join(get_job_dir(), id)
+
+    def __repr__(self):
+        return u'<ExportJob: {0} ({1})>'.format(self.id,
+                                                self.status().get('state'))
+
+    @property
+    def status_path(self):
+        return os.path.join(self.path, 'status.json')
+
+    @property
+    def spec_path(self):
+        return os.path.join(self.path, 'spec.json')
+
+    @property
+    def cancel_path(self):
+        return os.path.join(self.path, 'cancel')
+
+    @property
+    def claim_path(self):
+        return os.path.join(self.path, 'claimed')
+
+    @property
+    def output_path(self):
+        return os.path.join(self.path, self.status()['filename'])
+
+    @property
+    def cancelled(self):
+        return os.path.exists(self.cancel_path)
+
+    def status(self):
+        "Returns the status of the job including the rows and bytes written."
+        with open(self.status_path) as f:
+            return json.load(f)
+
+    def spec(self):
+        "Returns the context, view and exporter the job was submitted with."
+        with open(self.spec_path) as f:
+            return json.load(f)
+
+    def claim(self):
+        """Marks the job as taken by a worker. Returns false if another
+        worker has already claimed it.
+        """
+        try:
+            os.close(os.open(self.claim_path, os.O_CREAT | os.O_EXCL))
+        except OSError:
+            return False
+        return True
+
+    def update(self, **kwargs):
+        status = self.status() if os.path.exists(self.status_path) else {}
+        status.update(kwargs)
+
+        # Write and rename to prevent readers from seeing a partial file
+        tmp_path = '{0}.{1}'.format(self.status_path, os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f)
+
+        os.rename(tmp_path, self.status_path)
+
+    def cancel(self):
+        """Requests the job to be cancelled. A running job stops at the next
+        progress check.
+        """
+        open(self.cancel_path, 'w').close()
+
+        if self.status()['state'] == PENDING:
+            self.update(state=CANCELLED)
+
+    def open(self):
+        "Returns the output file of a completed job."
+        if self.status()['state'] != DONE:
+            raise ValueError('Export job {0} has not completed'
+                             .format(self.id))
+        return open(self.output_path, 'rb')
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def get_pending():
+    "Returns the pending jobs that have not been claimed in submission order."
+    path = get_job_dir()
+
+    if not os.path.isdir(path):
+        return []
+
+    jobs = []
+
+    for job_id in os.listdir(path):
+        job = get(job_id)
+
+        if job is None or os.path.exists(job.claim_path):
+            continue
+
+        try:
+            status = job.status()
+        except (IOError, ValueError):
+            continue
+
+        if status['state'] == PENDING:
+            jobs.append((status['created'], job))
+
+    return [job for created, job in sorted(jobs)]
+
+
+def get(job_id):
+    "Returns the job for `job_id` or `None` if it does not exist."
+    if not job_id_re.match(job_id or ''):
+        return
+
+    job = ExportJob(job_id)
+
+    if os.path.exists(job.status_path):
+        return job
+
+
+def submit(exporter, context=None, view=None, tree=None,
+           processor='default', **kwargs):
+    """Queues an export of the `context` and `view` JSON with the exporter
+    registered as `exporter`. Additional keyword arguments are passed to the
+    exporter. Returns the `ExportJob` which is picked up by the worker.
+    """
+    from avocado.export import registry as exporters
+
+    klass = exporters[exporter]
+    job = ExportJob(uuid.uuid4().hex)
+
+    os.makedirs(job.path)
+
+    spec = {
+        'exporter': exporter,
+        'context': context,
+        'view': view,
+        'tree': tree,
+        'processor': processor,
+        'kwargs': kwargs,
+    }
+
+    # The spec is in place before the job is visible as pending
+    with open(job.spec_path, 'w') as f:
+        json.dump(spec, f)
+
+    job.update(state=PENDING, exporter=exporter,
+               filename='export.{0}'.format(klass.file_extension),
+               content_type=klass.content_type, rows=0, bytes=0,
+               created=datetime.now().isoformat())
+
+    return job
+
+
+def _track(job, exporter, chunks, output):
+    """Writes the output chunks while recording progress and checking for
+    cancellation.
+    """
+    count = 0
+    last = time.time()
+
+    for chunk in chunks:
+        output.write(chunk)
+        count += 1
+
+        if count % PROGRESS_CHUNKS == 0 and \
+                time.time() - last >= PROGRESS_INTERVAL:
+            if job.cancelled:
+                raise JobCancelled
+
+            job.update(rows=exporter.metrics.counters.get('rows_emitted', 0),
+                       bytes=output.tell())
+            last = time.time()
+
+
+def run(job_id):
+    "Runs an export job and records the outcome in its status."
+    from avocado.models import DataContext, DataView
+    from avocado.export import registry as exporters
+    from avocado.query.pipeline import query_processors
+
+    job = ExportJob(job_id)
+
+    if job.cancelled:
+        job.update(state=CANCELLED)
+        return
+
+    job.update(state=RUNNING, started=datetime.now().isoformat())
+
+    try:
+        spec = job.spec()
+        context = DataContext(json=spec['context'])
+        view = DataView(json=spec['view'])
+
+        processor = query_processors[spec['processor']](
+            context=context, view=view, tree=spec['tree'])
+        exporter = processor.get_exporter(exporters[spec['exporter']])
+        kwargs = spec['kwargs']
+
+        processes = settings.EXPORT_JOB_PARTITION_PROCESSES
+
+        with open(job.output_path, 'wb') as output:
+            if processes and processes > 1:
+                iterable = processor.get_partitioned_iterable(
+                    processes=processes)
+            else:
+                iterable = processor.get_iterable()
+
+            # Exporters that produce their output incrementally are preferred
+            if hasattr(exporter, 'generator'):
+                _track(job, exporter, exporter.generator(iterable, **kwargs),
+                       output)
+            else:
+                exporter.write(iterable, output, **kwargs)
+
+            output.flush()
+            size = output.tell()
+
+        job.update(state=DONE, bytes=size,
+                   rows=exporter.metrics.counters.get('rows_emitted', 0),
+                   metrics=exporter.metrics.as_dict(),
+                   finished=datetime.now().isoformat())
+    except JobCancelled:
+        job.update(state=CANCELLED, finished=datetime.now().isoformat())
+    except Exception, e:
+        log.exception('Export job {0} failed'.format(job_id))
+        job.update(state=FAILED, error=unicode(e),
+                   finished=datetime.now().isoformat())
+
+
+def _run_in_worker(job_id):
+    "Runs an export job in a worker process."
+    from django.db import connection
+
+    close_inherited_connections()
+
+    try:
+        run(job_id)
+    finally:
+        # Do not leave the connection to be closed by the exiting process
+        connection.close()
+
+
+def work(processes=None, interval=None, once=False):
+    """Runs the pending jobs in at most `processes` worker processes,
+    `EXPORT_JOB_PROCESSES` by default. New jobs are looked for every
+    `interval` seconds. If `once` is true, returns as soon as no job is
+    pending or running.
+
+    Each job runs in its own process rather than in a process pool, since
+    the workers of a pool can not start the processes that read partitioned
+    exports (see `EXPORT_JOB_PARTITION_PROCESSES`).
+
+    This is the entry point of the `avocado exports` command and must run
+    in its own process rather than in a web process.
+    """
+    processes = processes or settings.EXPORT_JOB_PROCESSES
+    interval = interval or POLL_INTERVAL
+
+    running = []
+
+    try:
+        while True:
+            running = [p for p in running if p.is_alive()]
+
+            # Jobs are only claimed when a worker is free so other workers
+            # can pick up the rest.
+            for job in get_pending()[:processes - len(running)]:
+                if job.claim():
+                    worker = multiprocessing.Process(target=_run_in_worker,
+                                                     args=(job.id,))
+                    worker.start()
+                    running.append(worker)
+
+            if once and not running:
+                break
+
+            time.sleep(interval)
+    finally:
+        for worker in running:
+            worker.join()
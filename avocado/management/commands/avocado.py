@@ -17,6 +17,7 @@ class Command(BaseCommand):
         'lexicon': 'lexicon',
         'history': 'history',
         'migration': 'migration',
+        'exports': 'exports',
     }
 
     def print_subcommands(self, prog_name):
@@ -0,0 +1,23 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from avocado.export import jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs the background export jobs queued by the web processes'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type=int, help='Number of worker '
+                    'processes. Defaults to EXPORT_JOB_PROCESSES.'),
+
+        make_option('--interval', type=float, help='Number of seconds '
+                    'between checks for new jobs.'),
+
+        make_option('--once', action='store_true', help='Exits once no job '
+                    'is pending or running.'),
+    )
+
+    def handle(self, *args, **options):
+        jobs.work(processes=options.get('processes'),
+                  interval=options.get('interval'),
+                  once=options.get('once'))
@@ -17,13 +17,16 @@ from django.core.exceptions import ValidationError
 from avocado.core import utils
 from avocado.core.structures import ChoicesDict
 from avocado.core.models import Base, BasePlural, PublishArchiveMixin
+from django.core.cache import cache
 from avocado.core.cache import post_save_cache, pre_delete_uncache, \
-    cached_method
+    cached_method, instance_cache_key
+from avocado.core.cache.model import NEVER_EXPIRE
 from avocado.conf import settings, dep_supported
 from avocado import managers, history
 from avocado.query.models import AbstractDataView, AbstractDataContext, \
     AbstractDataQuery
 from avocado.query.translators import registry as translators
+from avocado.query.cache import invalidate_concept_fields
 from avocado.query.operators import registry as operators
 from avocado.lexicon.models import Lexicon
 from avocado.stats.agg import Aggregator
@@ -35,6 +38,10 @@ __all__ = ('DataCategory', 'DataConcept', 'DataField',
 
 log = logging.getLogger(__name__)
 
+# Number of values whose labels are fetched per query by
+# `DataField.get_labels`
+LABEL_BATCH_SIZE = 500
+
 ident_re = re.compile(r'^[a-zA-Z][a-zA-Z0-9_]*$')
 validate_ident = RegexValidator(ident_re, _("Enter an 'identifier' that is a "
                                 "valid Python variable name."),
@@ -516,6 +523,85 @@ class DataField(BasePlural, PublishArchiveMixin):
 
         return smart_unicode(value)
 
+    def get_labels(self, values, queryset=None):
+        """Returns a mapping of the given values to their labels.
+
+        Unlike `value_labels()`, only the labels of the requested values are
+        fetched, in batches of `LABEL_BATCH_SIZE` values per query. Labels are
+        cached per value until the data version of the field changes. Values
+        without a label are labeled by themselves as in `get_label()`.
+        """
+        unique = []
+        seen = set()
+        for value in values:
+            if value not in seen:
+                seen.add(value)
+                unique.append(value)
+        values = unique
+
+        labels = ChoicesDict()
+
+        if self.type == 'Boolean' or self.type == 'Boolean Array':
+            known = {True: 'True', False: 'False'}
+        elif self.allowed_values:
+            known = dict(zip(self.allowed_values, self.allowed_values))
+        elif self._has_predefined_choices():
+            known = dict((v, smart_unicode(l)) for v, l in self.field.choices)
+        else:
+            known = None
+
+        if known is not None:
+            for value in values:
+                labels[value] = known.get(value, smart_unicode(value))
+            return labels
+
+        use_cache = settings.DATA_CACHE_ENABLED and queryset is None and \
+            self.pk is not None
+        keys = {}
+        found = {}
+
+        if use_cache:
+            for value in values:
+                keys[value] = instance_cache_key(
+                    self, label='get_labels', version='data_version',
+                    args=[value])
+
+            cached = cache.get_many(keys.values())
+
+            for value, key in keys.items():
+                if key in cached:
+                    found[value] = cached[key]
+
+        missing = [v for v in values if v not in found]
+
+        if missing:
+            if queryset is None:
+                queryset = self.model.objects.all()
+
+            value_field = self.value_field.name
+            label_field = self.label_field.name
+            fetched = {}
+
+            for i in xrange(0, len(missing), LABEL_BATCH_SIZE):
+                batch = missing[i:i + LABEL_BATCH_SIZE]
+                rows = queryset.filter(**{value_field + '__in': batch}) \
+                    .values_list(value_field, label_field).distinct()
+
+                for value, label in rows:
+                    fetched.setdefault(value, smart_unicode(label))
+
+            for value in missing:
+                found[value] = fetched.get(value, smart_unicode(value))
+
+            if use_cache:
+                cache.set_many(dict((keys[v], found[v]) for v in missing),
+                               timeout=NEVER_EXPIRE)
+
+        for value in values:
+            labels[value] = found[value]
+
+        return labels
+
     def _has_predefined_choices(self):
         """Returns true if the base field has pre-defined choices and no
         alternative label field has been defined.
@@ -1131,6 +1217,15 @@ pre_delete.connect(pre_delete_uncache, sender=DataField)
 pre_delete.connect(pre_delete_uncache, sender=DataConcept)
 pre_delete.connect(pre_delete_uncache, sender=DataCategory)
 
+# Invalidate the process-level map of concept fields
+post_save.connect(invalidate_concept_fields, sender=DataField)
+post_save.connect(invalidate_concept_fields, sender=DataConcept)
+post_save.connect(invalidate_concept_fields, sender=DataConceptField)
+
+pre_delete.connect(invalidate_concept_fields, sender=DataField)
+pre_delete.connect(invalidate_concept_fields, sender=DataConcept)
+pre_delete.connect(invalidate_concept_fields, sender=DataConceptField)
+
 # Register with history API
 if settings.HISTORY_ENABLED:
     history.register(DataContext, fields=('name', 'description', 'json'))
@@ -0,0 +1,191 @@
+import json
+import hashlib
+from threading import Lock
+from django.core.cache import cache
+from modeltree.tree import trees
+from avocado.conf import settings
+from avocado.core.structures import LRUCache
+from avocado.core.cache.model import NEVER_EXPIRE
+
+# Keys added to context nodes during validation. They are descriptive only
+# and do not change the resulting query.
+ANNOTATION_KEYS = ('language', 'cleaned_value', 'errors', 'warnings')
+
+
+# Compiled querysets and their SQL keyed by `QueryProcessor.get_cache_key`
+compiled_queries = LRUCache(settings.QUERY_CACHE_SIZE)
+
+# Parsed context trees keyed by `context_key`
+parsed_contexts = LRUCache(settings.CONTEXT_CACHE_SIZE)
+
+# Contexts reachable from a composite context keyed by the id of the
+# composite and the user
+composite_graphs = LRUCache(settings.CONTEXT_CACHE_SIZE)
+
+# Select and order by plans of views keyed by the view JSON, the tree, the
+# distinct flag and the version of `concept_fields`
+view_plans = LRUCache(settings.VIEW_CACHE_SIZE)
+
+# Ordered fields of each concept keyed by the concept id. The map is shared
+# by the processes through a version stored in the Django cache which is
+# incremented whenever a concept or its fields change. Changes made by other
+# processes are only seen if the Django cache is shared by the processes
+# (e.g. memcached), a local-memory cache only invalidates its own process.
+concept_fields = {}
+CONCEPT_FIELDS_VERSION_KEY = 'avocado:concept_fields_version'
+_concept_fields_state = {'version': None}
+_concept_fields_lock = Lock()
+
+
+def canonical(attrs):
+    "Returns a copy of the JSON structure without the annotation keys."
+    if isinstance(attrs, dict):
+        return dict((k, canonical(v)) for k, v in attrs.items()
+                    if k not in ANNOTATION_KEYS)
+    if isinstance(attrs, (list, tuple)):
+        return [canonical(x) for x in attrs]
+    return attrs
+
+
+def fingerprint(*parts):
+    "Returns a hash of the canonical JSON representation of `parts`."
+    raw = json.dumps(parts, sort_keys=True, default=unicode)
+    return hashlib.sha1(raw).hexdigest()
+
+
+def context_versions(attrs, user=None, metadata=None):
+    """Returns the versions of the fields and composite contexts referenced
+    by the context. The `metadata` already resolved for the context may be
+    passed to avoid resolving it again.
+    """
+    from avocado.query.oldparsers.datacontext import Metadata
+
+    if not attrs or not isinstance(attrs, dict):
+        return ()
+
+    if metadata is None:
+        metadata = Metadata(attrs, user=user)
+
+    fields = sorted((f.pk, f.data_version, f.modified)
+                    for f in metadata.fields.values())
+    contexts = sorted((c.pk, c.modified) for c in metadata.contexts.values())
+
+    if not contexts:
+        return tuple(fields)
+
+    return tuple(fields), tuple(contexts)
+
+
+def view_versions(attrs):
+    "Returns the versions of the concepts and fields referenced by the view."
+    from avocado.models import DataConceptField
+    from avocado.query.oldparsers import dataview
+
+    node = dataview.parse(attrs)
+    ids = set(node.concept_ids)
+    ids.update(pk for pk, direction in node.ordering)
+
+    if not ids:
+        return ()
+
+    return tuple(DataConceptField.objects.filter(concept__pk__in=ids)
+                 .order_by('pk')
+                 .values_list('pk', 'concept', 'field', 'modified',
+                              'concept__modified', 'field__data_version',
+                              'field__modified'))
+
+
+def _tree_key(tree):
+    """Returns a stable key for a tree alias or model. The default tree is
+    keyed by its root model, so it shares keys with trees passed as that
+    model.
+    """
+    if tree is None:
+        tree = trees.default.root_model
+    if isinstance(tree, basestring):
+        return tree
+    opts = tree._meta
+    return u'{0}.{1}'.format(opts.app_label, opts.object_name)
+
+
+def context_key(attrs, tree=None, metadata=None, **context):
+    """Returns the key of the parsed context tree in `parsed_contexts` or
+    `None` if it cannot be cached. Trees are scoped to the user in the parse
+    context, other parse context is not supported.
+    """
+    if not settings.CONTEXT_CACHE_SIZE:
+        return
+
+    user = context.pop('user', None)
+
+    if context:
+        return
+
+    versions = context_versions(attrs, user=user, metadata=metadata)
+
+    return fingerprint('context', canonical(attrs), _tree_key(tree),
+                       getattr(user, 'pk', user), versions)
+
+
+def concept_fields_version():
+    "Returns the current version of `concept_fields` across processes."
+    return cache.get(CONCEPT_FIELDS_VERSION_KEY, 0)
+
+
+def get_concept_fields(ids, version=None):
+    """Returns the ordered fields of the concepts keyed by the concept id.
+    Only the concepts missing from `concept_fields` are fetched.
+
+    The `version` already read by the caller may be passed to avoid reading
+    it from the Django cache again.
+    """
+    from avocado.models import DataConceptField
+
+    if version is None:
+        version = concept_fields_version()
+
+    with _concept_fields_lock:
+        if version != _concept_fields_state['version']:
+            concept_fields.clear()
+            _concept_fields_state['version'] = version
+
+        fields = dict((pk, concept_fields[pk]) for pk in ids
+                      if pk in concept_fields)
+
+    missing = set(ids).difference(fields)
+
+    if missing:
+        fetched = dict((pk, []) for pk in missing)
+
+        cfields = DataConceptField.objects.filter(concept__pk__in=missing)\
+            .select_related('field').order_by('concept', 'order')
+
+        for cf in cfields:
+            fetched[cf.concept_id].append(cf.field)
+
+        with _concept_fields_lock:
+            for pk, concept_field_list in fetched.items():
+                fields[pk] = tuple(concept_field_list)
+
+                # Not stored if the map was invalidated in the meantime
+                if version == _concept_fields_state['version']:
+                    concept_fields[pk] = fields[pk]
+
+    return fields
+
+
+def invalidate_concept_fields(**kwargs):
+    """Signal receiver that clears `concept_fields` and the view plans
+    derived from it in all processes when a concept, concept field or field
+    is saved or deleted.
+    """
+    try:
+        cache.incr(CONCEPT_FIELDS_VERSION_KEY)
+    except ValueError:
+        cache.set(CONCEPT_FIELDS_VERSION_KEY, 1, timeout=NEVER_EXPIRE)
+
+    with _concept_fields_lock:
+        concept_fields.clear()
+        _concept_fields_state['version'] = None
+
+    view_plans.clear()
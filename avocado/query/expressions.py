@@ -0,0 +1,202 @@
+"""Expression trees for the SQL conditions of custom (dict-based) query
+conditions.
+
+Conditions are combined as `And`, `Or` and `Not` nodes over `Predicate`
+leaves rather than by concatenating SQL strings. `simplify` flattens nested
+nodes of the same type, removes duplicate predicates and merges exact
+matches on the same column that are OR'ed together into a single `IN`
+predicate. Matches on the `samples` column of the matrix tables are never
+merged since the VCF export rewrites them as `samples = <id>` predicates.
+`render` produces the SQL for the `query` key of the condition.
+"""
+import re
+
+# Matches predicates of the form `column = literal`
+EXACT_RE = re.compile(r'''^(?P<column>[\w."]+)\s*=\s*
+                          (?P<value>'(?:[^']|'')*'|-?\d+(?:\.\d+)?)$''',
+                      re.X)
+
+# Matches the `samples` column of the matrix tables
+SAMPLES_COLUMN_RE = re.compile(r'(^|\.)"?samples"?$')
+
+# Keys of the condition containing the expression of each SQL query key
+EXPRESSION_KEYS = {
+    'query': 'expr',
+    'matrix_query': 'matrix_expr',
+}
+
+
+class Expression(object):
+    def __eq__(self, other):
+        return isinstance(other, Expression) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return u'<{0}: {1}>'.format(self.__class__.__name__, self.render())
+
+    @property
+    def key(self):
+        return (self.__class__.__name__, self.render())
+
+    def render(self):
+        raise NotImplementedError
+
+
+class Predicate(Expression):
+    "Leaf expression containing a SQL condition."
+    def __init__(self, sql):
+        self.sql = sql
+
+    def render(self):
+        return self.sql
+
+    @property
+    def exact(self):
+        """Returns the `(column, value)` pair if this predicate is an exact
+        match of a column against a literal, otherwise `None`.
+        """
+        sql = self.sql.strip()
+
+        if sql.startswith('(') and sql.endswith(')'):
+            sql = sql[1:-1].strip()
+
+        match = EXACT_RE.match(sql)
+
+        if match:
+            return match.group('column'), match.group('value')
+
+
+class In(Predicate):
+    "Matches a column against a list of literals."
+    def __init__(self, column, values):
+        self.column = column
+        self.values = values
+        super(In, self).__init__(u'{0} IN ({1})'.format(
+            column, ', '.join(values)))
+
+
+class Branch(Expression):
+    connector = None
+
+    def __init__(self, children):
+        self.children = list(children)
+
+    def render(self):
+        sql = u' {0} '.format(self.connector) \
+            .join(c.render() for c in self.children)
+        return u'({0})'.format(sql)
+
+
+class And(Branch):
+    connector = 'AND'
+
+
+class Or(Branch):
+    connector = 'OR'
+
+
+class Not(Expression):
+    def __init__(self, child):
+        self.child = child
+
+    def render(self):
+        return u'NOT ({0})'.format(self.child.render())
+
+
+def _exact_values(expr):
+    "Returns the column and the literals an exact match expression matches."
+    if isinstance(expr, In):
+        return expr.column, expr.values
+
+    if isinstance(expr, Predicate):
+        exact = expr.exact
+        if exact and not SAMPLES_COLUMN_RE.search(exact[0]):
+            return exact[0], [exact[1]]
+
+
+def _merge_exact(children):
+    "Merges exact matches on the same column into `In` predicates."
+    columns = {}
+    counts = {}
+
+    for child in children:
+        exact = _exact_values(child)
+
+        if exact:
+            values = columns.setdefault(exact[0], [])
+            values.extend(v for v in exact[1] if v not in values)
+            counts[exact[0]] = counts.get(exact[0], 0) + 1
+
+    merged = []
+    seen = set()
+
+    for child in children:
+        exact = _exact_values(child)
+
+        if exact and counts[exact[0]] > 1:
+            # The merged predicate takes the place of the first match
+            if exact[0] not in seen:
+                seen.add(exact[0])
+                merged.append(In(exact[0], columns[exact[0]]))
+        else:
+            merged.append(child)
+
+    return merged
+
+
+def simplify(expr):
+    "Returns a simplified but equivalent expression."
+    if isinstance(expr, Not):
+        child = simplify(expr.child)
+
+        # NOT (NOT (x)) is x, also under three-valued logic
+        if isinstance(child, Not):
+            return child.child
+
+        return Not(child)
+
+    if not isinstance(expr, Branch):
+        return expr
+
+    children = []
+    seen = set()
+
+    for child in expr.children:
+        child = simplify(child)
+
+        # Nested branches of the same type are flattened
+        if type(child) is type(expr):
+            nested = child.children
+        else:
+            nested = [child]
+
+        for node in nested:
+            if node not in seen:
+                seen.add(node)
+                children.append(node)
+
+    if isinstance(expr, Or):
+        children = _merge_exact(children)
+
+    if len(children) == 1:
+        return children[0]
+
+    return expr.__class__(children)
+
+
+def from_condition(condition, key='query'):
+    """Returns the expression of the condition for the `query` or
+    `matrix_query` key. Conditions built by `tree.query_condition` only
+    contain the SQL and are wrapped in a `Predicate`.
+    """
+    expr_key = EXPRESSION_KEYS[key]
+
+    if condition.get(expr_key) is not None:
+        return condition[expr_key]
+
+    return Predicate(condition[key])
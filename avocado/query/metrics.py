@@ -0,0 +1,145 @@
+import time
+import logging
+from contextlib import contextmanager
+from threading import local, Lock
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+try:
+    import resource
+except ImportError:
+    resource = None
+from avocado.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """Collects the wall time spent in each stage of the query and export
+    pipeline along with counters such as the number of rows fetched, emitted
+    and deduplicated and the number of bytes written.
+
+    Stage timings are exclusive, time spent in a nested stage is only
+    accounted to the nested stage. Stages and counters may be recorded from
+    several threads.
+    """
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.counters = OrderedDict()
+        self.maxima = set()
+        self._local = local()
+        self._lock = Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_local')
+        state.pop('_lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = local()
+        self._lock = Lock()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name):
+        "Context manager that times the enclosed block as stage `name`."
+        stack = self._stack
+        stack.append(0)
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+
+            with self._lock:
+                self.timings[name] = self.timings.get(name, 0) + \
+                    elapsed - nested
+
+            if stack:
+                stack[-1] += elapsed
+
+    def timed(self, name, iterable, counter=None):
+        """Wraps an iterable and times each step as stage `name`. If `counter`
+        is supplied it is incremented for every item.
+        """
+        iterator = iter(iterable)
+
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+
+            if counter:
+                self.incr(counter)
+
+            yield item
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def maximum(self, name, value):
+        "Keeps the maximum of the values recorded for `name`."
+        with self._lock:
+            self.maxima.add(name)
+            self.counters[name] = max(self.counters.get(name, value), value)
+
+    def merge(self, other):
+        """Adds the timings and counters of `other`, such as the metrics of a
+        worker process, to these metrics. Timings of the same stage are
+        summed, so they add up to more than the wall time when the stages
+        ran in parallel.
+        """
+        with self._lock:
+            for name, value in other.timings.items():
+                self.timings[name] = self.timings.get(name, 0) + value
+
+            for name, value in other.counters.items():
+                if name in other.maxima:
+                    self.maxima.add(name)
+                    self.counters[name] = max(self.counters.get(name, value),
+                                              value)
+                else:
+                    self.counters[name] = self.counters.get(name, 0) + value
+
+    @property
+    def peak_rss(self):
+        "Peak resident set size of this process in bytes."
+        if resource:
+            # Reported in kilobytes on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def as_dict(self):
+        return {
+            'timings': dict(self.timings),
+            'counters': dict(self.counters),
+            'peak_rss': self.peak_rss,
+        }
+
+    def report(self, event='export', **kwargs):
+        """Writes the metrics to the log and/or the `avocado.events` Log
+        table depending on the `METRICS_LOGGING` and `METRICS_EVENTS`
+        settings.
+        """
+        data = self.as_dict()
+
+        if settings.METRICS_LOGGING:
+            log.info(u'{0} metrics: {1}'.format(event, data))
+
+        if settings.METRICS_EVENTS:
+            from avocado.events import usage
+            usage.log(event, data=data, **kwargs)
+
+        return data
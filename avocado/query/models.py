@@ -1,7 +1,7 @@
 import jsonfield
 from django.db import models
 from modeltree.tree import trees
-from . import oldparsers as parsers
+from . import oldparsers as parsers, cache, optimizer
 
 
 def _sql_string(queryset):
@@ -70,15 +70,40 @@ class AbstractDataContext(models.Model):
         "Validate `attrs` as a context."
         return parsers.datacontext.validate(attrs, **context)
 
-    def parse(self, tree=None, **context):
-        "Returns a parsed node for this context."
-        return parsers.datacontext.parse(self.json, tree=tree, **context)
+    def parse(self, tree=None, metadata=None, **context):
+        """Returns a parsed node for this context. Parsed nodes are shared
+        by contexts with the same conditions as long as the fields they
+        reference are not changed.
+
+        The `metadata` already resolved for this context may be passed to
+        avoid resolving it again.
+        """
+        if metadata is None:
+            metadata = parsers.datacontext.get_metadata(
+                self.json, user=context.get('user'))
+
+        key = cache.context_key(self.json, tree=tree, metadata=metadata,
+                                **context)
+
+        if key is not None:
+            node = cache.parsed_contexts.get(key)
+
+            if node is None:
+                node = parsers.datacontext.parse(self.json, tree=tree,
+                                                 metadata=metadata, **context)
+                cache.parsed_contexts.set(key, node)
+
+            return node
+
+        return parsers.datacontext.parse(self.json, tree=tree,
+                                         metadata=metadata, **context)
 
     def apply(self, queryset=None, tree=None, distinct=False, **context):
         "Applies this context to a QuerySet."
         if tree is None and queryset is not None:
             tree = queryset.model
-        return self.parse(tree=tree, **context).apply(queryset=queryset, distinct=False)
+        node = optimizer.optimize(self.parse(tree=tree, **context))
+        return node.apply(queryset=queryset, distinct=False)
 
     def language(self, tree=None, **context):
         return self.parse(tree=tree, **context).language
@@ -1,6 +1,12 @@
+import json
+import logging
+from copy import deepcopy
+from operator import or_
 from warnings import warn
 from django.db import models
+from avocado.conf import settings
 from avocado.core import utils
+from avocado.query import cache, expressions, operators
 from modeltree.tree import trees
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
@@ -11,6 +17,8 @@ from django.db.models import Model
 from django.db.models.fields.related import ForeignKey
 from django.db.models.sql.constants import JoinInfo
 
+log = logging.getLogger(__name__)
+
 AND = 'AND'
 OR = 'OR'
 BRANCH_KEYS = ('children', 'type')
@@ -44,17 +52,370 @@ def is_composite(obj):
     if has_keys(obj, keys=COMPOSITE_KEYS):
         return True
 
+
+def _field_lookup(key):
+    "Returns a hashable lookup for a field key."
+    return tuple(sorted(utils.parse_field_key(key).items()))
+
+
+def _collect_keys(attrs, field_keys, concept_keys, composite_keys):
+    """Collects the field and concept keys of the conditions and the ids of
+    the composite contexts in the tree. Field keys are paired with the
+    concept of the condition, if any, since the field is looked up among
+    the fields of the concept.
+    """
+    if not attrs or type(attrs) is not dict:
+        return
+
+    if is_composite(attrs):
+        composite_keys.add(attrs['composite'])
+    elif is_condition(attrs):
+        field_key = attrs.get('field') or attrs.get('id')
+
+        if field_key is not None:
+            field_keys.add((attrs.get('concept'), _field_lookup(field_key)))
+
+        if attrs.get('concept') is not None:
+            concept_keys.add(attrs['concept'])
+    elif is_branch(attrs):
+        for child in attrs['children']:
+            _collect_keys(child, field_keys, concept_keys, composite_keys)
+
+
+def _composite_keys(attrs):
+    "Returns the ids of the contexts referenced by the tree."
+    composite_keys = set()
+    _collect_keys(attrs, set(), set(), composite_keys)
+    return composite_keys
+
+
+class Metadata(object):
+    """Fields, concepts and composite contexts referenced by a context tree.
+    They are resolved with a few bulk queries and shared by all nodes of
+    the tree. Keys that do not resolve to exactly one object are left out
+    so the nodes fall back to their own lookups, which raise the usual
+    errors.
+
+    Composite contexts are fetched breadth-first, one query per level of
+    references. The contexts reachable from each composite are cached per
+    process and reused as long as none of them has been modified.
+    """
+    def __init__(self, attrs=None, user=None):
+        self.user = user
+        self.fields = {}
+        self.concepts = {}
+        self.contexts = {}
+
+        # Ids of the composite contexts being expanded, used to detect
+        # contexts that reference themselves.
+        self.expanding = []
+
+        # Translations shared by conditions with the same field, operator
+        # and value and the number of translations performed.
+        self.translations = {}
+        self.translation_count = 0
+
+        # Text of the primary keys described in the language of conditions
+        # on primary key fields and the keys yet to be described, keyed by
+        # the natural key of the field.
+        self.pk_texts = {}
+        self.shown_pks = {}
+
+        if attrs:
+            self.resolve(attrs)
+
+    def _contexts(self, ids):
+        from avocado.models import DataContext
+
+        queryset = DataContext.objects.filter(pk__in=ids)
+
+        if self.user is not None:
+            queryset = queryset.filter(user=self.user)
+
+        return queryset
+
+    def _reachable(self, pk):
+        "Returns the ids of the fetched contexts reachable from `pk`."
+        seen = set()
+        pending = [pk]
+
+        while pending:
+            pk = pending.pop()
+
+            if pk in seen or pk not in self.contexts:
+                continue
+
+            seen.add(pk)
+            pending.extend(_composite_keys(self.contexts[pk].json))
+
+        return seen
+
+    def has_cycle(self, pk):
+        "Returns true if the contexts reachable from `pk` form a cycle."
+        visiting = set()
+        visited = set()
+
+        def visit(pk):
+            if pk in visited or pk not in self.contexts:
+                return False
+            if pk in visiting:
+                return True
+
+            visiting.add(pk)
+
+            for reference in _composite_keys(self.contexts[pk].json):
+                if visit(reference):
+                    return True
+
+            visiting.remove(pk)
+            visited.add(pk)
+            return False
+
+        return visit(pk)
+
+    def resolve_composites(self, ids):
+        "Fetches the composite contexts `ids` and the contexts they reference."
+        from avocado.query import cache
+
+        user_key = getattr(self.user, 'pk', self.user)
+        pending = [pk for pk in ids if pk not in self.contexts]
+
+        # Reuse the cached graphs for which none of the contexts changed
+        graphs = []
+        for pk in pending:
+            graph = cache.composite_graphs.get((pk, user_key))
+            if graph is not None:
+                graphs.append((pk, graph))
+
+        if graphs:
+            versions = set()
+            for pk, graph in graphs:
+                versions.update(graph)
+
+            modified = dict(self._contexts(versions)
+                            .values_list('pk', 'modified'))
+
+            for pk, graph in graphs:
+                if all(modified.get(k) == c.modified
+                       for k, c in graph.items()):
+                    self.contexts.update(graph)
+                    pending.remove(pk)
+
+        fetched = set(pending)
+        level = pending
+
+        while level:
+            references = set()
+
+            for cxt in self._contexts(level):
+                self.contexts[cxt.pk] = cxt
+                references.update(_composite_keys(cxt.json))
+
+            level = [pk for pk in references
+                     if pk not in self.contexts and pk not in fetched]
+            fetched.update(level)
+
+        for pk in pending:
+            if pk in self.contexts:
+                graph = dict((k, self.contexts[k])
+                             for k in self._reachable(pk))
+                cache.composite_graphs.set((pk, user_key), graph)
+
+    def resolve(self, attrs):
+        from avocado.models import DataField, DataConcept, DataConceptField
+
+        field_keys = set()
+        concept_keys = set()
+        composite_keys = set()
+        _collect_keys(attrs, field_keys, concept_keys, composite_keys)
+
+        if composite_keys:
+            self.resolve_composites(composite_keys)
+
+            # The conditions of the referenced contexts are resolved along
+            # with the conditions of the tree
+            for pk in composite_keys:
+                for k in self._reachable(pk):
+                    _collect_keys(self.contexts[k].json, field_keys,
+                                  concept_keys, set())
+
+        lookups = [k for k in field_keys if k not in self.fields]
+
+        if lookups:
+            query = reduce(or_, [Q(**dict(lookup))
+                                 for concept, lookup in lookups])
+            fields = list(DataField.objects.filter(query))
+
+            # Fields of conditions with a concept must belong to the concept
+            concepts = set(c for c, lookup in lookups if c is not None)
+            members = set()
+
+            if concepts and fields:
+                members = set(DataConceptField.objects.filter(
+                    concept__in=concepts, field__in=fields)
+                    .values_list('concept', 'field'))
+
+            matches = dict((k, []) for k in lookups)
+
+            for field in fields:
+                for concept, lookup in lookups:
+                    if concept is not None and \
+                            (int(concept), field.pk) not in members:
+                        continue
+
+                    for key, value in lookup:
+                        if key == 'pk':
+                            if field.pk != value:
+                                break
+                        elif getattr(field, key) != value:
+                            break
+                    else:
+                        matches[(concept, lookup)].append(field)
+
+            for lookup, fields in matches.items():
+                if len(fields) == 1:
+                    self.fields[lookup] = fields[0]
+
+        concept_keys = [k for k in concept_keys if k not in self.concepts]
+
+        if concept_keys:
+            self.concepts.update(
+                DataConcept.objects.in_bulk(concept_keys))
+
+    def context(self, pk):
+        "Returns the composite context `pk`."
+        from avocado.models import DataContext
+
+        if pk not in self.contexts:
+            self.resolve_composites([pk])
+
+        if pk not in self.contexts:
+            raise DataContext.DoesNotExist(
+                u'DataContext "{0}" does not exist.'.format(pk))
+
+        return self.contexts[pk]
+
+    def field(self, key, concept=None):
+        "Returns the field `key`, among the fields of `concept` if given."
+        if key is None:
+            return
+        return self.fields.get((concept, _field_lookup(key)))
+
+    def concept(self, key):
+        return self.concepts.get(key)
+
+    def collect_pks(self, attrs):
+        """Collects the primary keys shown in the language of the conditions
+        on primary key fields in the tree, so the keys of all conditions on a
+        field are described at once.
+        """
+        if not attrs or type(attrs) is not dict:
+            return
+
+        if is_composite(attrs):
+            pk = attrs['composite']
+
+            if pk in self.contexts and pk not in self.expanding:
+                self.expanding.append(pk)
+                try:
+                    self.collect_pks(self.contexts[pk].json)
+                finally:
+                    self.expanding.pop()
+
+        elif is_condition(attrs):
+            field = self.field(attrs.get('field', attrs.get('id')),
+                               attrs.get('concept'))
+            value = attrs.get('value')
+
+            if field is None or value is None or \
+                    not isinstance(field.field, models.AutoField):
+                return
+
+            operator = operators.registry.get(attrs.get('operator'))
+
+            if isinstance(value, (list, tuple)):
+                if not hasattr(operator, 'shown'):
+                    return
+                value = operator.shown(value)
+            else:
+                value = [value]
+
+            pks = self.shown_pks.setdefault(field.natural_key(), set())
+
+            for x in value:
+                try:
+                    pks.add(field.field.to_python(getattr(x, 'pk', x)))
+                except (ValidationError, TypeError):
+                    pass
+
+        elif is_branch(attrs):
+            for child in attrs['children']:
+                self.collect_pks(child)
+
+    def describe_pks(self, translator, field, pks):
+        """Returns the text of the primary keys of the field. The keys shown
+        by the other conditions on the field are described along with the
+        first keys requested.
+        """
+        key = field.natural_key()
+        texts = self.pk_texts.setdefault(key, {})
+        missing = set(pks).difference(texts)
+
+        if missing:
+            missing.update(self.shown_pks.pop(key, ()))
+            missing.difference_update(texts)
+            texts.update(translator._describe_pks(field, list(missing)))
+
+        return texts
+
+    def translate(self, node):
+        "Returns the translation for the condition node."
+        key = (node.field.pk, json.dumps([node.operator, node.value],
+                                         sort_keys=True, default=unicode))
+
+        if key not in self.translations:
+            self.translations[key] = node.translate()
+            self.translation_count += 1
+
+        return self.translations[key]
+
+
+def _merge_models(*lists):
+    "Returns the models of the conditions without duplicates."
+    models = []
+    for model in [m for l in lists for m in l]:
+        if model not in models:
+            models.append(model)
+    return models
+
+
+def _set_query(condition, query_key, expr):
+    condition[expressions.EXPRESSION_KEYS[query_key]] = expr
+    condition[query_key] = expr.render()
+
+
+def _copy_query(condition, query_key, q):
+    expr_key = expressions.EXPRESSION_KEYS[query_key]
+    condition[query_key] = q[query_key]
+    if expr_key in q:
+        condition[expr_key] = q[expr_key]
+
+
 def or_queries(q1, q2):
     if isinstance(q1, dict) and isinstance(q2, dict):
-        condition = {'models':q1['models'] + q2['models']}
+        condition = {'models': _merge_models(q1['models'], q2['models'])}
 
         for query_key in ['query', 'matrix_query']:
             if query_key in q1 and query_key in q2:
-                condition[query_key] =  '(' + q1[query_key] + ' OR ' + q2[query_key] + ')'
+                expr = expressions.Or([
+                    expressions.from_condition(q1, query_key),
+                    expressions.from_condition(q2, query_key),
+                ])
+                _set_query(condition, query_key, expressions.simplify(expr))
             elif query_key in q1:
-                condition[query_key] =  q1[query_key]
+                _copy_query(condition, query_key, q1)
             elif query_key in q2:
-                condition[query_key] =  q2[query_key]
+                _copy_query(condition, query_key, q2)
 
         return condition
     else:
@@ -62,20 +423,25 @@ def or_queries(q1, q2):
 
 def and_queries(q1, q2):
     if isinstance(q1, dict) and isinstance(q2, dict):
-        condition = {'models':q1['models'] + q2['models'], 'is_sample_query':False}
+        condition = {'models': _merge_models(q1['models'], q2['models']),
+                     'is_sample_query': False}
         condition['sub_queries'] = q1.get('sub_queries', []) + q2.get('sub_queries', [])
 
         for query_key in ['query', 'matrix_query']:
             if query_key in q1 and query_key in q2:
-                condition[query_key] =  '(' + q1[query_key] + ' AND ' + q2[query_key] + ')'
+                expr = expressions.And([
+                    expressions.from_condition(q1, query_key),
+                    expressions.from_condition(q2, query_key),
+                ])
+                _set_query(condition, query_key, expressions.simplify(expr))
 
                 # queries on sample id will become subqueries
                 if q1.get('is_sample_query') or q2.get('is_sample_query'):
                     condition['sub_queries'].append(condition[query_key])
             elif query_key in q1:
-                condition[query_key] =  q1[query_key]
+                _copy_query(condition, query_key, q1)
             elif query_key in q2:
-                condition[query_key] =  q2[query_key]
+                _copy_query(condition, query_key, q2)
 
         return condition
     else:
@@ -87,7 +453,9 @@ def negate_query(q):
 
         for query_key in ['query', 'matrix_query']:
             if query_key in q:
-                condition[query_key] = 'NOT (' + q[query_key] + ')'
+                expr = expressions.Not(
+                    expressions.from_condition(q, query_key))
+                _set_query(condition, query_key, expressions.simplify(expr))
 
         return condition
     else:
@@ -120,16 +488,46 @@ def get_primary_key(model):
 
     return '_id'
 
+# Foreign key graphs of the model classes keyed by the class
+_foreign_key_graphs = {}
+
+def get_foreign_key_graph(model):
+    """Returns the `(table, primary key, field name)` of the parent model of
+    each foreign key of `model`. The graph is derived once per model class.
+    """
+    if model not in _foreign_key_graphs:
+        graph = []
+        for fkey in get_foreign_keys(model):
+            parent = fkey['parent_model']
+            graph.append((parent._meta.db_table, get_primary_key(parent),
+                          fkey['field'].name))
+        _foreign_key_graphs[model] = graph
+    return _foreign_key_graphs[model]
+
 class Node(object):
     condition = None
     annotations = None
     extra = None
     language = None
 
+    # Metadata shared by the nodes of a parsed tree
+    _metadata = None
+
+    # Strategy of the sample clauses of custom conditions applied by this
+    # node, see `get_sample_clause`
+    sample_strategy = None
+
     def __init__(self, tree=None, **context):
         self.tree = tree
         self.context = context
 
+    @property
+    def translation_count(self):
+        "Number of conditions translated so far in the tree of this node."
+        if self._metadata is None:
+            return 0
+        return self._metadata.translation_count
+
     def get_primary_table(self):
         if isinstance(self.tree, basestring):
             return self.tree
@@ -140,25 +538,33 @@ class Node(object):
         primary_table = self.get_primary_table()
         matrix_table = primary_table + '_matrix'
 
+        # The query is only compiled once, the joins are derived from the
+        # tables it references
+        sql = str(queryset.query)
+        referenced = {}
+
+        def in_query(table):
+            if table not in referenced:
+                referenced[table] = table in sql
+            return referenced[table]
+
         tables = []
+        added = set()
         joins = []
-        model_names = [model.__name__ for model in self.condition['models']]
+        model_names = set(model.__name__ for model in self.condition['models'])
         for model in self.condition['models']:
             model_class = model
             table = model_class._meta.db_table
-            if table not in tables and not model==primary_table and table in str(queryset.query) and not table==matrix_table:
+            if table not in added and not model==primary_table and in_query(table) and not table==matrix_table:
 
+                added.add(table)
                 tables.append(table)
-                
-                primary_key  = get_primary_key(model_class)
-                foreign_keys = get_foreign_keys(model_class)
-                for fkey in foreign_keys:
-                    foreign = fkey['parent_model']._meta.db_table
 
+                for foreign, foreign_key, field_name in get_foreign_key_graph(model_class):
                     # if foreign key joins to an included model
-                    if (foreign in model_names or foreign==primary_table) and not foreign==model and foreign in str(queryset.query):
-                        where = foreign + '.' + get_primary_key(fkey['parent_model']) + ' = ' + table + '.' + fkey['field'].name
-                        joins.append(where)     
+                    if (foreign in model_names or foreign==primary_table) and not foreign==model and in_query(foreign):
+                        where = foreign + '.' + foreign_key + ' = ' + table + '.' + field_name
+                        joins.append(where)
 
         queryset = queryset.extra(tables=tables)
         queryset = queryset.extra(where=joins)
@@ -166,6 +572,70 @@ class Node(object):
         return queryset
         
 
+    def get_sample_clause(self, sub_queries, strategy=None):
+        """Returns the clause restricting the primary table to the rows that
+        have matching rows in the matrix table for each of the sample
+        `sub_queries`.
+
+        The `strategy` defaults to the `sample_strategy` of the node or else
+        to the `SAMPLE_QUERY_STRATEGY` setting:
+
+        - `correlated` compares the primary key to a correlated subquery for
+        each sub-query
+        - `exists` uses a correlated `EXISTS` for each sub-query which can be
+        planned as a semi-join
+        - `grouped` scans the matrix table once for all sub-queries and
+        matches the primary key against the grouped set of keys having a
+        match for each of them
+        """
+        if strategy is None:
+            strategy = self.sample_strategy or settings.SAMPLE_QUERY_STRATEGY
+
+        variant_table = self.get_primary_table()
+        matrix_table = variant_table + '_matrix'
+        variant_id = variant_table + '._id'
+        matrix_id = matrix_table + '._id'
+
+        # The same sample condition may be combined more than once
+        unique = []
+        for sub_query in sub_queries:
+            if sub_query not in unique:
+                unique.append(sub_query)
+
+        if strategy == 'grouped':
+            clause = variant_id + ' IN (SELECT ' + matrix_id + ' FROM ' + \
+                matrix_table + ' WHERE '
+
+            if len(unique) == 1:
+                return clause + unique[0] + ')'
+
+            having = ['count(CASE WHEN ' + sub_query + ' THEN 1 END) > 0'
+                      for sub_query in unique]
+
+            clause += ' OR '.join('(' + s + ')' for s in unique)
+            clause += ' GROUP BY ' + matrix_id
+            clause += ' HAVING ' + ' AND '.join(having) + ')'
+            return clause
+
+        clauses = []
+        for sub_query in unique:
+            if strategy == 'exists':
+                clause  = 'EXISTS (SELECT 1 FROM ' + matrix_table + ' '
+                clause += 'WHERE ' + sub_query + ' '
+                clause += 'AND ' + variant_id + ' = ' + matrix_id + ')'
+            elif strategy == 'correlated':
+                clause  = variant_id + ' = ('
+                clause += 'SELECT ' + matrix_id + ' FROM ' + matrix_table + ' '
+                clause += 'WHERE ' + sub_query + ' '
+                clause += 'AND ' + variant_id + ' = ' + matrix_id + ' '
+                clause += 'LIMIT 1)'
+            else:
+                raise ValueError('Unknown sample query strategy: {0}'
+                                 .format(strategy))
+            clauses.append(clause)
+
+        return ' AND '.join(clauses)
+
     def apply(self, queryset=None, distinct=True):
         if queryset is None:
             queryset = trees[self.tree].get_queryset()
@@ -175,19 +645,13 @@ class Node(object):
             if isinstance(self.condition, dict):
                 # construct matrix table subclause
                 where_clause = self.condition.get('query', '')
-                for sub_query in self.condition.get('sub_queries', []):
-                    variant_table  =  self.get_primary_table()
-                    matrix_table   = variant_table + '_matrix'
-
-                    matrix_clause  = variant_table + '._id = ('
-                    matrix_clause += 'SELECT ' + matrix_table + '._id FROM ' + matrix_table + ' ' 
-                    matrix_clause += 'WHERE ' + sub_query + ' '
-                    matrix_clause += 'AND ' + variant_table + '._id = ' + matrix_table + '._id '
-                    matrix_clause += 'LIMIT 1)'
+                sub_queries = self.condition.get('sub_queries', [])
+                if sub_queries:
+                    matrix_clause = self.get_sample_clause(sub_queries)
                     if where_clause:
                         where_clause = ' AND '.join([matrix_clause, where_clause])
                     else:
-                        where_clause = matrix_clause 
+                        where_clause = matrix_clause
 
                 queryset = queryset.extra(where=[where_clause])
                 queryset = self.add_joins(queryset)
@@ -200,6 +664,17 @@ class Node(object):
         return queryset
 
 
+class Empty(Node):
+    """Node for a context tree that can not match any row. The condition is
+    part of the query itself so it is kept when the view or other querysets
+    are applied on top.
+    """
+    def apply(self, queryset=None, distinct=True):
+        if queryset is None:
+            queryset = trees[self.tree].get_queryset()
+        return queryset.extra(where=['1 = 0'])
+
+
 class Condition(Node):
     "Contains information for a single query condition."
     def __init__(self, value, operator, id=None, field=None,
@@ -218,13 +693,19 @@ class Condition(Node):
 
         super(Condition, self).__init__(**context)
 
+    def translate(self):
+        return self.field.translate(operator=self.operator, value=self.value,
+                                    tree=self.tree, metadata=self._metadata,
+                                    **self.context)
+
     @property
     def _meta(self):
-        if not hasattr(self, '__meta'):
-            self.__meta = self.field.translate(operator=self.operator,
-                                               value=self.value,
-                                               tree=self.tree, **self.context)
-        return self.__meta
+        if not hasattr(self, '_translation'):
+            if self._metadata is not None:
+                self._translation = self._metadata.translate(self)
+            else:
+                self._translation = self.translate()
+        return self._translation
 
     @property
     def concept(self):
@@ -333,6 +814,29 @@ class Branch(Node):
 
 
 def validate(attrs, **context):
+    """Validates the context tree. The fields and concepts of all conditions
+    are resolved up front.
+
+    The conditions are cleaned once by their translation which also
+    annotates the language. The parsed tree of the validated context shares
+    these translations and is stored in the parse cache, so the context is
+    not validated again when it is applied.
+    """
+    metadata = get_metadata(attrs, user=context.get('user'))
+    metadata.collect_pks(attrs)
+
+    attrs = _validate(attrs, metadata, **context)
+
+    if attrs:
+        key = cache.context_key(attrs, metadata=metadata, **context)
+
+        if key is not None:
+            cache.parsed_contexts.set(key, _parse(attrs, metadata, **context))
+
+    return attrs
+
+
+def _validate(attrs, metadata, **context):
     if not attrs:
         return None
 
@@ -348,79 +852,83 @@ def validate(attrs, **context):
 
     if is_composite(attrs):
         from avocado.models import DataContext
+        pk = attrs['composite']
+
         try:
-            if 'user' in context:
-                cxt = DataContext.objects.get(id=attrs['composite'],
-                                              user=context['user'])
+            cxt = metadata.context(pk)
+
+            if metadata.has_cycle(pk):
+                enabled = False
+                errors.append(u'DataContext "{0}" references itself.'
+                              .format(pk))
             else:
-                cxt = DataContext.objects.get(id=attrs['composite'])
-            validate(cxt.json, **context)
-            if not attrs['language']: attrs['language'] = cxt.name
+                # The referenced tree is shared, validate a copy
+                _validate(deepcopy(cxt.json), metadata, **context)
+
+                if not attrs.get('language'):
+                    attrs['language'] = cxt.name
 
         except DataContext.DoesNotExist:
             enabled = False
-            print 'DataContext does not exit'
+            log.warning(u'DataContext "{0}" does not exist'.format(pk))
             errors.append(u'DataContext "{0}" does not exist.'
-                          .format(attrs['id']))
+                          .format(pk))
 
     elif is_condition(attrs):
         from avocado.models import DataField, DataConcept
         field_key = attrs.get('field', attrs.get('id'))
-        # Parse to get into a consistent format
-        field_key = utils.parse_field_key(field_key)
 
         try:
+            concept = None
+
             if 'concept' in attrs:
-                concept = DataConcept.objects.get(id=attrs['concept'])
-                field = DataField.objects.get(**field_key)
-            else:
-                field = DataField.objects.get(**field_key)
-            if not type(attrs['operator']) is list:
-                field.validate(operator=attrs['operator'], value=attrs['value'])
-            node = parse(attrs, **context)
+                concept = metadata.concept(attrs['concept'])
+                if concept is None:
+                    concept = DataConcept.objects.get(id=attrs['concept'])
+
+            field = metadata.field(field_key, attrs.get('concept'))
+            if field is None:
+                fields = concept.fields if concept else DataField.objects
+                field = fields.get(**utils.parse_field_key(field_key))
+
+            # Fields may extend the validation of the translator
+            if type(attrs['operator']) is not list:
+                field.validate(operator=attrs['operator'],
+                               value=attrs['value'])
+
+            # The translation validates and cleans the value
+            node = _parse(attrs, metadata, **context)
             attrs['language'] = node.language['language']
 
             value = node._meta['cleaned_data']['value']
             cleaned = None
 
-            if field.enumerable or field.simple_type == 'key':
-                value_labels = field.value_labels()
-
-                if isinstance(value, QuerySet):
-                    cleaned = [{
-                        'value': val.pk,
-                        'label': value_labels[val.pk]
-                    } for val in value]
-                elif isinstance(value, (list, tuple)):
-                    cleaned = []
-
-                    for val in value:
-                        if val in value_labels:
-                            label = value_labels[val]
-                        else:
-                            label = smart_unicode(val)
-
-                        cleaned.append({
-                            'value': val,
-                            'label': label
-                        })
+            # Querysets are not listed, their language only describes the
+            # count and the first keys
+            if (field.enumerable or field.simple_type == 'key') and \
+                    not isinstance(value, QuerySet):
+                # Only the labels of the values in the condition are fetched
+                if isinstance(value, (list, tuple)):
+                    values = list(value)
                 elif isinstance(value, models.Model):
-                    # Values represented by django models
-                    # have only one particular label.
-                    cleaned = {
-                        'value': value.pk,
-                        'label': value_labels[value.pk]
-                    }
+                    values = [value.pk]
                 else:
-                    # Handle single, non-model values.
-                    if value in value_labels:
-                        label = value_labels[value]
-                    else:
-                        label = smart_unicode(value)
+                    values = [value]
+
+                value_labels = field.get_labels(values)
 
+                if isinstance(value, (list, tuple)):
+                    cleaned = [{
+                        'value': val,
+                        'label': value_labels[val]
+                    } for val in values]
+                else:
+                    # Values represented by django models have only one
+                    # particular label, single non-model values are handled
+                    # the same way.
                     cleaned = {
-                        'value': value,
-                        'label': label,
+                        'value': values[0],
+                        'label': value_labels[values[0]],
                     }
 
             if cleaned:
@@ -428,7 +936,7 @@ def validate(attrs, **context):
 
         except ObjectDoesNotExist:
             enabled = False
-            print 'Field does not exist'
+            log.warning(u'Field "{0}" does not exist'.format(field_key))
             errors.append('Field does not exist')
             raise
 
@@ -436,7 +944,8 @@ def validate(attrs, **context):
         if attrs['type'] not in LOGICAL_OPERATORS:
             enabled = False
         else:
-            map(lambda x: validate(x, **context), attrs['children'])
+            map(lambda x: _validate(x, metadata, **context),
+                attrs['children'])
     else:
         enabled = False
         errors.append('Unknown node type')
@@ -454,26 +963,56 @@ def validate(attrs, **context):
     return attrs
 
 
-def parse(attrs, **context):
+def get_metadata(attrs, user=None):
+    "Returns the metadata resolved for the context tree."
+    if attrs and type(attrs) is dict:
+        return Metadata(attrs, user=user)
+    return Metadata(user=user)
+
+
+def parse(attrs, metadata=None, **context):
+    """Returns the parsed node for the context tree. The fields of all
+    conditions are resolved up front unless the `metadata` of the tree is
+    passed.
+    """
+    if metadata is None:
+        metadata = get_metadata(attrs, user=context.get('user'))
+
+    return _parse(attrs, metadata, **context)
+
 
+def _parse(attrs, metadata, **context):
     if not attrs or attrs.get('enabled') is False:
         node = Node(**context)
     elif is_composite(attrs):
-        from avocado.models import DataContext
-        if 'user' in context:
-            cxt = DataContext.objects.get(id=attrs['composite'],
-                                          user=context['user'])
-        else:
-            cxt = DataContext.objects.get(id=attrs['composite'])
+        pk = attrs['composite']
+        cxt = metadata.context(pk)
+
+        if pk in metadata.expanding:
+            raise ValidationError(u'DataContext "{0}" references itself.'
+                                  .format(pk))
 
-        return parse(cxt.json, **context)
+        metadata.expanding.append(pk)
+        try:
+            return _parse(cxt.json, metadata, **context)
+        finally:
+            metadata.expanding.pop()
     elif is_condition(attrs):
         node = Condition(operator=attrs['operator'], value=attrs['value'],
                          id=attrs.get('id'), field=attrs.get('field'),
-                         **context)
+                         concept=attrs.get('concept'), **context)
+
+        field = metadata.field(node.field_key, node.concept_key)
+        if field is not None:
+            node._field = field
+
+        concept = metadata.concept(node.concept_key)
+        if concept is not None:
+            node._concept = concept
     else:
         node = Branch(type=attrs['type'], **context)
-        node.children = map(lambda x: parse(x, **context), attrs['children'])
+        node.children = map(lambda x: _parse(x, metadata, **context),
+                            attrs['children'])
 
-    
+    node._metadata = metadata
     return node
@@ -5,17 +5,41 @@ except ImportError:
     from ordereddict import OrderedDict
 from modeltree.tree import trees
 from modeltree.query import ModelTreeQuerySet
+from avocado.conf import settings
+from avocado.query import cache
 
 
 SORT_DIRECTIONS = ('asc', 'desc')
 
 
+def _unique(ids):
+    "Returns the ids without duplicates in their original order."
+    seen = set()
+    unique = []
+    for pk in ids:
+        if pk not in seen:
+            seen.add(pk)
+            unique.append(pk)
+    return unique
+
+
 class Node(object):
     def __init__(self, facets=None, **context):
         self.facets = facets or []
         self.tree = context.pop('tree', None)
+        self._concept_fields_version = \
+            context.pop('concept_fields_version', None)
         self.context = context
 
+    @property
+    def concept_fields_version(self):
+        """The version of the concept fields map this node is planned with.
+        Unless passed in the parse context, it is read once per node.
+        """
+        if self._concept_fields_version is None:
+            self._concept_fields_version = cache.concept_fields_version()
+        return self._concept_fields_version
+
     @property
     def concept_ids(self):
         ids = []
@@ -56,36 +80,25 @@ class Node(object):
 
         from avocado.models import DataConcept
 
-        concepts = list(DataConcept.objects.filter(pk__in=ids))
-        concepts.sort(key=lambda o: ids.index(o.pk))
-        return concepts
+        concepts = DataConcept.objects.in_bulk(ids)
+        return [concepts[pk] for pk in _unique(ids) if pk in concepts]
 
     def _get_fields_for_concepts(self, ids):
-        "Returns an ordered list of fields for concept `ids`."
-        from avocado.models import DataConceptField
-
+        """Returns an ordered list of fields for concept `ids`. The fields
+        are read from the process-level map of concept fields.
+        """
         if not ids:
             return OrderedDict()
 
-        # Concept fields that are sorted by concept then order, but are not
-        # in the original order defined in `ids`
-        cfields = list(DataConceptField.objects.filter(concept__pk__in=ids)
-                       .select_related()
-                       .order_by('concept', 'order'))
+        fields = cache.get_concept_fields(ids, self.concept_fields_version)
 
-        # Order concept fields relative to `ids`
-        cfields.sort(key=lambda o: ids.index(o.concept.pk))
-
-        # Construct an ordered dict of fields by their concept
+        # Construct an ordered dict of fields by their concept relative to
+        # the order defined in `ids`
         groups = OrderedDict()
 
-        for cf in cfields:
-            pk = cf.concept.pk
-
-            if pk not in groups:
-                groups[pk] = []
-
-            groups[pk].append(cf.field)
+        for pk in _unique(ids):
+            if fields.get(pk):
+                groups[pk] = list(fields[pk])
 
         return groups
 
@@ -135,6 +148,38 @@ class Node(object):
 
         return order_by
 
+    def _get_plan(self, tree, distinct):
+        """Returns the model fields to select and the order by lookups of
+        this view for the tree. The select list depends on the models the
+        tree has built nodes for, so they are part of the key. Plans are
+        cached until a concept or its fields change.
+        """
+        key = None
+
+        if settings.VIEW_CACHE_SIZE:
+            key = cache.fingerprint('view', cache.canonical(self.facets),
+                                    cache._tree_key(self.tree), distinct,
+                                    sorted(cache._tree_key(model)
+                                           for model in tree._nodes),
+                                    self.concept_fields_version)
+            plan = cache.view_plans.get(key)
+
+            if plan is not None:
+                return plan
+
+        # Set model fields for `select()` method
+        select = [s for s in self._get_select(distinct) if s[1]]
+        if tree._nodes:
+            nodes = set(tree._nodes)
+            select = [s for s in select if s[0] in nodes]
+
+        plan = (select, self._get_order_by())
+
+        if key is not None:
+            cache.view_plans.set(key, plan)
+
+        return plan
+
     # Primary method for apply this view to a QuerySet
     def apply(self, queryset=None, include_pk=True):
         tree = trees[self.tree]
@@ -144,14 +189,10 @@ class Node(object):
         # Convert to a ModelTreeQuerySet for the `select()` method
         queryset = ModelTreeQuerySet(tree, query=queryset.query)
 
-        # Set model fields for `select()` method
-        select = [s for s in self._get_select(queryset.query.distinct) if s[1]]
-        if tree._nodes:
-            select = [s for s in select if s[0] in tree._nodes]
+        select, order_by = self._get_plan(tree, queryset.query.distinct)
         queryset = queryset.select(*select, include_pk=include_pk)
 
         # Set the order by on the QuerySet
-        order_by = self._get_order_by()
         if order_by:
             queryset = queryset.order_by(*order_by)
 
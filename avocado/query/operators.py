@@ -62,9 +62,29 @@ class ContainerTypeOperator(BaseOperator):
     def is_valid(self, value):
         return hasattr(value, '__iter__')
 
-    def text(self, value):
+    def shown(self, value, length=None):
+        """Returns the items of `value` that are shown in the text. The
+        `length` of the value may be passed for sequences that are sliced
+        rather than listed, such as querysets.
+        """
+        if length is None:
+            length = len(value)
+
+        if length > self.max_list_size + 1:
+            return list(value[:self.max_list_size]) + \
+                list(value[length - 1:length])
+
+        return list(value)
+
+    def text(self, value, length=None):
+        """Returns the text of the value. If `length` is passed, the value
+        only contains the items returned by `shown` for a value of that
+        length.
+        """
         value = map(self.coerce_to_unicode, value)
-        length = len(value)
+
+        if length is None:
+            length = len(value)
 
         if length == 1:
             if self.negated:
@@ -0,0 +1,368 @@
+"""Logical optimization of parsed context trees.
+
+The optimizer runs between parsing and translation. It rewrites the tree of
+a parsed context into an equivalent tree with fewer conditions:
+
+- duplicate children of a branch are dropped
+- duplicate values of `in` conditions are dropped
+- exact and `in` conditions on the same field that are OR'ed together are
+folded into a single `in` condition
+- bounds on the same numerical field that are AND'ed together are merged
+into a single `range` condition (or the tightest pair of bounds)
+
+Branches that can not match any row are replaced by an `Empty` node which
+applies as a single `1 = 0` condition instead of the branch's conditions. If
+the whole tree is empty, the query processor returns an empty queryset and
+does not execute any SQL.
+
+The parsed tree is not modified since parsed trees are shared across
+contexts, the optimized tree is built from copies of the nodes.
+"""
+import json
+from copy import copy
+from avocado.conf import settings
+from avocado.query.oldparsers.datacontext import Condition, Branch, Empty, \
+    AND
+
+# Lookups contributing a lower or upper bound on the value of a field
+LOWER_BOUNDS = {'gt': True, 'gte': False}
+UPPER_BOUNDS = {'lt': True, 'lte': False}
+
+# Lookups matching a set of values
+EQUALITY_LOOKUPS = ('exact', 'in')
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+
+def _is_literal(value):
+    return _is_number(value) or isinstance(value, basestring)
+
+
+def _values(node):
+    "Returns the list of values an exact or `in` condition matches."
+    if node.operator == 'in':
+        return list(node.value)
+    return [node.value]
+
+
+def _field_key(node):
+    """Returns the key identifying the field and concept of a condition if
+    it can be optimized, otherwise `None`. Conditions on fields with custom
+    translators are left as is since the translation may depend on the
+    operator.
+    """
+    field = getattr(node, '_field', None)
+
+    if field is None or field.translator or \
+            not isinstance(node.operator, basestring):
+        return None
+
+    return (field.pk, node.concept_key)
+
+
+def _node_key(node):
+    "Returns a key identifying equivalent nodes."
+    if isinstance(node, Condition):
+        try:
+            value = json.dumps(node.value, sort_keys=True)
+        except TypeError:
+            return ('node', id(node))
+
+        field = getattr(node, '_field', None)
+        field_key = field.pk if field is not None else repr(node.field_key)
+
+        return ('condition', field_key, node.concept_key,
+                repr(node.operator), value)
+
+    if isinstance(node, Branch):
+        return (node.type, tuple(_node_key(c) for c in node.children))
+
+    if isinstance(node, Empty):
+        return ('empty',)
+
+    if node.condition is None and not node.annotations and not node.extra:
+        return ('node',)
+
+    return ('node', id(node))
+
+
+def _condition(node, operator, value):
+    "Returns a copy of the condition with the operator and value."
+    new = copy(node)
+    new.operator = operator
+    new.value = value
+
+    # The copy is translated on its own
+    new.__dict__.pop('_translation', None)
+
+    return new
+
+
+def _branch(node, children):
+    "Returns a copy of the branch with the children."
+    if len(children) == 1:
+        return children[0]
+
+    new = copy(node)
+    new.children = children
+    new.__dict__.pop('_condition', None)
+    new.__dict__.pop('_annotations', None)
+
+    return new
+
+
+def _empty(node):
+    empty = Empty(tree=node.tree, **node.context)
+    empty._metadata = node._metadata
+    return empty
+
+
+def _unique(values):
+    unique = []
+    for value in values:
+        if value not in unique:
+            unique.append(value)
+    return unique
+
+
+def _optimize_condition(node):
+    if node.operator in ('in', '-in') and \
+            isinstance(node.value, (list, tuple)):
+        values = _unique(node.value)
+
+        if not values and node.operator == 'in':
+            return _empty(node)
+
+        if len(values) < len(node.value):
+            return _condition(node, node.operator, values)
+
+    return node
+
+
+def _fold_equality(conditions):
+    """Folds exact and `in` conditions on the same field into a single `in`
+    condition. Returns `None` if they can not be folded.
+    """
+    values = []
+
+    for node in conditions:
+        if node.operator not in EQUALITY_LOOKUPS:
+            return None
+
+        node_values = _values(node)
+
+        if not all(_is_literal(v) for v in node_values):
+            return None
+
+        values.extend(node_values)
+
+    return [_condition(conditions[0], 'in', _unique(values))]
+
+
+def _merge_bounds(conditions):
+    """Merges the bounds and exact matches on the same numerical field.
+    Returns the merged conditions, `Empty` if they can not be satisfied or
+    `None` if they can not be merged.
+    """
+    node = conditions[0]
+
+    if node._field.simple_type != 'number':
+        return None
+
+    lower = upper = None
+    equal = None
+
+    def tighten(lower, upper, bound):
+        "Returns the tighter lower and upper bounds given the new bound."
+        operator, value, strict = bound
+
+        if operator in LOWER_BOUNDS:
+            # A strict bound is tighter than an inclusive one
+            if lower is None or (value, strict) > lower[1:]:
+                lower = bound
+        elif upper is None or (value, not strict) < (upper[1], not upper[2]):
+            upper = bound
+
+        return lower, upper
+
+    for node in conditions:
+        operator, value = node.operator, node.value
+
+        if operator in EQUALITY_LOOKUPS:
+            values = _values(node)
+
+            if not all(_is_number(v) for v in values):
+                return None
+
+            if equal is None:
+                equal = _unique(values)
+            else:
+                equal = [v for v in equal if v in values]
+        elif operator == 'range':
+            if not isinstance(value, (list, tuple)) or len(value) != 2 or \
+                    not all(_is_number(v) for v in value):
+                return None
+
+            lower, upper = tighten(lower, upper, ('gte', value[0], False))
+            lower, upper = tighten(lower, upper, ('lte', value[1], False))
+        elif operator in LOWER_BOUNDS and _is_number(value):
+            lower, upper = tighten(lower, upper,
+                                   (operator, value, LOWER_BOUNDS[operator]))
+        elif operator in UPPER_BOUNDS and _is_number(value):
+            lower, upper = tighten(lower, upper,
+                                   (operator, value, UPPER_BOUNDS[operator]))
+        else:
+            return None
+
+    def in_bounds(value):
+        if lower is not None:
+            if value < lower[1] or (lower[2] and value == lower[1]):
+                return False
+        if upper is not None:
+            if value > upper[1] or (upper[2] and value == upper[1]):
+                return False
+        return True
+
+    first = conditions[0]
+
+    if equal is not None:
+        equal = [v for v in equal if in_bounds(v)]
+
+        if not equal:
+            return _empty(first)
+        if len(equal) == 1:
+            return [_condition(first, 'exact', equal[0])]
+        return [_condition(first, 'in', equal)]
+
+    if lower is not None and upper is not None:
+        if lower[1] > upper[1]:
+            return _empty(first)
+
+        if lower[1] == upper[1] and (lower[2] or upper[2]):
+            return _empty(first)
+
+        if not lower[2] and not upper[2]:
+            return [_condition(first, 'range', [lower[1], upper[1]])]
+
+    merged = []
+
+    if lower is not None:
+        operator = 'gt' if lower[2] else 'gte'
+        merged.append(_condition(first, operator, lower[1]))
+    if upper is not None:
+        operator = 'lt' if upper[2] else 'lte'
+        merged.append(_condition(first, operator, upper[1]))
+
+    return merged
+
+
+def _merge_conditions(branch, children):
+    """Merges the conditions on the same field among the children. Returns
+    the new children or `Empty` if the branch can not match any row.
+    """
+    groups = {}
+
+    for child in children:
+        if isinstance(child, Condition):
+            key = _field_key(child)
+            if key is not None:
+                groups.setdefault(key, []).append(child)
+
+    merged = {}
+
+    for key, conditions in groups.items():
+        if len(conditions) < 2:
+            continue
+
+        if branch.type == AND:
+            result = _merge_bounds(conditions)
+        else:
+            result = _fold_equality(conditions)
+
+        if isinstance(result, Empty):
+            return result
+
+        if result is not None:
+            merged[key] = result
+
+    if not merged:
+        return children
+
+    # The merged conditions take the place of the first condition on the
+    # field
+    optimized = []
+    seen = set()
+
+    for child in children:
+        key = _field_key(child) if isinstance(child, Condition) else None
+
+        if key in merged:
+            if key not in seen:
+                seen.add(key)
+                optimized.extend(merged[key])
+        else:
+            optimized.append(child)
+
+    return optimized
+
+
+def _optimize(node):
+    if isinstance(node, Condition):
+        return _optimize_condition(node)
+
+    if not isinstance(node, Branch):
+        return node
+
+    children = []
+    seen = set()
+    changed = False
+
+    for child in node.children:
+        optimized = _optimize(child)
+        changed = changed or optimized is not child
+
+        if isinstance(optimized, Empty):
+            # A single empty child empties an AND branch and is ignored by
+            # an OR branch
+            if node.type == AND:
+                return optimized
+            continue
+
+        key = _node_key(optimized)
+
+        if key in seen:
+            changed = True
+            continue
+
+        seen.add(key)
+        children.append(optimized)
+
+    if not children:
+        return _empty(node)
+
+    merged = _merge_conditions(node, children)
+
+    if isinstance(merged, Empty):
+        return merged
+
+    if not changed and merged is children and \
+            len(children) == len(node.children):
+        return node
+
+    return _branch(node, merged)
+
+
+def optimize(node):
+    """Returns the optimized tree of the parsed node. The result is kept on
+    the node so shared parsed trees are only optimized once.
+    """
+    if not settings.CONTEXT_OPTIMIZER_ENABLED:
+        return node
+
+    if '_optimized' not in node.__dict__:
+        node._optimized = _optimize(node)
+
+    return node._optimized
@@ -1,65 +1,971 @@
+import sys
+import multiprocessing
+from django.db import connections, models
+from django.db.models import Max, Min
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.datastructures import SortedDict
 from django.utils.importlib import import_module
 from modeltree.tree import trees
 from avocado.formatters import RawFormatter
 from avocado.conf import settings
+from avocado.query import cache, optimizer
+from avocado.query.oldparsers import datacontext
+from avocado.query.metrics import Metrics
+from Queue import Queue, Empty, Full
+from collections import deque
+from functools import partial
+from threading import Thread
 import gc
+import uuid
 
 QUERY_PROCESSOR_DEFAULT_ALIAS = 'default'
 
-def queryset_iterator(sql, params, cursor, chunksize=500000):
-    '''''
-    Perform SQL query in chunks without holding query in memory
-    '''
+class ChunkSizer(object):
+    """Sizes the chunks of rows fetched from the database to a memory budget.
+
+    The size of the rows is estimated from a sample of each fetched chunk and
+    the next chunk is sized so it fits in `budget` bytes. The first chunk
+    contains `initial` rows. If no budget is set, every chunk contains
+    `initial` rows.
+    """
+    sample_size = 100
+
+    def __init__(self, initial, budget=None, minimum=100, maximum=None,
+                 metrics=None):
+        if budget is None:
+            budget = settings.QUERY_CHUNK_MEMORY
+
+        self.size = initial
+        self.budget = budget
+        self.minimum = minimum
+        self.maximum = maximum
+        self.metrics = metrics
+
+    def row_size(self, rows):
+        "Estimates the average size in bytes of the rows."
+        step = max(1, len(rows) // self.sample_size)
+        sample = rows[::step]
+
+        total = 0
+        for row in sample:
+            total += sys.getsizeof(row)
+            for value in row:
+                total += sys.getsizeof(value)
+
+        return float(total) / len(sample)
+
+    def measure(self, rows):
+        """Records a fetched chunk and returns the number of rows to fetch
+        in the next chunk.
+        """
+        if not rows:
+            return self.size
+
+        row_size = self.row_size(rows)
+
+        if self.metrics is not None:
+            self.metrics.incr('chunks')
+            self.metrics.maximum('chunk_memory_peak',
+                                 int(row_size * len(rows)))
+
+        if self.budget:
+            size = max(self.minimum, int(self.budget / row_size))
+
+            if self.maximum:
+                size = min(size, self.maximum)
+
+            self.size = size
+
+        return self.size
+
+
+def queryset_iterator(sql, params, cursor, chunksize=None, metrics=None):
+    """Perform SQL query in chunks without holding query in memory. The
+    chunks are sized by a `ChunkSizer` unless a fixed `chunksize` is given.
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    if chunksize:
+        sizer = ChunkSizer(chunksize, budget=0, metrics=metrics)
+    else:
+        sizer = ChunkSizer(settings.QUERY_CHUNK_INITIAL, metrics=metrics)
 
-    # get the first chunk
     sql = sql.rstrip(';')
-    chunked_sql = sql + ' LIMIT ' + str(chunksize)
-    cursor.execute(chunked_sql, params)    
-    rows = cursor.fetchall()
+    offset = 0
+
+    while True:
+        size = sizer.size
+        chunked_sql = sql + ' LIMIT ' + str(size)
+
+        if offset:
+            chunked_sql += ' OFFSET ' + str(offset)
+
+        with metrics.stage('execute'):
+            cursor.execute(chunked_sql, params)
+        with metrics.stage('fetch'):
+            rows = cursor.fetchall()
+        metrics.incr('rows_fetched', len(rows))
+
+        sizer.measure(rows)
+        offset += len(rows)
 
-    chunk_count = 0
-    while rows:
         for row in rows:
             yield row
 
-        # get the next chunk
-        chunk_count += 1
-        offset = chunk_count*chunksize
-        chunked_sql = sql + ' LIMIT ' + str(chunksize) + ' OFFSET ' + str(offset)
-        cursor.execute(chunked_sql, params)
-        rows = cursor.fetchall()
+        if len(rows) < size:
+            break
 
+        # Release the chunk before the next one is fetched
+        del rows
         gc.collect()
 
+
+def streaming_iterator(sql, params, connection, itersize=None, metrics=None,
+                       withhold=None):
+    """Perform SQL query once through a named (server-side) cursor and fetch
+    the rows in batches as they are consumed. The first batch contains
+    `itersize` rows, subsequent batches are sized by a `ChunkSizer`.
+
+    A named cursor only lives until the end of the transaction it is
+    declared in, so the query is read within a managed transaction that is
+    ended once the rows have been consumed. A cursor declared `WITH HOLD`
+    survives commits, but the server materializes the remaining result when
+    the transaction commits, so it is only used when `withhold` is true.
+
+    The cursor is closed when the iterator is exhausted or when the consumer
+    stops early and the generator is closed.
+    """
+    if not itersize:
+        itersize = settings.QUERY_STREAM_ITERSIZE
+
+    if metrics is None:
+        metrics = Metrics()
+
+    sizer = ChunkSizer(itersize, metrics=metrics)
+
+    # Ensure the underlying connection has been established
+    connection.cursor()
+
+    # An enclosing managed transaction is not committed while the rows are
+    # read, so the cursor is declared within it.
+    managed = not withhold and not connection.is_managed()
+
+    if managed:
+        connection.enter_transaction_management()
+        connection.managed(True)
+
+    name = 'avocado_{0}'.format(uuid.uuid4().hex)
+    cursor = connection.connection.cursor(name=name, withhold=bool(withhold))
+    cursor.itersize = itersize
+
+    try:
+        with metrics.stage('execute'):
+            cursor.execute(sql, params)
+
+        while True:
+            with metrics.stage('fetch'):
+                rows = cursor.fetchmany(sizer.size)
+
+            if not rows:
+                break
+
+            metrics.incr('rows_fetched', len(rows))
+            sizer.measure(rows)
+
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+        if managed:
+            try:
+                connection.commit()
+            finally:
+                connection.leave_transaction_management()
+
+
+def supports_streaming(connection):
+    "Returns true if rows can be streamed from a server-side cursor."
+    return bool(settings.QUERY_STREAM_ITERSIZE) and \
+        connection.vendor == 'postgresql'
+
+
+def supports_copy(connection):
+    "Returns true if query results can be bulk copied as text."
+    return bool(settings.QUERY_COPY_CHUNKSIZE) and \
+        connection.vendor == 'postgresql'
+
+
+def _copy_column(alias, kind, null):
+    """Returns the SQL expression that renders the column `alias` as the
+    text of a formatted value. `kind` is one of `text`, `number` or
+    `boolean` and NULLs are rendered as `null`.
+    """
+    if kind == 'boolean':
+        return "CASE WHEN {0} THEN 'True' WHEN NOT {0} THEN 'False' " \
+               "ELSE '{1}' END".format(alias, null)
+
+    value = '{0}::text'.format(alias)
+
+    # Commas are replaced by semicolons in text values
+    if kind == 'text':
+        value = "replace({0}, ',', ';')".format(value)
+
+    return "coalesce({0}, '{1}')".format(value, null)
+
+
+def copy_iterator(sql, params, connection, columns, chunksize=None,
+                  metrics=None):
+    """Streams the result of the query through PostgreSQL's
+    `COPY ... TO STDOUT` as lines of tab-delimited text. `columns` is a
+    sequence of `(kind, null)` pairs describing how each of the leading
+    columns of the query is rendered (see `_copy_column`), the remaining
+    columns are not copied.
+
+    Each row is rendered as a single text value so the only escapes in the
+    output are those of COPY's text format, which are decoded. The COPY is
+    executed in a thread and the output is yielded in chunks of complete
+    lines of roughly `chunksize` bytes.
+    """
+    if not chunksize:
+        chunksize = settings.QUERY_COPY_CHUNKSIZE
+
+    if metrics is None:
+        metrics = Metrics()
+
+    # Ensure the underlying connection has been established
+    connection.cursor()
+    cursor = connection.connection.cursor()
+
+    aliases = ['_c{0}'.format(i) for i in xrange(len(columns))]
+    line = " || E'\\t' || ".join(_copy_column(alias, kind, null)
+                                 for alias, (kind, null)
+                                 in zip(aliases, columns))
+
+    copy_sql = 'COPY (SELECT {0} FROM ({1}) AS _copy ({2})) TO STDOUT'\
+        .format(line, sql.rstrip(';'), ', '.join(aliases))
+    copy_sql = cursor.mogrify(copy_sql, params)
+
+    queue = Queue(maxsize=16)
+    writer = _QueueWriter(queue)
+    done = object()
+    errors = []
+
+    def target():
+        try:
+            cursor.copy_expert(copy_sql, writer, size=chunksize)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            # The sentinel must be delivered even if the queue is full
+            while not writer.closed:
+                try:
+                    queue.put(done, timeout=1)
+                    break
+                except Full:
+                    pass
+
+    thread = Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+    # Incomplete line at the end of the last chunk
+    remainder = ''
+
+    try:
+        while True:
+            with metrics.stage('copy'):
+                try:
+                    data = queue.get(timeout=1)
+                except Empty:
+                    continue
+
+            if data is done:
+                break
+
+            data = remainder + data
+            end = data.rfind('\n') + 1
+            data, remainder = data[:end], data[end:]
+
+            if not data:
+                continue
+
+            # Escaped newlines within values are only decoded here, so the
+            # chunk contains a line per row.
+            metrics.incr('rows_fetched', data.count('\n'))
+            yield data.decode('string_escape')
+
+        if errors:
+            raise errors[0]
+    finally:
+        writer.closed = True
+        thread.join()
+        cursor.close()
+
+
+class _QueueWriter(object):
+    """File-like object that hands the written data to a bounded queue. Used
+    to pass data from a producer thread to a consumer.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.closed = False
+
+    def write(self, data):
+        # Block until the consumer catches up. Raising aborts the producer,
+        # e.g. a COPY, if the consumer has gone away.
+        while True:
+            if self.closed:
+                raise IOError('Consumer closed')
+            try:
+                self.queue.put(data, timeout=1)
+                return
+            except Full:
+                pass
+
+
+def supports_prefetch(connection):
+    """Returns true if rows can be fetched in a background thread while the
+    previous rows are formatted.
+
+    The rows are fetched through a dedicated connection which does not see
+    the changes of a transaction managed on `connection`, so they are not
+    prefetched within one.
+    """
+    return bool(settings.EXPORT_PIPELINE_DEPTH) and \
+        connection.vendor == 'postgresql' and not connection.is_managed()
+
+
+def dedicated_connection(using):
+    """Returns a new connection to the database `using` that is not shared
+    with the connection of the calling thread. It must be closed by the
+    caller.
+    """
+    settings_dict = dict(connections[using].settings_dict)
+    backend = import_module(settings_dict['ENGINE'] + '.base')
+    return backend.DatabaseWrapper(settings_dict, using)
+
+
+def detached_iterator(sql, params, using, metrics=None):
+    """Streams the result of the query through a dedicated connection to
+    the database `using`, see `streaming_iterator`. The connection is opened
+    when the first row is fetched, so the iterator can be consumed by
+    another thread while the connection of this thread is in use.
+    """
+    connection = dedicated_connection(using)
+
+    try:
+        for row in streaming_iterator(sql, params, connection,
+                                      metrics=metrics):
+            yield row
+    finally:
+        connection.close()
+
+
+def prefetch_iterator(iterable, depth=None, batch=None, metrics=None):
+    """Fetches the rows of `iterable` in a background thread while the
+    consumer processes the rows fetched so far. At most `depth` batches of
+    `batch` rows are buffered, the fetch thread blocks when the consumer
+    falls behind.
+
+    The iterable is consumed by the fetch thread, so it must not use the
+    database connection of the consumer, e.g. a `detached_iterator`.
+    """
+    if not depth:
+        depth = settings.EXPORT_PIPELINE_DEPTH
+
+    if not batch:
+        batch = settings.EXPORT_PIPELINE_BATCH
+
+    if metrics is None:
+        metrics = Metrics()
+
+    queue = Queue(maxsize=depth)
+    writer = _QueueWriter(queue)
+    done = object()
+    errors = []
+
+    iterator = iter(iterable)
+
+    def target():
+        rows = []
+
+        try:
+            for row in iterator:
+                rows.append(row)
+
+                if len(rows) >= batch:
+                    writer.write(rows)
+                    rows = []
+
+            if rows:
+                writer.write(rows)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            # Release the cursor of a generator that has not been exhausted
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+            while not writer.closed:
+                try:
+                    queue.put(done, timeout=1)
+                    break
+                except Full:
+                    pass
+
+    thread = Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            # Time spent here is time the consumer waits for the database
+            with metrics.stage('fetch_wait'):
+                try:
+                    rows = queue.get(timeout=1)
+                except Empty:
+                    continue
+
+            if rows is done:
+                break
+
+            for row in rows:
+                yield row
+
+        if errors:
+            raise errors[0]
+    finally:
+        writer.closed = True
+        thread.join()
+
+
+def _seek_clause(keys, values):
+    """Builds the WHERE clause that selects the rows strictly after `values`
+    relative to the ordering defined by `keys`, e.g. for two keys:
+
+        (a > %s) OR (a = %s AND b > %s)
+    """
+    clauses = []
+    params = []
+
+    for i, (column, descending) in enumerate(keys):
+        toks = []
+
+        for j in xrange(i):
+            toks.append('{0} = %s'.format(keys[j][0]))
+            params.append(values[j])
+
+        toks.append('{0} {1} %s'.format(column, descending and '<' or '>'))
+        params.append(values[i])
+
+        clauses.append('(' + ' AND '.join(toks) + ')')
+
+    return '(' + ' OR '.join(clauses) + ')', params
+
+
+def keyset_iterator(queryset, keys, chunksize=None, metrics=None):
+    """Perform the query in chunks by seeking past the last row of the
+    previous chunk rather than skipping rows with OFFSET.
+
+    `keys` is a list of `(column, descending)` pairs that define a total
+    ordering of the rows, typically the sort columns of the view followed
+    by the primary key of the root model as a tie-breaker. The key columns
+    are selected as extra columns and are stripped from the rows before they
+    are yielded, so the rows match those of the queryset itself.
+
+    The chunks are sized by a `ChunkSizer` unless a fixed `chunksize` is
+    given.
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    if chunksize:
+        sizer = ChunkSizer(chunksize, budget=0, metrics=metrics)
+    else:
+        sizer = ChunkSizer(settings.QUERY_CHUNK_INITIAL, metrics=metrics)
+
+    select = SortedDict()
+    order_by = list(queryset.query.order_by)
+
+    for i, (column, descending) in enumerate(keys):
+        alias = '_keyset_{0}'.format(i)
+        select[alias] = column
+        order_by.append((descending and '-' or '') + alias)
+
+    queryset = queryset.extra(select=select).order_by(*order_by)
+
+    # Values querysets only select the extra columns they were asked for
+    mask = queryset.query.extra_select_mask
+    if mask is not None:
+        queryset.query.set_extra_mask(set(mask) | set(select))
+
+    # The extra columns are selected ahead of the model columns in the order
+    # they were added, which includes the queryset's own extra columns.
+    aliases = queryset.query.extra_select.keys()
+    positions = [aliases.index(alias) for alias in select]
+    stripped = set(positions)
+
+    chunk = queryset
+
+    while True:
+        size = sizer.size
+        compiler = chunk[:size].query.get_compiler(queryset.db)
+
+        # The rows are fetched as the query is executed
+        with metrics.stage('fetch'):
+            rows = list(compiler.results_iter())
+
+        metrics.incr('rows_fetched', len(rows))
+        sizer.measure(rows)
+
+        for row in rows:
+            yield tuple(v for i, v in enumerate(row) if i not in stripped)
+
+        if len(rows) < size:
+            break
+
+        last = rows[-1]
+        where, params = _seek_clause(keys, [last[i] for i in positions])
+        chunk = queryset.extra(where=[where], params=params)
+
+
+_table_models = {}
+
+
+def _get_model_for_table(table):
+    "Returns the model class for a database table name."
+    if table not in _table_models:
+        _table_models.clear()
+        for model in models.get_models():
+            _table_models[model._meta.db_table] = model
+    return _table_models.get(table)
+
+
+def is_single_valued(queryset):
+    """Returns true if each row of the root model produces at most one row
+    in the queryset, that is all joins follow a foreign key to the primary
+    key of the joined table. Reverse and many-to-many joins can produce
+    multiple rows per root row which prevents seeking on the root key.
+    """
+    query = queryset.query
+
+    if query.extra_tables:
+        return False
+
+    for join in query.alias_map.values():
+        # Base table
+        if not join.lhs_alias:
+            continue
+
+        model = _get_model_for_table(join.table_name)
+
+        if model is None or join.rhs_join_col != model._meta.pk.column:
+            return False
+
+    return True
+
+
+# Connections inherited by worker processes are referenced here so they are
+# never finalized in the child, which would terminate the parent's session.
+_inherited_connections = []
+
+
+def close_inherited_connections():
+    """Discards the database connections inherited from the parent process so
+    a worker process opens its own. Used as the initializer of process pools.
+    """
+    for conn in connections.all():
+        # An in-memory SQLite database only exists within the connection that
+        # created it, so the worker keeps reading through its copy.
+        if conn.vendor == 'sqlite' and \
+                conn.settings_dict['NAME'] in ('', ':memory:'):
+            continue
+
+        if conn.connection is not None:
+            _inherited_connections.append(conn.connection)
+            conn.connection = None
+
+
+def _read_partition(args):
+    "Executes and formats a single primary key range in a worker process."
+    processor, klass, using, sql, params, kwargs = args
+
+    exporter = processor.get_exporter(klass)
+
+    # The metrics are merged into and reported by the parent's exporter
+    exporter.report_metrics = False
+
+    cursor = connections[using].cursor()
+
+    with exporter.metrics.stage('execute'):
+        cursor.execute(sql, params)
+
+    def rows():
+        while True:
+            with exporter.metrics.stage('fetch'):
+                chunk = cursor.fetchmany(settings.QUERY_CHUNK_INITIAL)
+            if not chunk:
+                break
+            exporter.metrics.incr('rows_fetched', len(chunk))
+            for row in chunk:
+                yield row
+
+    formatted = [list(row) for row in exporter.read(rows(), **kwargs)]
+
+    # Rows are counted as emitted once the parent yields them
+    exporter.metrics.counters.pop('rows_emitted', None)
+
+    if exporter.metrics.peak_rss is not None:
+        exporter.metrics.maximum('worker_peak_rss',
+                                 exporter.metrics.peak_rss)
+
+    return formatted, exporter.metrics
+
+
+class PartitionedIterable(object):
+    """Iterable of queries over consecutive primary key ranges of the root
+    model. `BaseExporter.read` hands itself to `read` which executes and
+    formats the ranges in a pool of worker processes and yields the
+    formatted rows in primary key order.
+
+    Ranges are submitted as the rows are consumed and at most `depth` ranges
+    are in flight. Each range is meant to produce the number of rows sized
+    by a `ChunkSizer`, or a fixed `chunksize`, so neither the workers nor
+    the consumer hold more than a few chunks of rows at a time.
+
+    Ranges span keys rather than rows, so the number of keys of the next
+    range is estimated from the rows per key of the last range that was
+    consumed. Gaps in the keys and multi-valued joins only affect the
+    estimate, which is allowed to grow by at most `growth` times per range.
+    """
+    growth = 8
+
+    def __init__(self, processor, queryset, bounds, processes=None,
+                 chunksize=None, depth=None):
+        self.processor = processor
+        self.queryset = queryset
+        self.using = queryset.db
+        self.lo, self.hi = bounds
+        self.processes = processes or settings.QUERY_PARTITION_PROCESSES \
+            or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.depth = depth or self.processes * 2
+        self.width = None
+
+    def ranges(self):
+        """Yields the number of keys, SQL and parameters of consecutive
+        primary key ranges. Each range spans the current `width` keys.
+        """
+        if self.lo is None:
+            return
+
+        start = self.lo
+
+        while start <= self.hi:
+            width = self.width
+            stop = start + width
+            chunk = self.queryset.filter(pk__gte=start, pk__lt=stop)\
+                .order_by('pk')
+            compiler = chunk.query.get_compiler(self.using)
+            sql, params = compiler.as_sql()
+
+            if sql:
+                yield width, sql, params
+
+            start = stop
+
+    def estimate(self, sizer, width, count):
+        """Sets the width of the next ranges given the `count` of rows the
+        last range of `width` keys produced.
+        """
+        if count:
+            estimate = int(sizer.size * width / float(count))
+        else:
+            estimate = width * self.growth
+
+        self.width = max(1, min(estimate, width * self.growth))
+
+    def read(self, exporter, **kwargs):
+        if self.chunksize:
+            sizer = ChunkSizer(self.chunksize, budget=0,
+                               metrics=exporter.metrics)
+        else:
+            sizer = ChunkSizer(settings.QUERY_CHUNK_INITIAL,
+                               metrics=exporter.metrics)
+
+        self.width = sizer.size
+
+        ranges = self.ranges()
+        pending = deque()
+        pool = None
+
+        # A single process reads the ranges itself
+        if self.processes > 1:
+            pool = multiprocessing.Pool(
+                self.processes, initializer=close_inherited_connections)
+
+        try:
+            while True:
+                # Keep the workers busy while the oldest range is consumed
+                while len(pending) < self.depth:
+                    try:
+                        width, sql, params = ranges.next()
+                    except StopIteration:
+                        break
+
+                    task = (self.processor, exporter.__class__, self.using,
+                            sql, params, kwargs)
+
+                    if pool is None:
+                        result = partial(_read_partition, task)
+                    else:
+                        result = pool.apply_async(_read_partition, [task]).get
+
+                    pending.append((width, result))
+
+                if not pending:
+                    break
+
+                width, result = pending.popleft()
+                rows, metrics = result()
+                exporter.metrics.merge(metrics)
+
+                sizer.measure(rows)
+                self.estimate(sizer, width, len(rows))
+
+                for row in rows:
+                    yield row
+
+                del rows
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+
+class QueryIterable(object):
+    """Iterable over the rows of a compiled query that also exposes the
+    query itself. Exporters can use it to push offsets and limits into the
+    query or to hand the query to the database directly, e.g. to bulk copy
+    the output, in which case the rows of this iterable are never fetched.
+    """
+    def __init__(self, iterable, queryset, sql, params):
+        self.iterable = iterable
+        self.queryset = queryset
+        self.sql = sql
+        self.params = params
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    @property
+    def connection(self):
+        return connections[self.queryset.db]
+
+    @property
+    def columns(self):
+        "Number of columns selected by the query."
+        compiler = self.queryset.query.get_compiler(self.queryset.db)
+        return len(compiler.get_columns())
+
+    def is_distinct(self, length):
+        """Returns true if the first `length` columns of the rows are
+        guaranteed to be distinct by the query itself.
+        """
+        return self.queryset.query.distinct and self.columns == length
+
+    def slice(self, offset=None, limit=None):
+        """Returns a new iterable with the offset and limit applied to the
+        query. The rows of this iterable are never fetched.
+        """
+        queryset = self.queryset
+        query = queryset.query
+
+        # Rows must be in a stable order across slices. The primary key is
+        # the tie-breaker of the explicit or the model's default ordering.
+        order_by = list(query.order_by)
+
+        if not order_by and query.default_ordering:
+            order_by = list(query.get_meta().ordering)
+
+        if query.distinct and query.select:
+            # Ordering by the primary key would add it to the distinct
+            # columns. The selected columns are unique together, so they
+            # break the ties instead.
+            ties = ['{0}.{1}'.format(*col) for col in query.select
+                    if isinstance(col, (list, tuple))]
+        else:
+            ties = ['pk']
+
+        ties = [t for t in ties if t not in order_by and
+                '-{0}'.format(t) not in order_by]
+
+        if ties:
+            queryset = queryset.order_by(*(order_by + ties))
+
+        offset = offset or 0
+
+        if limit is not None:
+            queryset = queryset[offset:offset + limit]
+        elif offset:
+            queryset = queryset[offset:]
+
+        compiler = queryset.query.get_compiler(queryset.db)
+        sql, params = compiler.as_sql()
+
+        if not sql:
+            return QueryIterable(iter([]), queryset, sql, params)
+
+        return QueryIterable(compiler.results_iter(), queryset, sql, params)
+
+
 class QueryProcessor(object):
     """Prepares and builds a QuerySet for export.
 
     Overriding or extending these methods enable customizing the behavior
     pre/post-construction of the query.
     """
-    def __init__(self, context=None, view=None, tree=None, include_pk=True):
+    # Prefix of the tables whose unbounded queries are read in chunks
+    chunked_tables = 'p_'
+
+    def __init__(self, context=None, view=None, tree=None, include_pk=True,
+                 sample_strategy=None):
         self.context = context
         self.view = view
         self.tree = tree
         self.include_pk = include_pk
+        self.sample_strategy = sample_strategy
+        self.metrics = Metrics()
+
+    def get_metadata(self):
+        """Returns the metadata of the context. It is resolved once per
+        processor and shared by the cache key and the parsed context.
+        """
+        if not hasattr(self, '_metadata'):
+            self._metadata = None
+
+            if self.context:
+                self._metadata = datacontext.get_metadata(self.context.json)
+
+        return self._metadata
+
+    def get_concept_fields_version(self):
+        """Returns the version of the concept fields map the view is planned
+        with. It is read from the Django cache once per processor.
+        """
+        if not hasattr(self, '_concept_fields_version'):
+            self._concept_fields_version = cache.concept_fields_version()
+
+        return self._concept_fields_version
+
+    def get_cache_key(self):
+        """Returns the key of the compiled query for this processor in the
+        query cache or `None` if it cannot be cached. The key is computed
+        once per processor.
+        """
+        if not hasattr(self, '_cache_key'):
+            self._cache_key = None
+
+            if settings.QUERY_CACHE_SIZE:
+                context_json = self.context.json if self.context else None
+                view_json = self.view.json if self.view else None
+                self._cache_key = cache.fingerprint(
+                    self.__class__.__name__, self.tree, self.include_pk,
+                    self.sample_strategy, cache.canonical(context_json),
+                    view_json,
+                    cache.context_versions(context_json,
+                                           metadata=self.get_metadata()),
+                    cache.view_versions(view_json))
+
+        return self._cache_key
+
+    def compile(self, queryset):
+        """Returns the SQL and parameters of the queryset. The SQL is empty
+        if the queryset can not match any row.
+        """
+        with self.metrics.stage('compile'):
+            try:
+                return queryset.query.get_compiler(queryset.db).as_sql()
+            except EmptyResultSet:
+                return '', ()
 
     def get_queryset(self, queryset=None, **kwargs):
-        "Returns a queryset based on the context and view."
+        """Returns a queryset based on the context and view. If the optimized
+        context can not match any row an empty queryset is returned which is
+        counted and iterated over without executing any SQL.
+        """
+        key = None
+        empty = False
+
+        # Querysets passed in cannot be fingerprinted
+        if queryset is None:
+            key = self.get_cache_key()
+
+            if key is not None:
+                entry = cache.compiled_queries.get(key)
+
+                if entry is not None:
+                    return entry[0]._clone()
+
         if self.context:
-            queryset = self.context.apply(queryset=queryset, tree=self.tree)
+            tree = self.tree
+            if tree is None and queryset is not None:
+                tree = queryset.model
+
+            # Translation of the conditions happens lazily while the parsed
+            # node is applied.
+            with self.metrics.stage('parse'):
+                node = self.context.parse(tree=tree,
+                                          metadata=self.get_metadata())
+
+            with self.metrics.stage('optimize'):
+                node = optimizer.optimize(node)
+
+            empty = isinstance(node, datacontext.Empty)
+
+            # Sample clauses are rendered when the node is applied
+            if self.sample_strategy:
+                node.sample_strategy = self.sample_strategy
+
+            with self.metrics.stage('translate'):
+                count = node.translation_count
+                queryset = node.apply(queryset=queryset, distinct=False)
+
+            self.metrics.incr('translations', node.translation_count - count)
 
         if self.view:
-            queryset = self.view.apply(queryset=queryset, tree=self.tree,
-                                       include_pk=self.include_pk)
+            with self.metrics.stage('view'):
+                queryset = self.view.apply(
+                    queryset=queryset, tree=self.tree,
+                    include_pk=self.include_pk,
+                    concept_fields_version=self.get_concept_fields_version())
 
         if queryset is None:
             queryset = trees[self.tree].get_queryset()
-     
+
+        # The view is applied first since it would turn the empty queryset
+        # back into a regular one.
+        if empty:
+            queryset = queryset.none()
+
+        # Entries are shared by all processors and never modified, the SQL is
+        # compiled along with the queryset.
+        if key is not None:
+            if empty:
+                sql, params = '', ()
+            else:
+                sql, params = self.compile(queryset)
+
+            cache.compiled_queries.set(key, (queryset._clone(), sql, params))
+
         return queryset
 
     def get_exporter(self, klass, **kwargs):
         "Returns an exporter prepared for the queryset."
         exporter = klass(self.view)
+        exporter.metrics = self.metrics
 
         if self.include_pk:
             pk_name = trees[self.tree].root_model._meta.pk.name
@@ -67,11 +973,123 @@ class QueryProcessor(object):
 
         return exporter
 
+    def get_keyset(self, queryset):
+        """Returns the `(column, descending)` pairs that can be used to seek
+        through the queryset or `None` if the ordering does not allow it.
+
+        The sort columns of the view are used as leading keys with the
+        primary key of the root model as the tie-breaker. Seeking is only
+        possible if the sort columns are not nullable, belong to the root
+        model and each root row produces a single row in the output.
+        """
+        model = queryset.model
+        qn = connections[queryset.db].ops.quote_name
+        table = qn(model._meta.db_table)
+        keys = []
+
+        if not is_single_valued(queryset):
+            return
+
+        if self.view:
+            version = self.get_concept_fields_version()
+            node = self.view.parse(tree=self.tree,
+                                   concept_fields_version=version)
+            groups = node.get_fields_for_order_by()
+
+            for pk, direction in node.ordering:
+                for f in groups[pk]:
+                    field = f.order_field
+
+                    if f.model is not model or field.null:
+                        return
+
+                    keys.append(('{0}.{1}'.format(table, qn(field.column)),
+                                 direction.lower() == 'desc'))
+
+        keys.append(('{0}.{1}'.format(table, qn(model._meta.pk.column)),
+                     False))
+
+        return keys
+
+    def get_partitioned_iterable(self, chunksize=None, processes=None,
+                                 queryset=None, **kwargs):
+        """Returns an iterable that splits the root model's primary key range
+        into consecutive slices of about `chunksize` rows (sized to the memory
+        budget by default) that are executed and formatted in parallel by
+        `processes` workers.
+
+        The slices are merged in primary key order, so this is only used if
+        the primary key is included in the output and the view does not
+        define an ordering. Otherwise the regular iterable is returned.
+        """
+        if queryset is None:
+            queryset = self.get_queryset(**kwargs)
+
+        if isinstance(queryset, EmptyQuerySet):
+            return self.get_iterable(queryset=queryset)
+
+        model = queryset.model
+        pk = model._meta.pk
+
+        if not self.include_pk or \
+                not isinstance(pk, (models.AutoField, models.IntegerField)):
+            return self.get_iterable(queryset=queryset)
+
+        if self.view and self.view.parse(tree=self.tree).ordering:
+            return self.get_iterable(queryset=queryset)
+
+        bounds = model.objects.aggregate(lo=Min('pk'), hi=Max('pk'))
+        bounds = (bounds['lo'], bounds['hi'])
+
+        return PartitionedIterable(self, queryset, bounds,
+                                   processes=processes, chunksize=chunksize)
+
+    def get_fetch_strategy(self, queryset, sql):
+        """Returns the strategy used to fetch the rows of the compiled query
+        and the keyset to seek on, if any.
+
+        Unbounded queries of the chunked tables are read in chunks. Seeking
+        on a keyset (`keyset`) keeps each chunk cheap without holding a
+        cursor open, so it is preferred. Otherwise unbounded queries are
+        streamed through a server-side cursor (`stream`) where supported and
+        chunked with LIMIT/OFFSET (`chunked`) as the last resort. All other
+        queries are fetched by the compiler (`fetch`).
+        """
+        unbounded = 'LIMIT' not in sql
+        tables = queryset.query.tables
+        chunked = unbounded and len(tables) > 0 and \
+            tables[0].startswith(self.chunked_tables)
+
+        if chunked:
+            keys = self.get_keyset(queryset)
+
+            if keys:
+                return 'keyset', keys
+
+        if unbounded and supports_streaming(connections[queryset.db]):
+            return 'stream', None
+
+        if chunked:
+            return 'chunked', None
+
+        return 'fetch', None
+
     def get_iterable(self, offset=None, limit=None, queryset=None, **kwargs):
         "Returns an iterable that can be used by an exporter."
+        entry = None
+
         if queryset is None:
             queryset = self.get_queryset(**kwargs)
 
+            # The compiled SQL of unsliced querysets is cached along with the
+            # queryset itself.
+            if offset is None and limit is None and self.get_cache_key():
+                entry = cache.compiled_queries.get(self.get_cache_key())
+
+        # Nothing to execute for contexts that can not match any row
+        if isinstance(queryset, EmptyQuerySet):
+            return iter([])
+
         if offset is not None and limit is not None:
             queryset = queryset[offset:offset + limit]
         elif offset is not None:
@@ -80,16 +1098,33 @@ class QueryProcessor(object):
             queryset = queryset[:limit]
 
         compiler = queryset.query.get_compiler(queryset.db)
-        sql, params = compiler.as_sql()
+
+        if entry is not None:
+            sql, params = entry[1], entry[2]
+        else:
+            sql, params = self.compile(queryset)
+
         if not sql:
             return iter([])
 
-        tables = queryset.query.tables
-        if len(tables)>0 and tables[0].startswith('p_') and 'LIMIT' not in sql:
-            return queryset_iterator(sql, params, compiler.connection.cursor())
+        strategy, keys = self.get_fetch_strategy(queryset, sql)
+
+        if strategy == 'keyset':
+            iterable = keyset_iterator(queryset, keys, metrics=self.metrics)
+        elif strategy == 'stream':
+            iterable = streaming_iterator(sql, params, compiler.connection,
+                                          metrics=self.metrics)
+        elif strategy == 'chunked':
+            iterable = queryset_iterator(sql, params,
+                                         compiler.connection.cursor(),
+                                         metrics=self.metrics)
         else:
-            return compiler.results_iter()
-        
+            # The query is executed when the first row is fetched
+            iterable = self.metrics.timed('fetch', compiler.results_iter(),
+                                          counter='rows_fetched')
+
+        return QueryIterable(iterable, queryset, sql, params)
+
 
 
 class QueryProcessors(object):
@@ -1,9 +1,15 @@
+import re
+from datetime import date, datetime
+from decimal import Decimal
 from django import forms
 from django.db import models
+from django.core.validators import EMPTY_VALUES
+from django.utils.encoding import smart_unicode
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
 from modeltree.tree import trees
 from avocado.core import loader
+from avocado.core.structures import LRUCache
 from avocado.conf import settings
 from avocado.core.utils import get_form_class
 from avocado.query.oldparsers.datacontext import or_queries, and_queries, negate_query
@@ -13,6 +19,161 @@ OPERATORS = settings.OPERATORS
 INTERNAL_DATATYPE_FORMFIELDS = settings.INTERNAL_DATATYPE_FORMFIELDS
 
 
+class ValueArray(list):
+    """List of values for an `in` lookup that is passed to the database as
+    a single array parameter on PostgreSQL. The lookup is rendered as
+    `IN (SELECT unnest(%s))` which is planned as a hashed semi-join rather
+    than comparing each row against every value of the list. Other backends
+    receive one parameter per value as usual.
+
+    The values must already be prepared for the lookup field.
+    """
+    def _prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'SELECT unnest(%s)', [list(self)]
+        return ', '.join(['%s'] * len(self)), list(self)
+
+
+# Returned by the coercers of `ValueValidator` for values they do not handle
+NOT_COERCED = object()
+
+ISO_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+
+# Maximum number of compiled value validators kept per process
+VALUE_VALIDATORS_SIZE = 1000
+
+
+def _coerce_int(value):
+    if type(value) in (int, long):
+        return value
+    return NOT_COERCED
+
+
+def _coerce_float(value):
+    if type(value) in (int, long, float):
+        return float(value)
+    return NOT_COERCED
+
+
+def _coerce_decimal(value):
+    if type(value) in (int, long, float):
+        return Decimal(str(value))
+    return NOT_COERCED
+
+
+def _coerce_string(value):
+    if type(value) is unicode:
+        return value
+    if type(value) is str:
+        return smart_unicode(value)
+    return NOT_COERCED
+
+
+def _coerce_bool(value):
+    if type(value) is bool:
+        return value
+    return NOT_COERCED
+
+
+def _coerce_date(value):
+    if type(value) is date:
+        return value
+    if type(value) is datetime:
+        return value.date()
+    if isinstance(value, basestring):
+        match = ISO_DATE_RE.match(value)
+        if match:
+            try:
+                return date(*map(int, match.groups()))
+            except ValueError:
+                pass
+    return NOT_COERCED
+
+
+class ValueValidator(object):
+    """Validates and cleans values using a form field that is built once.
+
+    Values of common types are coerced directly with the same result as
+    the form field's `to_python` and are then validated by the form field.
+    Other values and values that fail the fast coercion are cleaned by the
+    form field itself, which also raises the validation errors. The choices
+    of fields with choices are checked against a set.
+    """
+    def __init__(self, formfield):
+        self.formfield = formfield
+        self.coerce = None
+        self.choices = None
+
+        # Exact types since subclasses may normalize values differently
+        kind = type(formfield)
+
+        if kind is forms.TypedChoiceField:
+            self.choices = set(smart_unicode(k) for k, v in
+                               formfield.choices if not
+                               isinstance(v, (list, tuple)))
+            self.coerce = self._coerce_choice
+        elif kind is forms.IntegerField:
+            self.coerce = _coerce_int
+        elif kind is forms.FloatField:
+            self.coerce = _coerce_float
+        elif kind is forms.DecimalField:
+            self.coerce = _coerce_decimal
+        elif kind is forms.CharField:
+            self.coerce = _coerce_string
+        elif kind in (forms.BooleanField, forms.NullBooleanField):
+            self.coerce = _coerce_bool
+        elif kind is forms.DateField:
+            self.coerce = _coerce_date
+
+    def _coerce_choice(self, value):
+        if value is None:
+            return NOT_COERCED
+
+        value = smart_unicode(value)
+
+        if value not in self.choices or value in EMPTY_VALUES:
+            return NOT_COERCED
+
+        try:
+            return self.formfield.coerce(value)
+        except (ValueError, TypeError, ValidationError):
+            return NOT_COERCED
+
+    def _clean(self, value):
+        if self.coerce is not None:
+            cleaned = self.coerce(value)
+
+            if cleaned is not NOT_COERCED:
+                # Choices have already been checked against the set
+                if self.choices is None:
+                    self.formfield.validate(cleaned)
+                self.formfield.run_validators(cleaned)
+                return cleaned
+
+        return self.formfield.clean(value)
+
+    def clean(self, value):
+        # Special case for ``None`` values since all form fields seem to
+        # handle the conversion differently. Simply ignore the cleaning if
+        # ``None``, this scenario occurs when a list of values are being
+        # queried and one of them is to lookup NULL values. Note, the None is
+        # handled downstream and is contained with the query directly.
+        if hasattr(value, '__iter__'):
+            # Django assumes an empty string when given a ``NoneType``
+            # for char-based form fields, this is to ensure ``NoneType``
+            # are passed through unmodified
+            return [None if x is None else self._clean(x) for x in value]
+
+        return self._clean(value)
+
+
+# Compiled value validators keyed by the translator class and the field
+value_validators = LRUCache(VALUE_VALIDATORS_SIZE)
+
+
 class Translator(object):
     """Given a `DataField` instance, a raw value and operator, a
     translator validates, cleans and constructs Django compatible
@@ -75,7 +236,8 @@ class Translator(object):
                                   'this translator'.format(operator))
         return operator
 
-    def _validate_value(self, field, value, **kwargs):
+    def _get_formfield(self, field, **kwargs):
+        "Returns the form field used to clean values of `field`."
         # If a form class is not specified, check to see if there is a custom
         # form_class specified for this datatype or if this translator has
         # one defined
@@ -93,43 +255,84 @@ class Translator(object):
         # 'required' validation errors should be raised.
         kwargs['required'] = False
 
+        # The model field instance has a convenience method called `formfield`
+        # that is suited for the field type. The widget is not used for
+        # cleaning, so the choices of enumerable fields are not loaded.
+        return field.field.formfield(**kwargs)
+
+    def get_value_validator(self, field):
+        """Returns the `ValueValidator` for `field`. Validators are compiled
+        once per field and data version.
+        """
+        key = (self.__class__, field.pk, field.data_version, field.modified)
+        validator = value_validators.get(key)
+
+        if validator is None:
+            validator = ValueValidator(self._get_formfield(field))
+            value_validators.set(key, validator)
+
+        return validator
+
+    def _validate_pk(self, field, value):
+        """Validates primary key values by counting the matching rows rather
+        than loading the objects. The primary keys are returned. Querysets of
+        the model are returned as a queryset of their primary keys which is
+        used as a subquery.
+        """
+        queryset = field.objects
+        pk_field = field.field
+
+        def invalid(pk):
+            return ValidationError(u'Select a valid choice. {0} is not one '
+                                   'of the available choices.'.format(pk))
+
+        if isinstance(value, QuerySet):
+            if value.model is not queryset.model:
+                raise ValidationError(u'The queryset must be of "{0}" '
+                                      'objects'.format(queryset.model))
+            return value.values_list('pk', flat=True)
+
+        if hasattr(value, '__iter__'):
+            pks = [pk_field.to_python(getattr(x, 'pk', x)) for x in value]
+            unique = set(pks)
+
+            if not unique:
+                return []
+
+            lookup = list(unique)
+            threshold = settings.QUERY_IN_ARRAY_THRESHOLD
+            if threshold and len(lookup) > threshold:
+                lookup = ValueArray(lookup)
+
+            if queryset.filter(pk__in=lookup).count() != len(unique):
+                found = set(queryset.filter(pk__in=lookup)
+                            .values_list('pk', flat=True))
+                raise invalid([pk for pk in pks if pk not in found][0])
+
+            return pks
+
+        if value in EMPTY_VALUES:
+            return None
+
+        pk = pk_field.to_python(getattr(value, 'pk', value))
+
+        if not queryset.filter(pk=pk).exists():
+            raise invalid(pk)
+
+        return pk
+
+    def _validate_value(self, field, value, **kwargs):
         # Special handling for primary keys
         if isinstance(field.field, models.AutoField):
-            kwargs.pop('form_class', None)
-            queryset = field.objects
-            if hasattr(value, '__iter__'):
-                formfield = forms.ModelMultipleChoiceField(queryset, **kwargs)
-            else:
-                formfield = forms.ModelChoiceField(queryset, **kwargs)
-            cleaned_value = formfield.clean(value)
-            return cleaned_value
+            return self._validate_pk(field, value)
 
-        # If this field is flagged as enumerable, use a select multiple
-        # by default.
-        if field.enumerable and 'widget' not in kwargs:
-            kwargs['widget'] = forms.SelectMultiple(choices=field.choices())
+        # Custom form field options are not shared with other validations
+        if kwargs or not field.pk:
+            validator = ValueValidator(self._get_formfield(field, **kwargs))
+        else:
+            validator = self.get_value_validator(field)
 
-        # The model field instance has a convenience method called `formfield`
-        # that is suited for the field type
-        formfield = field.field.formfield(**kwargs)
-
-        # Special case for ``None`` values since all form fields seem to handle
-        # the conversion differently. Simply ignore the cleaning if ``None``,
-        # this scenario occurs when a list of values are being queried and one
-        # of them is to lookup NULL values. Note, the None is handled
-        # downstream and is contained with the query directly.
-        if hasattr(value, '__iter__'):
-            cleaned_value = []
-            for x in value:
-                if x is not None:
-                    cleaned_value.append(formfield.clean(x))
-                # Django assumes an empty string when given a ``NoneType``
-                # for char-based form fields, this is to ensure ``NoneType``
-                # are passed through unmodified
-                else:
-                    cleaned_value.append(None)
-            return cleaned_value
-        return formfield.clean(value)
+        return validator.clean(value)
 
     def _get_not_null_pk(self, field, tree):
         """The below logic is required to get the expected results back
@@ -175,11 +378,18 @@ class Translator(object):
             add_null = True
         else:
             # Remove the None value from the list to process separately
-            if operator.lookup == 'in':
+            # Querysets are used as subqueries as is
+            if operator.lookup == 'in' and isinstance(value, list):
                 if None in value:
                     add_null = True
                     value.remove(None)
 
+                # Large lists are passed as a single array parameter
+                threshold = settings.QUERY_IN_ARRAY_THRESHOLD
+                if threshold and len(value) > threshold:
+                    value = ValueArray(
+                        field.field.get_prep_lookup('in', value))
+
             # Process a normal value
             if value is not None:
                 condition = \
@@ -216,12 +426,14 @@ class Translator(object):
         """Normalizes a cleaned value from some non-primitive type
         such as a model or queryset instance.
         """
-        if field.simple_type == 'key':
-            if isinstance(value, (list, tuple, QuerySet)):
-                return [x.pk for x in value]
-            return value.pk
+        # Querysets are rendered as a subquery of their primary keys rather
+        # than loading the objects
         if isinstance(value, QuerySet):
-            return [x.pk for x in value]
+            return value.values_list('pk', flat=True)
+        if field.simple_type == 'key':
+            if isinstance(value, (list, tuple)):
+                return [getattr(x, 'pk', x) for x in value]
+            return getattr(value, 'pk', value)
         if isinstance(value, models.Model):
             return value.pk
         return value
@@ -242,7 +454,54 @@ class Translator(object):
                                   '"{1}"'.format(value, operator))
         return operator, value
 
-    def language(self, field, operator, value, **kwargs):
+    def _describe_pks(self, field, pks):
+        """Returns a mapping of the primary keys to their text. Keys are
+        described by the label field if the field has one, otherwise by the
+        objects themselves.
+        """
+        if field.label_field is not field.field:
+            return field.get_labels(pks)
+
+        objects = field.objects.in_bulk(pks)
+
+        return dict((pk, unicode(objects[pk]) if pk in objects
+                     else smart_unicode(pk)) for pk in pks)
+
+    def language(self, field, operator, value, metadata=None, **kwargs):
+        length = None
+
+        # Primary keys are described by their labels or objects. Only the keys
+        # shown in the text are described, querysets are counted and sliced
+        # rather than listed. The keys of all conditions on the field are
+        # described at once by the `metadata` of the context tree, if passed.
+        if isinstance(field.field, models.AutoField) and value is not None:
+            if isinstance(value, (list, tuple, QuerySet)):
+                if isinstance(value, QuerySet):
+                    length = value.count()
+                else:
+                    length = len(value)
+                pks = operator.shown(value, length)
+            else:
+                pks = [value]
+
+            if metadata is not None:
+                text = metadata.describe_pks(self, field, pks)
+            else:
+                text = self._describe_pks(field, pks)
+
+            if length is None:
+                value = text[value]
+            else:
+                value = [text[x] for x in pks]
+
+                # The length is only passed for values that were sliced
+                if len(value) == length:
+                    length = None
+
+        if length is not None:
+            return u'{0} {1}'.format(field.name,
+                                     operator.text(value, length=length))
+
         return u'{0} {1}'.format(field.name, operator.text(value))
 
     def translate(self, field, roperator, rvalue, tree, **kwargs):
@@ -255,10 +514,12 @@ class Translator(object):
         It should be noted that no checks are performed to prevent the same
         name being used for annotations.
         """
+        metadata = kwargs.pop('metadata', None)
         operator, value = \
             self.validate(field, roperator, rvalue, tree, **kwargs)
         condition = self._condition(field, operator, value, tree)
-        language = self.language(field, operator, value, **kwargs)
+        language = self.language(field, operator, value, metadata=metadata,
+                                 **kwargs)
 
         return {
             'field': field.pk,
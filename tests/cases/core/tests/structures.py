@@ -0,0 +1,25 @@
+from django.test import TestCase
+from avocado.core.structures import LRUCache
+
+__all__ = ['LRUCacheTestCase']
+
+
+class LRUCacheTestCase(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # Access marks 'a' as recently used, so 'b' is evicted
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b', 0), 0)
+
+    def test_disabled(self):
+        cache = LRUCache(None)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
@@ -1,15 +1,32 @@
 import os
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+from cStringIO import StringIO
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils.unittest import skipUnless
 from django.http import HttpResponse
 from django.template import Template
 from django.core import management
+from django.core.cache import cache
 from avocado import export
-from avocado.formatters import RawFormatter
+from avocado.conf import settings
+from avocado.export import jobs
+from avocado.export._base import RESUME_KEY_PREFIX
+from avocado.formatters import Formatter, RawFormatter, \
+    registry as formatters
+from avocado.query.pipeline import QueryIterable, QueryProcessor, \
+    streaming_iterator
 from avocado.models import DataField, DataConcept, DataConceptField, DataView
 from ... import models
 
 __all__ = ['FileExportTestCase', 'ResponseExportTestCase',
-           'ForceDistinctRegressionTestCase']
+           'ForceDistinctRegressionTestCase', 'CopyExportTestCase',
+           'PagedExportTestCase',
+           'StreamingExportTestCase', 'ExportJobTestCase',
+           'PartitionedExportJobTestCase']
 
 
 class ExportTestCase(TestCase):
@@ -95,6 +112,7 @@ class FileExportTestCase(TestCase):
         buff = exporter.write(self.query)
         buff.seek(0)
         self.assertEqual(len(buff.read()), 246)
+        self.assertEqual(exporter.metrics.counters['bytes_written'], 246)
 
     def test_excel(self):
         fname = 'excel_export.xlsx'
@@ -267,3 +285,335 @@ class ForceDistinctRegressionTestCase(TestCase):
             (1, u'Eric', u'Smith'),
             (2, u'Erin', u'Jones')
         ])
+
+
+class CopyExportTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+        self.concepts = [DataField.objects.get_by_natural_key(*key)
+                         .concepts.all()[0] for key in (
+                             ('tests', 'employee', 'first_name'),
+                             ('tests', 'employee', 'is_manager'),
+                             ('tests', 'title', 'salary'))]
+
+    def processor(self, concepts):
+        view = DataView(json=[{'concept': c.pk} for c in concepts])
+        return QueryProcessor(view=view, tree=models.Employee)
+
+    def test_columns(self):
+        processor = self.processor(self.concepts)
+        exporter = processor.get_exporter(export.CSVExporter)
+        iterable = processor.get_iterable()
+
+        self.assertEqual(exporter.get_copy_columns(iterable), (
+            ['id', 'first_name', 'is_manager', 'salary'],
+            [('number', 'None'), ('text', ''), ('boolean', ''),
+             ('number', '')]))
+
+    def test_columns_formatted(self):
+        budget = DataField.objects.get_by_natural_key(
+            'tests', 'project', 'budget').concepts.all()[0]
+
+        # Decimals are rendered differently by the database
+        processor = self.processor([budget])
+        exporter = processor.get_exporter(export.CSVExporter)
+        self.assertEqual(exporter.get_copy_columns(
+            processor.get_iterable()), None)
+
+        # Custom formatters need the rows
+        class UpperFormatter(Formatter):
+            def to_string(self, value, **context):
+                return super(UpperFormatter, self).to_string(value).upper()
+
+        formatters.register(UpperFormatter)
+
+        try:
+            concept = self.concepts[0]
+            concept.formatter_name = 'UpperFormatter'
+            concept.save()
+
+            processor = self.processor([concept])
+            exporter = processor.get_exporter(export.CSVExporter)
+            self.assertEqual(exporter.get_copy_columns(
+                processor.get_iterable()), None)
+        finally:
+            formatters.unregister(UpperFormatter)
+
+    def test_titles(self):
+        processor = self.processor(self.concepts[:1])
+        exporter = processor.get_exporter(export.CSVExporter)
+
+        # Titles of plain exports are the names of the concepts' fields
+        lines = ''.join(exporter.generator(processor.get_iterable(),
+                                           force_distinct=False))\
+            .splitlines()
+        title = DataField.objects.get_by_natural_key(
+            'tests', 'employee', 'first_name').name
+        self.assertEqual(lines[0], 'id\t{0}'.format(title))
+        self.assertEqual(len(lines), 7)
+
+    @skipUnless(connection.vendor == 'postgresql',
+                'COPY is only supported by PostgreSQL')
+    def test_copy(self):
+        models.Employee.objects.filter(pk=1).update(
+            first_name='a,b\tc\\d\ne')
+        models.Employee.objects.filter(pk=2).update(is_manager=None)
+
+        processor = self.processor(self.concepts)
+        exporter = processor.get_exporter(export.CSVExporter)
+        iterable = processor.get_iterable(
+            queryset=processor.get_queryset().order_by('pk'))
+
+        self.assertTrue(exporter.can_copy(iterable, force_distinct=False))
+
+        copied = ''.join(exporter.generator(iterable, force_distinct=False))
+        self.assertTrue('copy' in exporter.metrics.timings)
+        self.assertFalse('format' in exporter.metrics.timings)
+
+        # Formatted in Python from the fetched rows
+        exporter = processor.get_exporter(export.CSVExporter)
+        formatted = ''.join(exporter.generator(list(iterable),
+                                               force_distinct=False))
+
+        self.assertEqual(copied, formatted)
+
+
+class PagedExportTestCase(TestCase):
+    fixtures = ['employee_data.json', 'month_data.json']
+
+    def setUp(self):
+        self.queryset = models.Employee.objects.values_list('last_name')\
+            .order_by('pk')
+        self.exporter = export.BaseExporter()
+        self.exporter.add_formatter(RawFormatter(keys=['last_name']), 1)
+
+    def get_iterable(self, queryset):
+        compiler = queryset.query.get_compiler(queryset.db)
+        sql, params = compiler.as_sql()
+        return QueryIterable(compiler.results_iter(), queryset, sql, params)
+
+    def test_offset_distinct(self):
+        rows = list(self.exporter.write(self.queryset, offset=2, limit=2))
+        self.assertEqual(rows, [(u'Harris',), (u'Cook',)])
+
+    def test_pushdown(self):
+        rows = list(self.exporter.write(self.get_iterable(self.queryset),
+                                        force_distinct=False, offset=2,
+                                        limit=2))
+        self.assertEqual(rows, [(u'Smith',), (u'Harris',)])
+        self.assertEqual(self.exporter.metrics.counters['rows_emitted'], 2)
+
+    def test_default_ordering(self):
+        models.Month.objects.filter(value='jan').update(order=20)
+        queryset = models.Month.objects.values_list('value')
+
+        # Slices keep the model's ordering with the primary key as the
+        # tie-breaker
+        rows = map(tuple, self.get_iterable(queryset).slice(0, 2))
+        self.assertEqual(rows, [(u'feb',), (u'mar',)])
+
+        rows = map(tuple, self.get_iterable(queryset).slice(10, 2))
+        self.assertEqual(rows, [(u'dec',), (u'jan',)])
+
+    def test_resume(self):
+        iterable = self.get_iterable(self.queryset)
+        rows = list(self.exporter.write(iterable, offset=0, limit=2))
+        self.assertEqual(rows, [(u'Smith',), (u'Jones',)])
+
+        token = self.exporter.resume_token
+        self.assertTrue(token)
+
+        rows = list(self.exporter.write(self.get_iterable(self.queryset),
+                                        offset=2, limit=2, resume=token))
+        self.assertEqual(rows, [(u'Harris',), (u'Cook',)])
+
+        # Positions are kept in the Django cache
+        state = cache.get(RESUME_KEY_PREFIX + token)
+        self.assertEqual(state['offset'], 2)
+        self.assertEqual(len(state['unique_rows']), 2)
+
+    def test_resume_window(self):
+        window = settings.EXPORT_RESUME_WINDOW
+        settings.EXPORT_RESUME_WINDOW = 1
+
+        try:
+            list(self.exporter.write(self.get_iterable(self.queryset),
+                                     offset=0, limit=2))
+        finally:
+            settings.EXPORT_RESUME_WINDOW = window
+
+        # The rows read so far do not fit in the window
+        self.assertEqual(self.exporter.resume_token, None)
+
+    def test_distinct_ordering(self):
+        queryset = models.Employee.objects\
+            .values_list('title__name', 'last_name').distinct()
+
+        # The selected columns are the tie-breaker of distinct rows
+        rows = map(tuple, self.get_iterable(queryset).slice(0, 2)) + \
+            map(tuple, self.get_iterable(queryset).slice(2, 10))
+        self.assertEqual(rows, sorted(set(queryset)))
+
+
+class StreamingExportTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+        concepts = [DataField.objects.get(field_name=name).concepts.all()[0]
+                    for name in ('first_name', 'last_name')]
+        self.view = DataView(json=[{'concept': c.pk} for c in concepts])
+
+    def export(self):
+        processor = QueryProcessor(view=self.view, tree=models.Employee)
+        exporter = processor.get_exporter(export.BaseExporter)
+        iterable = processor.get_iterable()
+        return iterable, sorted(exporter.write(iterable))
+
+    @skipUnless(connection.vendor == 'postgresql',
+                'Server-side cursors require PostgreSQL')
+    def test_rows(self):
+        iterable, rows = self.export()
+        self.assertEqual(iterable.iterable.__name__, 'streaming_iterator')
+
+        with override_settings(AVOCADO_QUERY_STREAM_ITERSIZE=None):
+            iterable, expected = self.export()
+
+        self.assertNotEqual(iterable.iterable.__name__, 'streaming_iterator')
+        self.assertEqual(rows, expected)
+        self.assertEqual(len(rows), models.Employee.objects.count())
+
+    @skipUnless(connection.vendor == 'postgresql',
+                'Server-side cursors require PostgreSQL')
+    def test_close(self):
+        queryset = models.Employee.objects.values_list('pk').order_by('pk')
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+
+        iterator = streaming_iterator(sql, params, connection, itersize=2)
+        self.assertEqual(iterator.next(), (1,))
+
+        # The cursor is released when the consumer stops early
+        iterator.close()
+        self.assertEqual(list(queryset), [(i,) for i in xrange(1, 7)])
+
+
+class ExportJobTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+        self.path = tempfile.mkdtemp()
+        self.settings = override_settings(AVOCADO_EXPORT_JOB_DIR=self.path)
+        self.settings.enable()
+
+        concept = DataField.objects.get(field_name='first_name')\
+            .concepts.all()[0]
+        self.view = [{'concept': concept.pk}]
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.path)
+
+    def test_run(self):
+        job = jobs.submit('json', view=self.view)
+        self.assertEqual(job.status()['state'], jobs.PENDING)
+        self.assertEqual([j.id for j in jobs.get_pending()], [job.id])
+
+        # A job is only run by the worker that claims it
+        self.assertTrue(job.claim())
+        self.assertFalse(job.claim())
+        self.assertEqual(jobs.get_pending(), [])
+
+        jobs.run(job.id)
+
+        status = job.status()
+        self.assertEqual(status['state'], jobs.DONE)
+        self.assertEqual(status['rows'], 6)
+        self.assertTrue(status['bytes'] > 0)
+        self.assertEqual(len(json.loads(job.open().read())), 6)
+
+    def test_cancel_pending(self):
+        job = jobs.submit('json', view=self.view)
+        job.cancel()
+        self.assertEqual(job.status()['state'], jobs.CANCELLED)
+        self.assertEqual(jobs.get_pending(), [])
+
+        jobs.run(job.id)
+        self.assertEqual(job.status()['state'], jobs.CANCELLED)
+        self.assertRaises(ValueError, job.open)
+
+    def test_cancel_running(self):
+        job = jobs.submit('json', view=self.view)
+        exporter = export.JSONExporter()
+        output = StringIO()
+
+        def chunks():
+            yield 'a'
+            # Cancelled while the output is written
+            job.cancel()
+            yield 'b'
+            yield 'c'
+
+        progress = jobs.PROGRESS_CHUNKS, jobs.PROGRESS_INTERVAL
+        jobs.PROGRESS_CHUNKS, jobs.PROGRESS_INTERVAL = 1, 0
+
+        try:
+            self.assertRaises(jobs.JobCancelled, jobs._track, job, exporter,
+                              chunks(), output)
+        finally:
+            jobs.PROGRESS_CHUNKS, jobs.PROGRESS_INTERVAL = progress
+
+        self.assertEqual(output.getvalue(), 'ab')
+
+    def test_error(self):
+        job = jobs.submit('json', view=self.view, processor='missing')
+        jobs.run(job.id)
+
+        status = job.status()
+        self.assertEqual(status['state'], jobs.FAILED)
+        self.assertTrue('missing' in status['error'])
+        self.assertTrue('finished' in status)
+
+
+class PartitionedExportJobTestCase(TransactionTestCase):
+    # Worker processes only see committed rows
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+        self.path = tempfile.mkdtemp()
+        self.settings = override_settings(AVOCADO_EXPORT_JOB_DIR=self.path)
+        self.settings.enable()
+
+        concept = DataField.objects.get(field_name='first_name')\
+            .concepts.all()[0]
+        self.view = [{'concept': concept.pk}]
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.path)
+
+    def run_job(self):
+        job = jobs.submit('json', view=self.view)
+        jobs.run(job.id)
+
+        status = job.status()
+        self.assertEqual(status['state'], jobs.DONE)
+        self.assertEqual(status['rows'], 6)
+
+        return json.loads(job.open().read())
+
+    def test_run(self):
+        serial = self.run_job()
+
+        with override_settings(AVOCADO_EXPORT_JOB_PARTITION_PROCESSES=2):
+            partitioned = self.run_job()
+
+        self.assertEqual(len(partitioned), 6)
+        self.assertEqual(sorted(partitioned), sorted(serial))
@@ -281,6 +281,30 @@ class DataFieldQuerysetTestCase(TestCase):
             list(self.first_name.value_labels(queryset=queryset)),
             [(u'Zac', u'Zac')])
 
+    def test_get_labels(self):
+        cache.clear()
+
+        with self.assertNumQueries(1):
+            labels = self.first_name.get_labels(['Zac', 'Mel', 'Zac', 'X'])
+
+        self.assertSequenceEqual(list(labels), [
+            (u'Zac', u'Zac'),
+            (u'Mel', u'Mel'),
+            (u'X', u'X'),
+        ])
+
+        # Labels are cached per value
+        with self.assertNumQueries(1):
+            labels = self.first_name.get_labels(['Mel', 'Eric'])
+
+        self.assertSequenceEqual(list(labels), [
+            (u'Mel', u'Mel'),
+            (u'Eric', u'Eric'),
+        ])
+
+        with self.assertNumQueries(0):
+            self.first_name.get_labels(['Zac', 'Eric'])
+
     def test_coded_labels(self):
         self.first_name.code_field_name = 'id'
 
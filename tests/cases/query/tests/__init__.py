@@ -1,3 +1,7 @@
 from .operators import *        # noqa
 from .parsers import *          # noqa
 from .translators import *      # noqa
+from .pipeline import *         # noqa
+from .metrics import *          # noqa
+from .expressions import *      # noqa
+from .optimizer import *       # noqa
@@ -0,0 +1,138 @@
+from django.test import TestCase
+from avocado.export._vcf import fix_sample_queries
+from avocado.query.expressions import Predicate, In, And, Or, Not, simplify
+from avocado.query.oldparsers.datacontext import Node, or_queries, \
+    and_queries, negate_query, get_foreign_key_graph
+from ....models import Employee
+
+__all__ = ['ExpressionTestCase', 'DictConditionTestCase',
+           'SampleClauseTestCase', 'ForeignKeyGraphTestCase']
+
+
+class ExpressionTestCase(TestCase):
+    def test_flatten(self):
+        a, b, c = Predicate('a > 1'), Predicate('b > 1'), Predicate('c > 1')
+        expr = simplify(And([a, And([b, And([c, a])])]))
+        self.assertEqual(expr.render(), '(a > 1 AND b > 1 AND c > 1)')
+
+    def test_single(self):
+        a = Predicate('a > 1')
+        self.assertEqual(simplify(Or([a, a])), a)
+
+    def test_merge_exact(self):
+        expr = simplify(Or([
+            Predicate("t.chr = 'chr1'"),
+            Predicate('t.pos > 10'),
+            Or([Predicate("t.chr = 'chr2'"), Predicate('t.qual = 5')]),
+        ]))
+        self.assertEqual(expr.render(),
+                         "(t.chr IN ('chr1', 'chr2') OR t.pos > 10 OR "
+                         "t.qual = 5)")
+        self.assertTrue(isinstance(expr.children[0], In))
+
+    def test_no_merge_in_and(self):
+        expr = simplify(And([Predicate('t.a = 1'), Predicate('t.a = 2')]))
+        self.assertEqual(expr.render(), '(t.a = 1 AND t.a = 2)')
+
+    def test_double_negation(self):
+        a = Predicate('a > 1')
+        self.assertEqual(simplify(Not(Not(a))), a)
+        self.assertEqual(simplify(Not(a)).render(), 'NOT (a > 1)')
+
+
+class DictConditionTestCase(TestCase):
+    def test_or(self):
+        q1 = {'query': 't.a = 1', 'models': ['t']}
+        q2 = {'query': 't.a = 2', 'models': ['t']}
+        q3 = {'query': 't.b > 3', 'models': ['t', 'u']}
+
+        condition = or_queries(or_queries(q1, q2), q3)
+        self.assertEqual(condition['query'], '(t.a IN (1, 2) OR t.b > 3)')
+        self.assertEqual(condition['models'], ['t', 'u'])
+
+    def test_or_samples(self):
+        q1 = {'query': 'v_matrix.samples = 1', 'models': ['v_matrix']}
+        q2 = {'query': 'v_matrix.samples = 2', 'models': ['v_matrix']}
+
+        # Sample matches are left for the VCF export to rewrite
+        condition = or_queries(q1, q2)
+        sql = '(v_matrix.samples = 1 OR v_matrix.samples = 2)'
+
+        self.assertEqual(condition['query'], sql)
+        self.assertTrue('NOT v_matrix.samples' in
+                        fix_sample_queries(condition['query']))
+
+    def test_and(self):
+        q1 = {'query': 't.a = 1', 'models': ['t']}
+        q2 = {'query': 't.b > 3', 'models': ['t']}
+
+        condition = and_queries(and_queries(q1, q2), q1)
+        self.assertEqual(condition['query'], '(t.a = 1 AND t.b > 3)')
+        self.assertEqual(condition['models'], ['t'])
+
+    def test_negate(self):
+        condition = negate_query(negate_query({'query': 't.a = 1',
+                                               'models': ['t']}))
+        self.assertEqual(condition['query'], 't.a = 1')
+
+
+class SampleClauseTestCase(TestCase):
+    sub_queries = ['v_matrix.samples = 1', 'v_matrix.samples = 2',
+                   'v_matrix.samples = 1']
+
+    def test_correlated(self):
+        clause = Node(tree='v').get_sample_clause(self.sub_queries[:1],
+                                                  strategy='correlated')
+        self.assertEqual(clause, 'v._id = (SELECT v_matrix._id FROM '
+                         'v_matrix WHERE v_matrix.samples = 1 AND '
+                         'v._id = v_matrix._id LIMIT 1)')
+
+    def test_exists(self):
+        clause = Node(tree='v').get_sample_clause(self.sub_queries,
+                                                  strategy='exists')
+        self.assertEqual(clause.count('EXISTS'), 2)
+        self.assertTrue(clause.startswith(
+            'EXISTS (SELECT 1 FROM v_matrix WHERE v_matrix.samples = 1 '
+            'AND v._id = v_matrix._id)'))
+
+    def test_grouped(self):
+        node = Node(tree='v')
+
+        clause = node.get_sample_clause(self.sub_queries[:1],
+                                        strategy='grouped')
+        self.assertEqual(clause, 'v._id IN (SELECT v_matrix._id FROM '
+                         'v_matrix WHERE v_matrix.samples = 1)')
+
+        clause = node.get_sample_clause(self.sub_queries, strategy='grouped')
+        self.assertEqual(clause, 'v._id IN (SELECT v_matrix._id FROM '
+                         'v_matrix WHERE (v_matrix.samples = 1) OR '
+                         '(v_matrix.samples = 2) GROUP BY v_matrix._id '
+                         'HAVING count(CASE WHEN v_matrix.samples = 1 THEN 1 '
+                         'END) > 0 AND count(CASE WHEN v_matrix.samples = 2 '
+                         'THEN 1 END) > 0)')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, Node(tree='v').get_sample_clause,
+                          self.sub_queries, strategy='lateral')
+
+    def test_node_strategy(self):
+        node = Node(tree='v')
+        node.sample_strategy = 'exists'
+
+        # The strategy of the node takes precedence over the setting
+        self.assertTrue(node.get_sample_clause(self.sub_queries[:1])
+                        .startswith('EXISTS'))
+        self.assertTrue(node.get_sample_clause(self.sub_queries[:1],
+                                               strategy='correlated')
+                        .startswith('v._id = (SELECT'))
+
+
+class ForeignKeyGraphTestCase(TestCase):
+    def test_graph(self):
+        graph = get_foreign_key_graph(Employee)
+        self.assertEqual(sorted(graph), [
+            ('tests_office', '_id', 'office'),
+            ('tests_title', '_id', 'title'),
+        ])
+        # Derived once per model class
+        self.assertTrue(get_foreign_key_graph(Employee) is graph)
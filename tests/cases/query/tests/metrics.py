@@ -0,0 +1,48 @@
+from django.test import TestCase
+from avocado.query.metrics import Metrics
+
+__all__ = ['MetricsTestCase']
+
+
+class MetricsTestCase(TestCase):
+    def test_stage(self):
+        metrics = Metrics()
+
+        with metrics.stage('outer'):
+            with metrics.stage('inner'):
+                pass
+
+        self.assertEqual(metrics.timings.keys(), ['inner', 'outer'])
+
+    def test_timed(self):
+        metrics = Metrics()
+        items = list(metrics.timed('fetch', [1, 2, 3], counter='rows'))
+
+        self.assertEqual(items, [1, 2, 3])
+        self.assertEqual(metrics.counters['rows'], 3)
+        self.assertTrue('fetch' in metrics.timings)
+
+    def test_as_dict(self):
+        metrics = Metrics()
+        metrics.incr('bytes_written', 10)
+        metrics.maximum('peak', 5)
+        metrics.maximum('peak', 2)
+
+        data = metrics.as_dict()
+        self.assertEqual(data['counters'], {'bytes_written': 10, 'peak': 5})
+
+    def test_merge(self):
+        metrics = Metrics()
+        metrics.incr('rows_fetched', 2)
+        metrics.maximum('peak', 5)
+
+        worker = Metrics()
+        worker.incr('rows_fetched', 3)
+        worker.maximum('peak', 7)
+
+        with worker.stage('format'):
+            pass
+
+        metrics.merge(worker)
+        self.assertEqual(metrics.counters, {'rows_fetched': 5, 'peak': 7})
+        self.assertEqual(metrics.timings.keys(), ['format'])
@@ -0,0 +1,176 @@
+from django.test import TestCase
+from django.core import management
+from avocado.query import oldparsers as parsers, optimizer
+from avocado.query.oldparsers.datacontext import Condition, Branch, Empty
+from avocado.models import DataContext, DataField, DataView
+from avocado.query.pipeline import QueryProcessor
+from avocado.export import CSVExporter
+from ....models import Employee
+
+__all__ = ['OptimizerTestCase']
+
+
+class OptimizerTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+    def optimize(self, attrs):
+        return optimizer.optimize(
+            parsers.datacontext.parse(attrs, tree=Employee))
+
+    def test_duplicate_children(self):
+        condition = {
+            'field': 'tests.title.name',
+            'operator': 'exact',
+            'value': 'CEO',
+        }
+        node = self.optimize({
+            'type': 'and',
+            'children': [dict(condition), dict(condition)],
+        })
+        self.assertTrue(isinstance(node, Condition))
+        self.assertEqual(node.value, 'CEO')
+
+    def test_in_values(self):
+        node = self.optimize({
+            'field': 'tests.title.name',
+            'operator': 'in',
+            'value': ['CEO', 'CTO', 'CEO'],
+        })
+        self.assertEqual(node.value, ['CEO', 'CTO'])
+
+    def test_fold_exact(self):
+        node = self.optimize({
+            'type': 'or',
+            'children': [{
+                'field': 'tests.title.name',
+                'operator': 'exact',
+                'value': 'CEO',
+            }, {
+                'field': 'tests.title.name',
+                'operator': 'in',
+                'value': ['CTO', 'CEO'],
+            }, {
+                'field': 'tests.title.salary',
+                'operator': 'gt',
+                'value': 10000,
+            }],
+        })
+        self.assertTrue(isinstance(node, Branch))
+        self.assertEqual(len(node.children), 2)
+        self.assertEqual(node.children[0].operator, 'in')
+        self.assertEqual(node.children[0].value, ['CEO', 'CTO'])
+
+        expected = Employee.objects.filter(title__name__in=['CEO', 'CTO']) \
+            | Employee.objects.filter(title__salary__gt=10000)
+        self.assertEqual(
+            sorted(node.apply().values_list('pk', flat=True)),
+            sorted(expected.distinct().values_list('pk', flat=True)))
+
+    def test_merge_bounds(self):
+        node = self.optimize({
+            'type': 'and',
+            'children': [{
+                'field': 'tests.title.salary',
+                'operator': 'gte',
+                'value': 10000,
+            }, {
+                'field': 'tests.title.salary',
+                'operator': 'range',
+                'value': [5000, 20000],
+            }, {
+                'field': 'tests.title.salary',
+                'operator': 'lte',
+                'value': 30000,
+            }],
+        })
+        self.assertEqual(node.operator, 'range')
+        self.assertEqual(node.value, [10000, 20000])
+
+        node = self.optimize({
+            'type': 'and',
+            'children': [{
+                'field': 'tests.title.salary',
+                'operator': 'gt',
+                'value': 10000,
+            }, {
+                'field': 'tests.title.salary',
+                'operator': 'lte',
+                'value': 20000,
+            }, {
+                'field': 'tests.title.salary',
+                'operator': 'in',
+                'value': [10000, 15000],
+            }],
+        })
+        self.assertEqual(node.operator, 'exact')
+        self.assertEqual(node.value, 15000)
+
+    def test_unsatisfiable(self):
+        attrs = {
+            'type': 'and',
+            'children': [{
+                'field': 'tests.title.salary',
+                'operator': 'gt',
+                'value': 20000,
+            }, {
+                'field': 'tests.title.salary',
+                'operator': 'lt',
+                'value': 10000,
+            }],
+        }
+        node = self.optimize(attrs)
+        self.assertTrue(isinstance(node, Empty))
+
+        queryset = DataContext(json=attrs).apply(tree=Employee)
+        self.assertEqual(queryset.count(), 0)
+        self.assertEqual(list(queryset), [])
+
+        # The context stays empty when the view is applied
+        concept = DataField.objects.get(field_name='first_name')\
+            .concepts.all()[0]
+        view = DataView(json=[{'concept': concept.pk}])
+        processor = QueryProcessor(context=DataContext(json=attrs),
+                                   view=view, tree=Employee)
+        self.assertEqual(processor.get_queryset().count(), 0)
+        self.assertEqual(list(processor.get_iterable()), [])
+
+        # No SQL is executed for the export
+        queryset = processor.get_queryset()
+        exporter = processor.get_exporter(CSVExporter)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(queryset.count(), 0)
+            iterable = processor.get_iterable(queryset=queryset)
+            self.assertEqual(list(exporter.read(iterable)), [])
+            iterable = processor.get_iterable(queryset=queryset, offset=10,
+                                              limit=10)
+            self.assertEqual(list(exporter.read(iterable)), [])
+            iterable = processor.get_partitioned_iterable(queryset=queryset)
+            self.assertEqual(list(exporter.read(iterable)), [])
+
+        # An empty child of an OR branch is dropped
+        node = self.optimize({
+            'type': 'or',
+            'children': [attrs, {
+                'field': 'tests.title.name',
+                'operator': 'exact',
+                'value': 'CEO',
+            }],
+        })
+        self.assertTrue(isinstance(node, Condition))
+
+    def test_shared_tree(self):
+        attrs = {
+            'field': 'tests.title.name',
+            'operator': 'in',
+            'value': ['CEO', 'CEO'],
+        }
+        parsed = parsers.datacontext.parse(attrs, tree=Employee)
+        node = optimizer.optimize(parsed)
+
+        # The parsed tree is not modified and is optimized once
+        self.assertEqual(parsed.value, ['CEO', 'CEO'])
+        self.assertTrue(optimizer.optimize(parsed) is node)
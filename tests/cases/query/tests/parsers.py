@@ -1,9 +1,13 @@
+import multiprocessing
 from copy import deepcopy
 from django.test import TestCase
 from django.core.exceptions import ValidationError
 from django.core import management
-from avocado.query import oldparsers as parsers
-from avocado.models import DataConcept, DataField, DataConceptField
+from modeltree.tree import trees
+from avocado.query import oldparsers as parsers, cache
+from avocado.models import DataConcept, DataField, DataConceptField, \
+    DataContext, DataView
+from avocado.query.pipeline import QueryProcessor
 from ....models import Employee
 
 
@@ -197,6 +201,123 @@ class DataContextParserTestCase(TestCase):
         self.assertEqual(str(node.condition),
                          "(AND: ('title__name__exact', u'CEO'))")
 
+    def test_bulk_metadata(self):
+        title = DataField.objects.get_by_natural_key('tests.title.name')
+        attrs = {
+            'type': 'and',
+            'children': [{
+                'field': 'tests.title.name',
+                'operator': 'exact',
+                'value': 'CEO',
+            }, {
+                'field': title.pk,
+                'operator': 'exact',
+                'value': 'CEO',
+            }, {
+                'field': 'tests.employee.first_name',
+                'operator': 'exact',
+                'value': 'John',
+            }]
+        }
+
+        # The fields of all conditions are resolved in a single query
+        with self.assertNumQueries(1):
+            node = parsers.datacontext.parse(attrs, tree=Employee)
+
+        with self.assertNumQueries(0):
+            fields = [child.field for child in node.children]
+
+        self.assertEqual(fields[0], title)
+        self.assertEqual(fields[1], title)
+        self.assertEqual(fields[2].field_name, 'first_name')
+
+    def test_bulk_metadata_concept(self):
+        title = DataField.objects.get_by_natural_key('tests.title.name')
+        first_name = DataField.objects.get_by_natural_key(
+            'tests.employee.first_name')
+        concept = first_name.concepts.all()[0]
+
+        attrs = {
+            'type': 'and',
+            'children': [{
+                'concept': title.concepts.all()[0].pk,
+                'field': 'tests.title.name',
+                'operator': 'exact',
+                'value': 'CEO',
+            }, {
+                'concept': concept.pk,
+                'field': 'tests.title.name',
+                'operator': 'exact',
+                'value': 'CEO',
+            }]
+        }
+
+        node = parsers.datacontext.parse(attrs, tree=Employee)
+        self.assertEqual(node.children[0].field, title)
+
+        # The field is only looked up among the fields of the concept
+        self.assertRaises(DataField.DoesNotExist,
+                          lambda: node.children[1].field)
+
+    def test_composite(self):
+        c1 = DataContext(json={
+            'field': 'tests.title.name',
+            'operator': 'exact',
+            'value': 'CEO',
+        })
+        c1.save()
+        c2 = DataContext(json={'composite': c1.pk})
+        c2.save()
+        c3 = DataContext(json={
+            'type': 'and',
+            'children': [{'composite': c2.pk}, {'composite': c1.pk}],
+        })
+        c3.save()
+
+        node = parsers.datacontext.parse({'composite': c3.pk}, tree=Employee)
+        self.assertEqual(len(node.children), 2)
+        self.assertEqual(node.children[0].field.field_name, 'name')
+
+        # The graph is cached, only checked for changes
+        with self.assertNumQueries(2):
+            parsers.datacontext.parse({'composite': c3.pk}, tree=Employee)
+
+    def test_composite_cycle(self):
+        cxt = DataContext(json={})
+        cxt.save()
+        cxt.json = {
+            'type': 'or',
+            'children': [{'composite': cxt.pk}],
+        }
+        cxt.save()
+
+        self.assertRaises(ValidationError, parsers.datacontext.parse,
+                          {'composite': cxt.pk}, tree=Employee)
+
+        attrs = parsers.datacontext.validate({
+            'composite': cxt.pk,
+            'language': 'Cycle',
+        }, tree=Employee)
+        self.assertFalse(attrs['enabled'])
+
+    def test_translation_memoized(self):
+        condition = {
+            'field': 'tests.title.name',
+            'operator': 'exact',
+            'value': 'CEO',
+        }
+        node = parsers.datacontext.parse({
+            'type': 'or',
+            'children': [condition, dict(condition)],
+        }, tree=Employee)
+
+        node.condition
+        node.language
+        node.children[0].extra
+
+        # Identical conditions are translated once
+        self.assertEqual(node.translation_count, 1)
+
     def test_apply(self):
         node = parsers.datacontext.parse({
             'field': 'tests.title.boss',
@@ -253,6 +374,57 @@ class DataContextParserTestCase(TestCase):
         })
 
 
+class DataContextParseCacheTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+        self.attrs = {
+            'field': 'tests.title.name',
+            'operator': 'exact',
+            'value': 'CEO',
+        }
+
+    def test_shared(self):
+        node = DataContext(json=deepcopy(self.attrs)).parse(tree=Employee)
+
+        # Annotations do not change the conditions
+        attrs = dict(self.attrs, language='Name is CEO')
+        self.assertTrue(DataContext(json=attrs).parse(tree=Employee) is node)
+
+    def test_field_changed(self):
+        node = DataContext(json=deepcopy(self.attrs)).parse(tree=Employee)
+
+        DataField.objects.filter(field_name='name', model_name='title')\
+            .update(data_version=2)
+
+        self.assertFalse(DataContext(json=deepcopy(self.attrs))
+                         .parse(tree=Employee) is node)
+
+    def test_validated(self):
+        attrs = parsers.datacontext.validate(deepcopy(self.attrs),
+                                             tree=Employee)
+
+        # The tree parsed during validation is applied without translating
+        # the condition again
+        node = DataContext(json=attrs).parse(tree=Employee)
+        count = node.translation_count
+        self.assertEqual(count, 1)
+
+        node.apply()
+        self.assertEqual(node.translation_count, count)
+
+    def test_validated_default_tree(self):
+        attrs = parsers.datacontext.validate(deepcopy(self.attrs))
+
+        # Contexts validated against the default tree are applied by the
+        # processor of its root model without translating them again
+        processor = QueryProcessor(context=DataContext(json=attrs),
+                                   tree=Employee)
+        processor.get_queryset()
+        self.assertEqual(processor.metrics.counters.get('translations'), 0)
+
+
 class DataViewParserTestCase(TestCase):
     fixtures = ['employee_data.json']
 
@@ -357,6 +529,87 @@ class DataViewParserTestCase(TestCase):
             '"tests_title"."id") ORDER BY "tests_office"."location" DESC, '
             '"tests_title"."name" DESC')
 
+    def test_fields_cached(self):
+        node = parsers.dataview.parse([{'concept': 1}], tree=Employee)
+        fields = node.get_fields_for_select()
+        self.assertEqual(sorted(f.pk for f in fields[1]), [1, 2])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(node.get_fields_for_select(), fields)
+
+        # Changing the fields of the concept invalidates the map
+        DataConceptField(concept=DataConcept.objects.get(pk=1),
+                         field=DataField.objects.get(pk=3)).save()
+
+        fields = node.get_fields_for_select()
+        self.assertEqual(sorted(f.pk for f in fields[1]), [1, 2, 3])
+
+    def test_fields_invalidated_by_other_process(self):
+        node = parsers.dataview.parse([{'concept': 1}], tree=Employee)
+        fields = node.get_fields_for_select()
+
+        # The version is incremented in the Django cache shared with the
+        # other process
+        process = multiprocessing.Process(
+            target=cache.invalidate_concept_fields)
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertTrue(1 in cache.concept_fields)
+
+        # Nodes parsed afterwards drop the map of this process
+        node = parsers.dataview.parse([{'concept': 1}], tree=Employee)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(node.get_fields_for_select(), fields)
+
+    def test_version_read_once(self):
+        calls = []
+        concept_fields_version = cache.concept_fields_version
+
+        def counted():
+            calls.append(None)
+            return concept_fields_version()
+
+        cache.concept_fields_version = counted
+
+        try:
+            view = DataView(json=[{'concept': 1, 'sort': 'desc'}])
+            processor = QueryProcessor(view=view, tree=Employee)
+            processor.get_queryset()
+            processor.get_keyset(processor.get_queryset())
+        finally:
+            cache.concept_fields_version = concept_fields_version
+
+        self.assertEqual(len(calls), 1)
+
+    def test_plan_cached(self):
+        node = parsers.dataview.parse({'columns': [1]}, tree=Employee)
+        sql = unicode(node.apply().query)
+
+        tree = trees[Employee]
+        plan = node._get_plan(tree, False)
+
+        # Shared by views with the same facets
+        node = parsers.dataview.parse({'columns': [1]}, tree=Employee)
+        self.assertTrue(node._get_plan(tree, False) is plan)
+        self.assertFalse(node._get_plan(tree, True) is plan)
+        self.assertEqual(unicode(node.apply().query), sql)
+
+        # Not shared with the tree before it built its nodes
+        nodes = tree._nodes
+        tree._nodes = {}
+
+        try:
+            self.assertFalse(node._get_plan(tree, False) is plan)
+        finally:
+            tree._nodes = nodes
+
+        # Changing the fields of the concept invalidates the plan
+        DataConceptField(concept=DataConcept.objects.get(pk=1),
+                         field=DataField.objects.get(pk=3)).save()
+        self.assertFalse(node._get_plan(tree, False) is plan)
+
 
 class DataQueryParserTestCase(TestCase):
     fixtures = ['employee_data.json']
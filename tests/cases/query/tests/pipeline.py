@@ -0,0 +1,368 @@
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.core import management
+from avocado.export import BaseExporter
+from avocado.models import DataField, DataView, DataContext
+from avocado.query import cache, pipeline
+from avocado.query.metrics import Metrics
+from avocado.query.pipeline import ChunkSizer, keyset_iterator, \
+    is_single_valued, prefetch_iterator, dedicated_connection, \
+    PartitionedIterable, QueryProcessor
+from ....models import Employee
+
+__all__ = ['KeysetIteratorTestCase', 'ChunkSizerTestCase',
+           'PrefetchIteratorTestCase', 'PartitionedIterableTestCase',
+           'QueryCacheTestCase', 'FetchStrategyTestCase']
+
+
+class KeysetIteratorTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def test_primary_key(self):
+        queryset = Employee.objects.values_list('pk', 'first_name')
+        keys = [('"tests_employee"."id"', False)]
+
+        self.assertEqual(list(keyset_iterator(queryset, keys, chunksize=2)),
+                         list(queryset.order_by('pk')))
+
+    def test_sort_key(self):
+        queryset = Employee.objects.values_list('pk', 'last_name')
+        keys = [
+            ('"tests_employee"."last_name"', True),
+            ('"tests_employee"."id"', False),
+        ]
+
+        self.assertEqual(list(keyset_iterator(queryset, keys, chunksize=4)),
+                         list(queryset.order_by('-last_name', 'pk')))
+
+    def test_extra_select(self):
+        initial = {'initial': 'substr("tests_employee"."first_name", 1, 1)'}
+        queryset = Employee.objects.extra(select=initial)
+
+        # Only the queryset's own columns are returned
+        values = queryset.values_list('pk', 'first_name')
+        keys = [('"tests_employee"."id"', False)]
+
+        self.assertEqual(list(keyset_iterator(values, keys, chunksize=2)),
+                         list(values.order_by('pk')))
+
+        keys = [
+            ('"tests_employee"."last_name"', True),
+            ('"tests_employee"."id"', False),
+        ]
+        ordered = queryset.order_by('-last_name', 'pk')
+        compiler = ordered.query.get_compiler(ordered.db)
+
+        self.assertEqual(list(keyset_iterator(queryset, keys, chunksize=3)),
+                         [tuple(row) for row in compiler.results_iter()])
+
+    def test_single_valued(self):
+        self.assertTrue(is_single_valued(
+            Employee.objects.values_list('pk', 'title__name')))
+        self.assertFalse(is_single_valued(
+            Employee.objects.values_list('pk', 'project__name')))
+
+
+class ChunkSizerTestCase(TestCase):
+    def test_budget(self):
+        metrics = Metrics()
+        sizer = ChunkSizer(10, budget=100000, minimum=1, metrics=metrics)
+        narrow = [(1,)] * 10
+        wide = [tuple(['x' * 100] * 50)] * 10
+
+        narrow_size = sizer.measure(narrow)
+        wide_size = sizer.measure(wide)
+
+        self.assertTrue(narrow_size > wide_size)
+        self.assertTrue(wide_size * sizer.row_size(wide) <= 100000)
+        self.assertEqual(metrics.counters['chunks'], 2)
+        self.assertTrue(metrics.counters['chunk_memory_peak'] >
+                        10 * 50 * 100)
+
+    def test_fixed(self):
+        sizer = ChunkSizer(10, budget=0)
+        self.assertEqual(sizer.measure([(1,)] * 10), 10)
+
+    def test_bounds(self):
+        sizer = ChunkSizer(10, budget=10 ** 9, minimum=5, maximum=50)
+        self.assertEqual(sizer.measure([(1,)] * 10), 50)
+
+        sizer = ChunkSizer(10, budget=1, minimum=5)
+        self.assertEqual(sizer.measure([(1,)] * 10), 5)
+
+
+class PrefetchIteratorTestCase(TestCase):
+    def test_order(self):
+        rows = [(i,) for i in xrange(100)]
+        self.assertEqual(list(prefetch_iterator(iter(rows), depth=2,
+                                                batch=7)), rows)
+
+    def test_error(self):
+        def rows():
+            yield (1,)
+            raise ValueError
+
+        iterator = prefetch_iterator(rows(), depth=2, batch=1)
+        self.assertEqual(iterator.next(), (1,))
+        self.assertRaises(ValueError, list, iterator)
+
+    def test_close(self):
+        closed = []
+
+        def rows():
+            try:
+                for i in xrange(1000):
+                    yield (i,)
+            finally:
+                closed.append(True)
+
+        iterator = prefetch_iterator(rows(), depth=1, batch=1)
+        self.assertEqual(iterator.next(), (0,))
+        iterator.close()
+        self.assertEqual(closed, [True])
+
+    def test_dedicated_connection(self):
+        dedicated = dedicated_connection('default')
+
+        # The fetch thread does not share the connection of the consumer
+        self.assertFalse(dedicated is connection)
+        self.assertEqual(dedicated.alias, 'default')
+        self.assertEqual(dedicated.settings_dict['NAME'],
+                         connection.settings_dict['NAME'])
+        dedicated.close()
+
+
+class PartitionedIterableTestCase(TransactionTestCase):
+    # Worker processes only see committed rows
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+        concepts = [DataField.objects.get(field_name=name).concepts.all()[0]
+                    for name in ('first_name', 'last_name')]
+        view = DataView(json=[{'concept': c.pk} for c in concepts])
+        self.processor = QueryProcessor(view=view, tree=Employee)
+
+    def read(self, iterable):
+        exporter = self.processor.get_exporter(BaseExporter)
+        return list(exporter.write(iterable))
+
+    def serial(self):
+        queryset = self.processor.get_queryset().order_by('pk')
+        return self.read(self.processor.get_iterable(queryset=queryset))
+
+    def test_rows(self):
+        iterable = self.processor.get_partitioned_iterable(chunksize=2,
+                                                           processes=1)
+        self.assertTrue(isinstance(iterable, PartitionedIterable))
+
+        # Rows of all ranges are returned in primary key order
+        rows = self.read(iterable)
+        self.assertEqual(rows, self.serial())
+        self.assertEqual([r[0] for r in rows], range(1, 7))
+
+    def test_sparse(self):
+        Employee.objects.filter(pk__in=[2, 3]).delete()
+
+        iterable = self.processor.get_partitioned_iterable(chunksize=1,
+                                                           processes=1)
+        rows = self.read(iterable)
+        self.assertEqual(rows, self.serial())
+        self.assertEqual([r[0] for r in rows], [1, 4, 5, 6])
+
+    def test_processes(self):
+        iterable = self.processor.get_partitioned_iterable(chunksize=2,
+                                                           processes=2)
+        self.assertEqual(self.read(iterable), self.serial())
+
+    def test_metrics(self):
+        reports = []
+        report = Metrics.report
+
+        def record(metrics, *args, **kwargs):
+            reports.append(metrics.as_dict())
+
+        iterable = self.processor.get_partitioned_iterable(chunksize=2,
+                                                           processes=2)
+        exporter = self.processor.get_exporter(BaseExporter)
+
+        Metrics.report = record
+
+        try:
+            list(exporter.write(iterable))
+        finally:
+            Metrics.report = report
+
+        # The metrics of the workers are reported once by the parent
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]['counters']['rows_fetched'], 6)
+        self.assertEqual(reports[0]['counters']['rows_emitted'], 6)
+        self.assertTrue('format' in reports[0]['timings'])
+
+    def test_estimate(self):
+        iterable = self.processor.get_partitioned_iterable(chunksize=4)
+        sizer = ChunkSizer(4, budget=0)
+
+        # Ranges are widened by the keys per row of the last range
+        iterable.estimate(sizer, 4, 2)
+        self.assertEqual(iterable.width, 8)
+
+        iterable.estimate(sizer, 8, 16)
+        self.assertEqual(iterable.width, 2)
+
+        # Empty ranges only grow by a bounded factor
+        iterable.estimate(sizer, 2, 0)
+        self.assertEqual(iterable.width, 2 * iterable.growth)
+
+        iterable.estimate(sizer, 1, 1)
+        self.assertEqual(iterable.width, 4)
+
+
+class QueryCacheTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+        cache.compiled_queries.clear()
+
+        self.field = DataField.objects.get_by_natural_key('tests', 'title',
+                                                          'name')
+        self.concept = DataField.objects.get(field_name='first_name')\
+            .concepts.all()[0]
+
+        self.context = DataContext(json={
+            'field': 'tests.title.name',
+            'operator': 'exact',
+            'value': 'Programmer',
+        })
+        self.view = DataView(json=[{'concept': self.concept.pk}])
+
+    def processor(self):
+        return QueryProcessor(context=self.context, view=self.view,
+                              tree=Employee)
+
+    def test_hit(self):
+        processor = self.processor()
+        queryset = processor.get_queryset()
+        key = processor.get_cache_key()
+
+        self.assertTrue(key)
+        self.assertTrue(isinstance(cache.compiled_queries.get(key), tuple))
+
+        processor = self.processor()
+        self.assertEqual(processor.get_cache_key(), key)
+
+        # The context is not parsed, translated or compiled again
+        with self.assertNumQueries(0):
+            cached = processor.get_queryset()
+            iterable = processor.get_iterable()
+
+        self.assertFalse('parse' in processor.metrics.timings)
+        self.assertFalse('compile' in processor.metrics.timings)
+        self.assertEqual(iterable.sql, cache.compiled_queries.get(key)[1])
+        self.assertEqual(list(cached), list(queryset))
+        self.assertEqual(len(list(iterable)), 3)
+
+    def test_context_changed(self):
+        key = self.processor().get_cache_key()
+
+        self.context = DataContext(json={
+            'field': 'tests.title.name',
+            'operator': 'exact',
+            'value': 'Analyst',
+        })
+        self.assertNotEqual(self.processor().get_cache_key(), key)
+
+    def test_view_changed(self):
+        key = self.processor().get_cache_key()
+
+        last_name = DataField.objects.get(field_name='last_name')\
+            .concepts.all()[0]
+        self.view = DataView(json=[{'concept': last_name.pk}])
+        self.assertNotEqual(self.processor().get_cache_key(), key)
+
+    def test_sample_strategy_changed(self):
+        key = self.processor().get_cache_key()
+        processor = QueryProcessor(context=self.context, view=self.view,
+                                   tree=Employee, sample_strategy='exists')
+        self.assertNotEqual(processor.get_cache_key(), key)
+
+    def test_field_changed(self):
+        processor = self.processor()
+        processor.get_queryset()
+        key = processor.get_cache_key()
+
+        # Fields of the context
+        self.field.data_version += 1
+        self.field.save()
+
+        processor = self.processor()
+        self.assertNotEqual(processor.get_cache_key(), key)
+        self.assertEqual(cache.compiled_queries.get(
+            processor.get_cache_key()), None)
+
+        # Fields of the view
+        key = processor.get_cache_key()
+
+        field = self.concept.fields.all()[0]
+        field.data_version += 1
+        field.save()
+
+        self.assertNotEqual(self.processor().get_cache_key(), key)
+
+
+class FetchStrategyTestCase(TestCase):
+    fixtures = ['employee_data.json']
+
+    def setUp(self):
+        class ChunkedProcessor(QueryProcessor):
+            chunked_tables = 'tests_'
+
+        self.processor = ChunkedProcessor(tree=Employee)
+        self.supports_streaming = pipeline.supports_streaming
+
+    def tearDown(self):
+        pipeline.supports_streaming = self.supports_streaming
+
+    def strategy(self, queryset, processor=None):
+        processor = processor or self.processor
+        sql, params = processor.compile(queryset)
+        return processor.get_fetch_strategy(queryset, sql)[0]
+
+    def test_order(self):
+        single = Employee.objects.values_list('pk', 'first_name')
+        multiple = Employee.objects.values_list('pk', 'project__name')
+
+        pipeline.supports_streaming = lambda connection: True
+
+        # Seeking is preferred over streaming
+        self.assertEqual(self.strategy(single), 'keyset')
+        self.assertEqual(self.strategy(multiple), 'stream')
+
+        pipeline.supports_streaming = lambda connection: False
+
+        self.assertEqual(self.strategy(single), 'keyset')
+        self.assertEqual(self.strategy(multiple), 'chunked')
+
+    def test_unchunked(self):
+        queryset = Employee.objects.values_list('pk', 'first_name')
+        processor = QueryProcessor(tree=Employee)
+
+        pipeline.supports_streaming = lambda connection: True
+        self.assertEqual(self.strategy(queryset, processor), 'stream')
+
+        pipeline.supports_streaming = lambda connection: False
+        self.assertEqual(self.strategy(queryset, processor), 'fetch')
+
+    def test_bounded(self):
+        queryset = Employee.objects.values_list('pk', 'first_name')[:2]
+
+        pipeline.supports_streaming = lambda connection: True
+        self.assertEqual(self.strategy(queryset), 'fetch')
+
+        # The default backend fetches the rows of the query
+        pipeline.supports_streaming = self.supports_streaming
+        iterable = QueryProcessor(tree=Employee).get_iterable(
+            queryset=Employee.objects.values_list('pk', 'first_name'))
+        self.assertEqual(len(list(iterable)), 6)
@@ -1,7 +1,9 @@
 from django.test import TestCase
 from django.core import management
 from django.core.exceptions import ValidationError
+from django.test.utils import override_settings
 from avocado.models import DataField
+from avocado.query.translators import ValueArray, Translator
 from ....models import Employee, Project
 
 
@@ -55,6 +57,15 @@ class TranslatorTestCase(BaseTestCase):
                          "(AND: ('title__salary__isnull', False), "
                          "('title__id__isnull', False))")
 
+    def test_pk_language(self):
+        field = DataField(app_name='tests', model_name='employee',
+                          field_name='id', type='auto')
+
+        # Objects without a label field describe themselves
+        trans = field.translate(value=1, tree=Employee)
+        self.assertTrue(unicode(Employee.objects.get(pk=1)) in
+                        trans['cleaned_data']['language'])
+
     def test_char(self):
         trans = self.first_name.translate(value='Robert', tree=Employee)
         self.assertEqual(unicode(trans['query_modifiers']['condition']),
@@ -67,6 +78,17 @@ class TranslatorTestCase(BaseTestCase):
                          "(OR: ('first_name__in', [u'Robert']), "
                          "('first_name__isnull', True))")
 
+    @override_settings(AVOCADO_QUERY_IN_ARRAY_THRESHOLD=1)
+    def test_char_in_array(self):
+        trans = self.first_name.translate(
+            value=['Eric', 'Zac'], operator='in', tree=Employee)
+        condition = trans['query_modifiers']['condition']
+        self.assertTrue(isinstance(condition.children[0][1], ValueArray))
+
+        names = Employee.objects.filter(condition)\
+            .values_list('first_name', flat=True)
+        self.assertEqual(sorted(names), ['Eric', 'Zac'])
+
     def test_char_isnull(self):
         self.assertRaises(ValidationError, self.first_name.translate,
                           value=False, operator='isnull', tree=Employee)
@@ -81,6 +103,29 @@ class TranslatorTestCase(BaseTestCase):
                           value=50.3932, tree=Project)
 
 
+class ValueValidatorTestCase(BaseTestCase):
+    def test_compiled_once(self):
+        trans = Translator()
+        validator = trans.get_value_validator(self.salary)
+        self.assertTrue(trans.get_value_validator(self.salary) is validator)
+
+        self.salary.data_version += 1
+        self.assertFalse(trans.get_value_validator(self.salary) is validator)
+
+    def test_clean_list(self):
+        validator = Translator().get_value_validator(self.salary)
+        self.assertEqual(validator.clean([1, None, 2.5, '3']),
+                         [1.0, None, 2.5, 3.0])
+        self.assertRaises(ValidationError, validator.clean, [1, 'a'])
+
+        validator = Translator().get_value_validator(self.first_name)
+        self.assertEqual(validator.clean(['Eric', u'Zac']),
+                         [u'Eric', u'Zac'])
+
+        validator = Translator().get_value_validator(self.budget)
+        self.assertRaises(ValidationError, validator.clean, [50, 50.3932])
+
+
 class TranslatorValueDictTestCase(BaseTestCase):
     def test_bool(self):
         trans = self.is_manager.translate(
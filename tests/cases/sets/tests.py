@@ -1,5 +1,7 @@
 from django.test import TestCase
-from avocado.models import DataField
+from django.core.exceptions import ValidationError
+from avocado.models import DataField, DataContext
+from avocado.query import translators
 from ...models import Record, RecordSet
 
 
@@ -26,3 +28,76 @@ class SetsTestCase(TestCase):
         trans = f.translate(value=s.pk, tree=Record)
         self.assertEqual(unicode(trans['query_modifiers']['condition']),
                          "(AND: ('recordset__id__exact', 1))")
+
+    def test_translator_in(self):
+        sets = [RecordSet(name=u'Set {0}'.format(i)) for i in xrange(3)]
+        [s.save() for s in sets]
+        sets[0].bulk([Record(pk=i) for i in xrange(1, 6)])
+
+        f = DataField(app_name='tests', model_name='recordset',
+                      field_name='id', type='auto')
+        pks = [s.pk for s in sets]
+
+        # Only the primary keys are validated and returned
+        trans = f.translate(operator='in', value=pks, tree=Record)
+        self.assertEqual(trans['cleaned_data']['value'], pks)
+
+        # Sets are described by their label field
+        language = trans['cleaned_data']['language']
+        self.assertTrue(u'Set 0' in language and u'Set 2' in language)
+
+        self.assertRaises(ValidationError, f.translate, operator='in',
+                          value=pks + [100], tree=Record)
+
+        # Querysets are used as a subquery of their primary keys
+        trans = f.translate(operator='in', tree=Record,
+                            value=RecordSet.objects.filter(pk=sets[0].pk))
+        condition = trans['query_modifiers']['condition']
+        self.assertEqual(Record.objects.filter(condition).distinct().count(),
+                         5)
+
+    def test_translator_queryset_language(self):
+        [RecordSet(name=u'Set {0}'.format(i)).save() for i in xrange(10)]
+        f = DataField(app_name='tests', model_name='recordset',
+                      field_name='id', type='auto')
+
+        # Querysets are counted and only the keys shown are described
+        trans = f.translate(operator='in', tree=Record,
+                            value=RecordSet.objects.order_by('pk'))
+        self.assertTrue(trans['cleaned_data']['language'].endswith(
+            u'is either Set 0, Set 1, Set 2 ... (6 more) or Set 9'))
+
+    def test_validate_describes_keys_once(self):
+        [RecordSet(name=u'Set {0}'.format(i)).save() for i in xrange(3)]
+        f = DataField(app_name='tests', model_name='recordset',
+                      field_name='id', type='auto')
+        f.save()
+
+        calls = []
+        describe_pks = translators.Translator._describe_pks
+
+        def counted(self, field, pks):
+            calls.append(sorted(pks))
+            return describe_pks(self, field, pks)
+
+        translators.Translator._describe_pks = counted
+
+        try:
+            attrs = DataContext.validate({
+                'type': 'or',
+                'children': [{
+                    'field': f.pk,
+                    'operator': 'in',
+                    'value': [1, 2],
+                }, {
+                    'field': f.pk,
+                    'operator': 'exact',
+                    'value': 3,
+                }],
+            }, tree=Record)
+        finally:
+            translators.Translator._describe_pks = describe_pks
+
+        # The keys of both conditions are described at once
+        self.assertEqual(calls, [[1, 2, 3]])
+        self.assertTrue(attrs['children'][1]['language'].endswith('Set 2'))